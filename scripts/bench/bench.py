@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the orchestration cycle
+Runs complete check cycles (in-process and as cold one-shot runs, the way cron
+starts the script) and single hot-path calls against local stand-ins, so no
+VPN, init system or root access is needed:
+* fakes/bin/systemctl and fakes/openrc-service keep the service states in files
+* fakes/netifaces.py serves the interfaces from a JSON file
+* fakes/bin/ping and fakes/bin/su (Flexget) answer immediately
+* a stub settings.json and an in-process Transmission RPC server
+Reports latency percentiles and the number of subprocesses per operation, and
+stores the results so a change can be compared against a baseline.
+
+Usage: python3 scripts/bench/bench.py [options]
+'''
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import socket
+import platform
+import tempfile
+import datetime
+import threading
+import subprocess
+import http.server
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(os.path.dirname(BENCH_DIR), "root")
+FAKES_DIR = os.path.join(BENCH_DIR, "fakes")
+
+VPN_PROVIDER = "bench"
+VPN_INTERFACE = "tun0"
+VPN_ADDR = "10.8.0.6"
+VPN_PEER = "127.0.0.1" # Answers ICMP where unprivileged ICMP sockets are allowed (fakes/bin/ping otherwise)
+LAN_ADDR = "192.168.1.20"
+DAEMON_NAME = "transmission-bench"
+
+SCENARIOS = ("idle", "active", "pending", "recover", "flexget")
+GROUPS = ("micro", "cycle", "cold")
+
+ITERATIONS = 100
+COLD_ITERATIONS = 10
+
+class ForkCounter:
+	"""
+	Counts the processes started through subprocess (run, check_output, Popen)
+	"""
+	count = 0
+
+	@classmethod
+	def install(cls):
+		base = subprocess.Popen
+		if (getattr(base, "benchCounting", False)):
+			return
+
+		class CountingPopen(base):
+			benchCounting = True
+
+			def __init__(self, *args, **kwargs):
+				cls.count += 1
+				base.__init__(self, *args, **kwargs)
+
+		subprocess.Popen = CountingPopen
+
+class FakeRpcHandler(http.server.BaseHTTPRequestHandler):
+	"""
+	Minimal Transmission RPC endpoint (session id handshake, keep-alive)
+	"""
+	protocol_version = "HTTP/1.1"
+	disable_nagle_algorithm = True # Headers and body are written separately
+
+	def reply(self, status, content, headers = None):
+		body = json.dumps(content).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self):
+		length = int(self.headers.get("Content-Length", 0))
+		request = json.loads(self.rfile.read(length).decode("utf-8"))
+		server = self.server
+		if (self.headers.get("X-Transmission-Session-Id") != server.sessionId):
+			self.reply(409, {}, {"X-Transmission-Session-Id": server.sessionId})
+			return
+		method = request.get("method")
+		arguments = {}
+		with server.lock:
+			if (method == "torrent-get"):
+				arguments = {"torrents": list(server.torrents)}
+			elif (method == "torrent-add"):
+				server.added += 1
+				arguments = {"torrent-added": {"id": 1000 + server.added, "name": "bench-%d" % (server.added),
+											   "hashString": "%040x" % (server.added)}}
+			elif (method == "session-get"):
+				arguments = {"version": "bench"}
+		self.reply(200, {"result": "success", "arguments": arguments})
+
+	def log_message(self, format, *args):
+		pass
+
+class FakeRpcServer(http.server.ThreadingHTTPServer):
+	"""
+	Transmission RPC stand-in serving a configurable torrent list
+	"""
+	daemon_threads = True
+
+	def __init__(self):
+		http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), FakeRpcHandler)
+		self.sessionId = "bench-session"
+		self.lock = threading.Lock()
+		self.torrents = []
+		self.added = 0
+		self.thread = threading.Thread(target = self.serve_forever, name = "fake-rpc", daemon = True)
+		self.thread.start()
+
+	def port(self):
+		return self.server_address[1]
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+class BenchEnv:
+	"""
+	Temporary directory with the stand-ins' state, the configuration and the torrent directories
+	"""
+	def __init__(self, path, initSystem = "systemd"):
+		"""
+		Constructor
+		@param path Environment directory
+		@param initSystem Init system to emulate (systemd or openRC)
+		"""
+		self.path = path
+		self.initSystem = initSystem
+		self.addedPath = os.path.join(path, "added")
+		self.activePath = os.path.join(path, "torrents")
+		self.downloadPath = os.path.join(path, "downloads")
+		self.initDir = os.path.join(path, "init.d")
+		self.openrcDir = os.path.join(path, "openrc")
+		self.settingsFile = os.path.join(path, "settings.json")
+		self.configFile = os.path.join(path, "bench.ini")
+		self.netifacesFile = os.path.join(path, "netifaces.json")
+		self.logFile = os.path.join(path, "torrent_vpn.log")
+		self.forksFile = os.path.join(path, "forks")
+		self.stateFile = os.path.join(path, "state.json")
+		self.iteration = 0
+
+	@classmethod
+	def create(cls, initSystem, rpcPort):
+		"""
+		Set up a new environment
+		@param initSystem Init system to emulate
+		@param rpcPort Port of the fake RPC server
+
+		@return BenchEnv object
+		"""
+		env = cls(tempfile.mkdtemp(prefix = "torrent_vpn_bench."), initSystem)
+		for d in (env.addedPath, env.activePath, env.downloadPath, env.initDir,
+				  os.path.join(env.openrcDir, "started"), os.path.join(env.path, "cgroup", "system.slice")):
+			os.makedirs(d)
+		for name in (env.vpnServiceName(), DAEMON_NAME):
+			os.symlink(os.path.join(FAKES_DIR, "openrc-service"), os.path.join(env.initDir, name))
+
+		with open(os.path.join(FAKES_DIR, "settings.json"), 'r') as f:
+			settings = json.load(f)
+		settings.update({"bind-address-ipv4": VPN_ADDR, "download-dir": env.downloadPath,
+						 "watch-dir": env.addedPath, "rpc-port": rpcPort})
+		with open(env.settingsFile, 'w') as f:
+			json.dump(settings, f, indent = 4, sort_keys = True)
+
+		with open(env.configFile, 'w') as f:
+			f.write("[DEFAULT]\nInitSystem = %s\nIspIpFirstOctet = 0\n\n" % (initSystem))
+			f.write("[VPN]\nProvider = %s\nInterface = %s\nRoutingTable = vpn\nMark = 0x2\nUser = transmission\n"
+					"ProbeTimeout = 3\nPingCount = 1\n\n" % (VPN_PROVIDER, VPN_INTERFACE))
+			f.write("[Torrents]\nHomePath = %s\nAddedPath = %s/\nActivePath = %s/\nConfigFile = %s\nDaemonName = %s\n"
+					"IndexFile = %s\nMinFreeSpace = 0\n\n" % (env.path, env.addedPath, env.activePath, env.settingsFile,
+															   DAEMON_NAME, os.path.join(env.path, "index.json")))
+			f.write("[Flexget]\nFlexgetBin = /bin/true\n\n")
+			f.write("[Metrics]\nJsonFile = %s\n" % (os.path.join(env.path, "metrics.json")))
+		return env
+
+	def vpnServiceName(self):
+		return ("openvpn@" if (self.initSystem == "systemd") else "openvpn.") + VPN_PROVIDER
+
+	def install(self):
+		"""
+		Put the stand-ins in place for this process (and the processes it starts)
+		"""
+		os.environ["BENCH_STATE"] = self.path
+		os.environ["BENCH_NETIFACES"] = self.netifacesFile
+		os.environ["PATH"] = os.path.join(FAKES_DIR, "bin") + os.pathsep + os.environ.get("PATH", "")
+		# The fake netifaces shadows an installed one
+		for d in (ROOT_DIR, FAKES_DIR):
+			if (d not in sys.path):
+				sys.path.insert(0, d)
+
+	def setService(self, name, running):
+		"""
+		Set the state of a fake service
+		@param name Service name
+		@param running True for a running service
+		"""
+		if (self.initSystem == "systemd"):
+			# See fakes/bin/systemctl
+			unitSlice = "system.slice"
+			if ('@' in name):
+				unitSlice = os.path.join(unitSlice, "system-%s.slice" % (name.split('@')[0]))
+			path = os.path.join(self.path, "cgroup", unitSlice, name if ('.' in name) else name + ".service")
+			os.makedirs(os.path.dirname(path), exist_ok = True)
+		else:
+			path = os.path.join(self.openrcDir, "started", name)
+		if (running):
+			open(path, 'w').close()
+		elif (os.path.exists(path)):
+			os.unlink(path)
+
+	def setTunnel(self, up, peer = VPN_PEER):
+		"""
+		Add or remove the tunnel interface (the LAN interface is always present)
+		@param up True to add the tunnel interface
+		@param peer Peer address of the tunnel
+		"""
+		ifaces = {"lo": [{"addr": "127.0.0.1", "netmask": "255.0.0.0"}]}
+		# The default route of this host is looked up in /proc/net/route
+		import Network.routetable as routetable
+		try:
+			route = routetable.RouteTable(watch = False).getDefaultRoute()
+		except OSError:
+			route = None
+		if (route is not None):
+			ifaces[route.iface] = [{"addr": LAN_ADDR, "netmask": "255.255.255.0"}]
+		if (up):
+			ifaces[VPN_INTERFACE] = [{"addr": VPN_ADDR, "peer": peer, "netmask": "255.255.255.255"}]
+		with open(self.netifacesFile + ".tmp", 'w') as f:
+			json.dump(ifaces, f)
+		os.replace(self.netifacesFile + ".tmp", self.netifacesFile)
+
+	def setScenario(self, scenario, rpc):
+		"""
+		Bring the fake system into the state of a scenario
+		@param scenario Scenario name (see SCENARIOS)
+		@param rpc FakeRpcServer object
+		"""
+		busy = (scenario != "idle")
+		self.setService(self.vpnServiceName(), busy)
+		self.setService(DAEMON_NAME, busy)
+		self.setTunnel(busy)
+		for d in (self.addedPath, self.activePath):
+			for name in os.listdir(d):
+				os.unlink(os.path.join(d, name))
+		with rpc.lock:
+			rpc.torrents = []
+		if (busy):
+			with open(os.path.join(self.activePath, "active.torrent"), 'wb') as f:
+				f.write(makeTorrent("active"))
+			with rpc.lock:
+				rpc.torrents = [{"id": 1, "status": 4, "percentDone": 0.5, "rateDownload": 1024, "isFinished": False}]
+
+	def prepareIteration(self, scenario):
+		"""
+		Per iteration set-up (the checks consume some of the scenario state)
+		@param scenario Scenario name
+		"""
+		self.iteration += 1
+		if (scenario == "pending"):
+			name = "new-%d.torrent" % (self.iteration)
+			with open(os.path.join(self.addedPath, name), 'wb') as f:
+				f.write(makeTorrent(name))
+		elif (scenario == "recover"):
+			self.setService(self.vpnServiceName(), False)
+
+	def cleanup(self):
+		shutil.rmtree(self.path, ignore_errors = True)
+
+def makeTorrent(name, size = 1024 * 1024):
+	"""
+	@return Metainfo bytes of a (single file) torrent
+	"""
+	name = name.encode("utf-8")
+	info = b"d6:lengthi%de4:name%d:%s12:piece lengthi262144e6:pieces20:%se" % (size, len(name), name, b"\0" * 20)
+	return b"d8:announce18:http://bench/annou4:info" + info + b"e"
+
+def loadOrchestrator(env):
+	"""
+	Import torrent_vpn with the stand-ins in place, redirecting its state files into the environment
+
+	@return torrent_vpn module
+	"""
+	env.install()
+	ForkCounter.install()
+	import torrent_vpn
+	import Service.service as service
+	import Torrent.completion as completion
+
+	service.dbus = None # Status through the (fake) status command, not the host's systemd
+	service.OPENRC_RUN_DIR = env.openrcDir
+	service.OPENRC_INIT_DIR = env.initDir
+	service.SYSTEMD_CGROUP_ROOTS = (os.path.join(env.path, "cgroup"),)
+	torrent_vpn.snapshot.STATE_FILE = env.stateFile
+	torrent_vpn.TORRENT_IDLE_FILE = os.path.join(env.path, "idle.json")
+	torrent_vpn.GlobalState.pidFile = os.path.join(env.path, "torrent_vpn.pid")
+	completion.CompletionSpool.__init__.__defaults__ = (os.path.join(env.path, "completed"), completion.BATCH_WINDOW, False, completion.MAX_ATTEMPTS, completion.RETRY_DELAY)
+
+	# Never touch the host's routes and firewall; the Flexget window only opens in the flexget scenario
+	torrent_vpn.vpnSetRoutesAndRules = lambda vpn: torrent_vpn.SUCCESS
+	torrent_vpn.needFlexget = lambda: torrent_vpn.GlobalState.flexgetOverwrite
+	return torrent_vpn
+
+def setupOrchestrator(t, env):
+	"""
+	Configure the orchestrator the way main() does
+
+	@return Tuple of (vpn, transmission) objects
+	"""
+	import Log.logqueue as logqueue
+	import Torrent.inventory as inventory
+	import Torrent.metainfo as metainfo
+	import Torrent.completion as completion
+	import Torrent.flexget as flexget
+
+	t.getConfig(env.configFile)
+	logqueue.setup(env.logFile, console = False)
+	vpn, transmission = t.createObjects()
+	t.GlobalState.torrentInventory = inventory.TorrentInventory(t.GlobalState.torrentAddedPath, t.GlobalState.torrentActivePath,
+																False, False)
+	t.GlobalState.torrentIndex = metainfo.TorrentIndex(t.GlobalState.torrentIndexFile)
+	t.GlobalState.torrentCompletion = completion.CompletionSpool()
+	t.GlobalState.flexgetRunner = flexget.Flexget(t.GlobalState.flexgetBin, t.GlobalState.vpnUser, t.GlobalState.flexgetConfigDir,
+												  t.GlobalState.flexgetDaemon, t.GlobalState.flexgetTimeout)
+	return vpn, transmission
+
+def percentile(ordered, fraction):
+	"""
+	@return Nearest-rank percentile of a sorted list
+	"""
+	idx = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+	return ordered[idx]
+
+def summarise(samples, forks):
+	"""
+	@param samples Durations (in seconds)
+	@param forks Subprocess counts, one per sample
+	@return Statistics dictionary (times in ms)
+	"""
+	ordered = sorted(s * 1000 for s in samples)
+	return {"n": len(ordered), "mean": sum(ordered) / len(ordered), "min": ordered[0],
+			"p50": percentile(ordered, 0.5), "p90": percentile(ordered, 0.9), "p99": percentile(ordered, 0.99),
+			"max": ordered[-1], "forks": sum(forks) / len(forks)}
+
+def measure(func, iterations, before = None):
+	"""
+	Time a function
+	@param func Function to call
+	@param iterations Number of calls
+	@param before Function called (untimed) before each call, None for none
+
+	@return Statistics dictionary
+	"""
+	samples = []
+	forks = []
+	for i in range(iterations):
+		if (before is not None):
+			before()
+		ForkCounter.count = 0
+		startTime = time.perf_counter()
+		func()
+		samples.append(time.perf_counter() - startTime)
+		forks.append(ForkCounter.count)
+	return summarise(samples, forks)
+
+def benchMicro(t, env, rpc, vpn, transmission, iterations):
+	"""
+	Microbenchmarks of single hot-path calls
+
+	@return Dictionary of benchmark name -> statistics
+	"""
+	import Service.service as service
+	results = {}
+	env.setScenario("active", rpc)
+	vpn.updateInfo()
+
+	results["Service.getStatus"] = measure(lambda: transmission.getStatus(0), iterations)
+	results["Service.getStatus(cached)"] = measure(lambda: transmission.getStatus(), iterations)
+	results["Interface.getTunnelParams"] = measure(vpn.vpnIf.getTunnelParams, iterations)
+	results["VPN.pingPeer"] = measure(lambda: vpn.pingPeer(1), iterations)
+	results["setLanInfo"] = measure(t.setLanInfo, iterations)
+	results["needTorrentClient"] = measure(t.needTorrentClient, iterations)
+	results["transmissionUpdateBindIp(unchanged)"] = measure(
+		lambda: t.transmissionUpdateBindIp(transmission, env.settingsFile, VPN_ADDR), iterations)
+
+	# Rebind while the daemon is stopped: settings rewrite only
+	addrs = ["10.8.0.%d" % (10 + (i % 2)) for i in range(iterations)]
+	env.setService(DAEMON_NAME, False)
+	results["transmissionUpdateBindIp(changed)"] = measure(
+		lambda: t.transmissionUpdateBindIp(transmission, env.settingsFile, addrs.pop()), iterations)
+	t.transmissionUpdateBindIp(transmission, env.settingsFile, VPN_ADDR)
+	return results
+
+def benchCycles(t, env, rpc, vpn, transmission, scenarios, iterations):
+	"""
+	Complete in-process check cycles per scenario
+
+	@return Dictionary of benchmark name -> statistics
+	"""
+	results = {}
+	for scenario in scenarios:
+		env.setScenario(scenario, rpc)
+		t.GlobalState.flexgetOverwrite = (scenario == "flexget")
+		results["cycle/%s" % (scenario)] = measure(lambda: t.runCycleSafe(vpn, transmission), iterations,
+												   lambda: env.prepareIteration(scenario))
+	t.GlobalState.flexgetOverwrite = False
+	return results
+
+def benchCold(env, rpc, scenarios, iterations):
+	"""
+	One-shot runs in a new interpreter (as started by cron), including interpreter start-up and imports
+
+	@return Dictionary of benchmark name -> statistics
+	"""
+	results = {}
+	results["cold/python-startup"] = measure(lambda: subprocess.run([sys.executable, "-c", "pass"]), iterations)
+	for scenario in scenarios:
+		env.setScenario(scenario, rpc)
+		samples = []
+		forks = []
+		for i in range(iterations):
+			env.prepareIteration(scenario)
+			cmd = [sys.executable, os.path.join(BENCH_DIR, "coldrun.py"), env.path, env.initSystem]
+			if (scenario == "flexget"):
+				cmd.append("--flexget")
+			startTime = time.perf_counter()
+			subprocess.run(cmd, stdout = subprocess.DEVNULL)
+			samples.append(time.perf_counter() - startTime)
+			with open(env.forksFile, 'r') as f:
+				forks.append(int(f.read()))
+		results["cold/%s" % (scenario)] = summarise(samples, forks)
+	return results
+
+def gitRevision():
+	try:
+		return subprocess.check_output(["git", "-C", BENCH_DIR, "rev-parse", "--short", "HEAD"],
+									   stderr = subprocess.DEVNULL).decode("utf-8").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def printResults(results, baseline = None):
+	"""
+	Print the statistics, with the change of the median against a baseline
+	"""
+	header = "%-38s %5s %9s %9s %9s %9s %9s %7s" % ("benchmark", "n", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms", "forks")
+	if (baseline is not None):
+		header += "  %9s %7s" % ("base p50", "change")
+	print(header)
+	for name, r in results.items():
+		line = "%-38s %5d %9.3f %9.3f %9.3f %9.3f %9.3f %7.1f" % (name, r["n"], r["mean"], r["p50"], r["p90"], r["p99"], r["max"], r["forks"])
+		base = (baseline or {}).get(name)
+		if (base is not None):
+			change = ((r["p50"] - base["p50"]) / base["p50"] * 100) if (base["p50"] > 0) else 0.0
+			line += "  %9.3f %+6.1f%%" % (base["p50"], change)
+			if (r["forks"] != base["forks"]):
+				line += "  forks %.1f -> %.1f" % (base["forks"], r["forks"])
+		print(line)
+
+def printUsage(appName):
+	"""
+	Print script usage
+	"""
+	print("\nUsage: %s [options]" % appName)
+	print("Available Options:")
+	print("  -h | --help                            This help message")
+	print("  -n | --iterations    <count>           Iterations per micro/cycle benchmark (defaults to %d)" % (ITERATIONS))
+	print("  -c | --cold          <count>           Iterations per cold one-shot run benchmark (defaults to %d)" % (COLD_ITERATIONS))
+	print("  -g | --groups        <group,...>       Benchmark groups to run: %s (defaults to all)" % (",".join(GROUPS)))
+	print("  -s | --scenarios     <scenario,...>    Cycle scenarios: %s (defaults to all)" % (",".join(SCENARIOS)))
+	print("  -i | --init-system   <init system>     Init system to emulate: systemd (default) or openRC")
+	print("  -o | --save          <results file>    Store the results (JSON)")
+	print("  -b | --baseline      <results file>    Compare against stored results")
+	sys.exit()
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hn:c:g:s:i:o:b:", ["help","iterations=","cold=","groups=","scenarios=",
+									"init-system=","save=","baseline="])
+	except getopt.GetoptError as goe:
+		print(goe)
+		printUsage(sys.argv[0])
+
+	iterations = ITERATIONS
+	coldIterations = COLD_ITERATIONS
+	groups = list(GROUPS)
+	scenarios = list(SCENARIOS)
+	initSystem = "systemd"
+	saveFile = None
+	baselineFile = None
+	try:
+		for opt, arg in opts:
+			if opt in ("-h", "--help"):
+				printUsage(sys.argv[0])
+			elif opt in ("-n", "--iterations"):
+				iterations = int(arg)
+			elif opt in ("-c", "--cold"):
+				coldIterations = int(arg)
+			elif opt in ("-g", "--groups"):
+				groups = arg.split(",")
+			elif opt in ("-s", "--scenarios"):
+				scenarios = arg.split(",")
+			elif opt in ("-i", "--init-system"):
+				initSystem = arg
+			elif opt in ("-o", "--save"):
+				saveFile = arg
+			elif opt in ("-b", "--baseline"):
+				baselineFile = arg
+	except ValueError:
+		print("Error: iteration counts must be whole numbers")
+		sys.exit(1)
+	if ((not set(groups) <= set(GROUPS)) or (not set(scenarios) <= set(SCENARIOS)) or (initSystem not in ("systemd", "openRC"))):
+		printUsage(sys.argv[0])
+
+	baseline = None
+	if (baselineFile is not None):
+		with open(baselineFile, 'r') as f:
+			baseline = json.load(f)["results"]
+
+	revision = gitRevision()
+	rpc = FakeRpcServer()
+	env = BenchEnv.create(initSystem, rpc.port())
+	results = {}
+	try:
+		t = loadOrchestrator(env)
+		vpn, transmission = setupOrchestrator(t, env)
+		if ("micro" in groups):
+			results.update(benchMicro(t, env, rpc, vpn, transmission, iterations))
+		if ("cycle" in groups):
+			results.update(benchCycles(t, env, rpc, vpn, transmission, scenarios, iterations))
+		if (("cold" in groups) and (coldIterations > 0)):
+			results.update(benchCold(env, rpc, scenarios, coldIterations))
+	finally:
+		rpc.stop()
+		env.cleanup()
+
+	printResults(results, baseline)
+	if (saveFile is not None):
+		content = {"meta": {"time": datetime.datetime.now().isoformat(timespec = "seconds"), "revision": revision,
+							"python": platform.python_version(), "host": socket.gethostname(), "initSystem": initSystem,
+							"iterations": iterations, "coldIterations": coldIterations},
+				   "results": results}
+		with open(saveFile, 'w') as f:
+			json.dump(content, f, indent = 1, sort_keys = True)
+		print("Results saved to %s" % (saveFile))
+
+if __name__ == '__main__':
+	main()
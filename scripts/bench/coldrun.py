@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+'''
+Body of a cold one-shot run of bench.py (as started by cron)
+Like torrent_vpn.py, the idle fast path is tried before anything else is
+imported; bench.py (with its stand-ins and orchestrator set-up) is only loaded
+when the full checks run, so the measured time is that of the script and not
+that of the benchmark.
+
+Usage: coldrun.py <environment directory> <init system> [--flexget]
+'''
+import os
+import sys
+import atexit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(os.path.dirname(BENCH_DIR), "root")
+
+def main():
+	envPath = sys.argv[1]
+	initSystem = sys.argv[2]
+	flexget = ("--flexget" in sys.argv[3:])
+	forks = [0]
+
+	def saveForks():
+		with open(os.path.join(envPath, "forks"), 'w') as f:
+			f.write("%d" % (forks[0]))
+	atexit.register(saveForks)
+
+	sys.argv = ["torrent_vpn.py", "-c", os.path.join(envPath, "bench.ini"), "-l", os.path.join(envPath, "torrent_vpn.log")] + (["-f"] if flexget else [])
+	sys.path.insert(0, ROOT_DIR)
+	import Service.snapshot as snapshot
+	snapshot.STATE_FILE = os.path.join(envPath, "state.json") # BenchEnv.stateFile
+	if (snapshot.idleFastPath(sys.argv[1:])):
+		return
+
+	import bench
+	env = bench.BenchEnv(envPath, initSystem)
+	t = bench.loadOrchestrator(env)
+	try:
+		t.main()
+	finally:
+		forks[0] = bench.ForkCounter.count
+
+if __name__ == '__main__':
+	main()
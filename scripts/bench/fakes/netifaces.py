@@ -0,0 +1,72 @@
+'''
+Stand-in for the netifaces module
+The interfaces and their addresses are read from the JSON file named by
+$BENCH_NETIFACES on every call (the real module queries the kernel on every
+call as well): {"<interface>": [{"addr": ..., "peer"/"netmask": ...}], ...}
+With BENCH_NETIFACES=kernel the (first) IPv4 address of each interface is
+queried from the kernel instead; unlike the real module a peer address is
+reported for any interface that has one, so a veth pair can stand in for a tunnel.
+'''
+import os
+import json
+import fcntl
+import socket
+import struct
+
+AF_INET = 2
+
+KERNEL = "kernel"
+
+SIOCGIFADDR = 0x8915
+SIOCGIFDSTADDR = 0x8917
+SIOCGIFNETMASK = 0x891b
+
+def kernelAddress(sock, ifId, request):
+	"""
+	@return IPv4 address (string) of an interface address ioctl, None if not set
+	"""
+	try:
+		ifreq = fcntl.ioctl(sock.fileno(), request, struct.pack("256s", ifId.encode("utf-8")[:15]))
+	except OSError:
+		return None
+	return socket.inet_ntoa(ifreq[20:24])
+
+def loadKernel():
+	"""
+	@return Dictionary of interface name -> list of IPv4 address dictionaries, from the kernel
+	"""
+	ifaces = {}
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+		for index, ifId in socket.if_nameindex():
+			addr = kernelAddress(sock, ifId, SIOCGIFADDR)
+			if (addr is None):
+				ifaces[ifId] = []
+				continue
+			entry = {"addr": addr, "netmask": kernelAddress(sock, ifId, SIOCGIFNETMASK)}
+			peer = kernelAddress(sock, ifId, SIOCGIFDSTADDR)
+			if (peer not in (None, addr)):
+				entry["peer"] = peer
+			ifaces[ifId] = [entry]
+	return ifaces
+
+def load():
+	"""
+	@return Dictionary of interface name -> list of IPv4 address dictionaries
+	"""
+	if (os.environ.get("BENCH_NETIFACES") == KERNEL):
+		return loadKernel()
+	try:
+		with open(os.environ["BENCH_NETIFACES"], 'r') as f:
+			return json.load(f)
+	except (KeyError, OSError, ValueError):
+		return {}
+
+def interfaces():
+	return list(load().keys())
+
+def ifaddresses(ifId):
+	ifaces = load()
+	if (ifId not in ifaces):
+		raise ValueError("You must specify a valid interface name.")
+	addrs = ifaces[ifId]
+	return {AF_INET: addrs} if (addrs) else {}
@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+'''
+Fault injection: VPN recovery time (MTTR)
+Keeps the orchestrator in its active state (VPN and torrent daemon running),
+injects a failure and runs check cycles, at the given interval, until the VPN
+is healthy again. Reports, per failure mode, the time from the failure to a
+healthy VPN, the time until the first restart and the number of restarts and
+cycles it took, so the retry policy of vpnCheck() and VPN.start() can be tuned
+from data.
+
+The VPN service is the fake service of bench.py; the tunnel follows it (it
+appears tunnel-delay seconds after a start and vanishes on a stop):
+* netns mode (root, iproute2): the orchestrator runs in its own network
+  namespace, the tunnel is one end of a veth pair whose other end lives in a
+  peer namespace that answers ICMP and the external IP (DNS) query. Link events,
+  ICMP and DNS are real; the host's network is never touched.
+* sim mode: the tunnel is the fake netifaces file, a silenced peer is replaced
+  by an address nobody answers, and the DNS server listens on the loopback.
+
+A failure of the tunnel lasts until the VPN is restarted (or, with --persist,
+survives that number of restarts); with --persist, that many more service
+starts stall or route set-ups fail. A cycle that passes the checks while the failure is still
+present (eg a silenced peer while the external IP check passes) is counted as
+masked: that failure is not recovered from.
+
+Usage: python3 scripts/bench/mttr.py [options]
+'''
+import os
+import sys
+import json
+import time
+import ctypes
+import random
+import getopt
+import shutil
+import socket
+import struct
+import platform
+import datetime
+import threading
+import subprocess
+
+import bench
+
+SCENARIOS = ("service-down", "service-stall", "iface-vanish", "peer-icmp", "dns-timeout", "blackout", "route-error")
+MODES = ("sim", "netns")
+
+REPETITIONS = 3
+INTERVAL = 2.0 # s between cycles
+RUN_TIMEOUT = 90.0 # s after which a failure counts as not recovered
+STALL = 10.0 # s a stalled service start takes
+TUNNEL_DELAY = 0.5 # s between the service start and the tunnel address
+
+EXTERNAL_IP = "203.0.113.7" # Answer of the external IP query (the VPN exit)
+ISP_FIRST_OCTET = "192"
+SILENT_PEER = "198.51.100.1" # Sim mode: peer address nothing answers (TEST-NET-2)
+
+HOST_NS = "tvpn-mttr"
+PEER_NS = "tvpn-mttr-peer"
+TUNNEL_PEER = "10.8.0.1"
+PEER_IF = "peer0"
+LAN_IF = "lan0"
+LAN_PEER_IF = "lan1"
+LAN_GW = "192.168.1.1"
+NETNS_DIR = "/run/netns"
+CLONE_NEWNET = 0x40000000
+
+class FakeDnsServer:
+	"""
+	Answers every A query with EXTERNAL_IP, or silently drops the queries while muted
+	"""
+	def __init__(self, address):
+		"""
+		Constructor (the socket belongs to the network namespace of the calling thread)
+		@param address Address to listen on
+		"""
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind((address, 0))
+		self.muted = False
+		self.thread = threading.Thread(target = self.serve, name = "fake-dns", daemon = True)
+
+	def port(self):
+		return self.sock.getsockname()[1]
+
+	def start(self):
+		self.thread.start()
+
+	def serve(self):
+		while True:
+			try:
+				msg, client = self.sock.recvfrom(512)
+			except OSError:
+				return
+			if (self.muted or (len(msg) < 12)):
+				continue
+			# Header and question (the query name is not compressed) followed by the answer
+			end = 12
+			while ((end < len(msg)) and msg[end]):
+				end += msg[end] + 1
+			end += 5
+			if (end > len(msg)):
+				continue
+			qid = struct.unpack_from("!H", msg)[0]
+			answer = struct.pack("!HHHIH", 0xc00c, 1, 1, 0, 4) + socket.inet_aton(EXTERNAL_IP)
+			self.sock.sendto(struct.pack("!HHHHHH", qid, 0x8180, 1, 1, 0, 0) + msg[12:end] + answer, client)
+
+	def stop(self):
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.sock.close()
+
+def ip(*args, check = True):
+	"""
+	Run an ip(8) command
+	@param args Arguments
+	@param check Raise on failure
+
+	@throws RuntimeError if the command fails (and check is set)
+	"""
+	result = subprocess.run(["ip"] + list(args), stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+	if (check and (result.returncode != 0)):
+		raise RuntimeError("ip %s: %s" % (" ".join(args), result.stderr.decode("utf-8", "replace").strip()))
+
+def setNetns(name):
+	"""
+	Move the calling thread into a named network namespace
+	Threads started afterwards inherit it, so this is done before any thread is started.
+	@param name Namespace name (see ip netns)
+	"""
+	libc = ctypes.CDLL(None, use_errno = True)
+	fd = os.open(os.path.join(NETNS_DIR, name), os.O_RDONLY)
+	try:
+		if (libc.setns(fd, CLONE_NEWNET) != 0):
+			err = ctypes.get_errno()
+			raise OSError(err, "setns %s: %s" % (name, os.strerror(err)))
+	finally:
+		os.close(fd)
+
+class SimTunnel:
+	"""
+	Tunnel stand-in of the fake netifaces file (no link events, the VPN polls for the address)
+	"""
+	linkEvents = False
+	resolverAddr = "127.0.0.1"
+
+	def __init__(self, env):
+		self.env = env
+
+	def setup(self):
+		pass
+
+	def up(self, icmp = True):
+		self.setIcmp(icmp)
+
+	def down(self):
+		self.env.setTunnel(False)
+
+	def setIcmp(self, answer):
+		self.env.setTunnel(True, bench.VPN_PEER if (answer) else SILENT_PEER)
+		peerDown = os.path.join(self.env.path, "peer-down") # Read by fakes/bin/ping
+		if (answer):
+			if (os.path.exists(peerDown)):
+				os.unlink(peerDown)
+		else:
+			open(peerDown, 'w').close()
+
+	def dnsServer(self):
+		return FakeDnsServer(self.resolverAddr)
+
+	def cleanup(self):
+		pass
+
+class NetnsTunnel:
+	"""
+	Tunnel stand-in of a veth pair between the orchestrator's namespace and a peer namespace
+	"""
+	linkEvents = True
+	resolverAddr = TUNNEL_PEER
+
+	def __init__(self, env):
+		self.env = env
+
+	@staticmethod
+	def available():
+		return ((os.geteuid() == 0) and (shutil.which("ip") is not None))
+
+	def setup(self):
+		"""
+		Create the namespaces (with a LAN link and default route) and move into the orchestrator's
+		"""
+		self.cleanup()
+		ip("netns", "add", HOST_NS)
+		ip("netns", "add", PEER_NS)
+		for ns in (HOST_NS, PEER_NS):
+			ip("-n", ns, "link", "set", "lo", "up")
+		ip("link", "add", LAN_IF, "netns", HOST_NS, "type", "veth", "peer", "name", LAN_PEER_IF, "netns", PEER_NS)
+		ip("-n", HOST_NS, "addr", "add", bench.LAN_ADDR + "/24", "dev", LAN_IF)
+		ip("-n", PEER_NS, "addr", "add", LAN_GW + "/24", "dev", LAN_PEER_IF)
+		ip("-n", HOST_NS, "link", "set", LAN_IF, "up")
+		ip("-n", PEER_NS, "link", "set", LAN_PEER_IF, "up")
+		ip("-n", HOST_NS, "route", "add", "default", "via", LAN_GW)
+		setNetns(HOST_NS)
+
+	def up(self, icmp = True):
+		ip("link", "add", bench.VPN_INTERFACE, "type", "veth", "peer", "name", PEER_IF, "netns", PEER_NS)
+		ip("-n", PEER_NS, "addr", "add", TUNNEL_PEER, "peer", bench.VPN_ADDR, "dev", PEER_IF)
+		ip("-n", PEER_NS, "link", "set", PEER_IF, "up")
+		self.setIcmp(icmp)
+		ip("link", "set", bench.VPN_INTERFACE, "up")
+		ip("addr", "add", bench.VPN_ADDR, "peer", TUNNEL_PEER, "dev", bench.VPN_INTERFACE)
+
+	def down(self):
+		ip("link", "del", bench.VPN_INTERFACE, check = False)
+
+	def setIcmp(self, answer):
+		ip("netns", "exec", PEER_NS, "sysctl", "-qw", "net.ipv4.icmp_echo_ignore_all=%d" % (0 if (answer) else 1))
+
+	def dnsServer(self):
+		setNetns(PEER_NS)
+		try:
+			return FakeDnsServer("0.0.0.0")
+		finally:
+			setNetns(HOST_NS)
+
+	def cleanup(self):
+		for ns in (HOST_NS, PEER_NS):
+			if (os.path.exists(os.path.join(NETNS_DIR, ns))):
+				ip("netns", "del", ns, check = False)
+
+class FaultInjector:
+	"""
+	Runs the tunnel along with the VPN service and applies the failures
+	"""
+	def __init__(self, t, env, tunnel, dnsServer, tunnelDelay, stall, persist):
+		"""
+		Constructor
+		@param t torrent_vpn module
+		@param env bench.BenchEnv object
+		@param tunnel SimTunnel or NetnsTunnel object
+		@param dnsServer FakeDnsServer object
+		@param tunnelDelay Time (in seconds) between a service start and the tunnel address
+		@param stall Time (in seconds) a stalled service start takes
+		@param persist Number of VPN restarts a failure survives
+		"""
+		self.t = t
+		self.env = env
+		self.tunnel = tunnel
+		self.dnsServer = dnsServer
+		self.tunnelDelay = tunnelDelay
+		self.stall = stall
+		self.persist = persist
+		self.lock = threading.Lock()
+		self.timer = None
+		self.tunnelUp = False
+		self.faults = set()
+		self.survive = 0
+		self.stalls = 0
+		self.routeFailures = 0
+		self.starts = 0
+		self.firstStart = None
+
+	def attach(self, vpn):
+		"""
+		Hook into the VPN service (the tunnel follows its starts and stops) and the route set-up
+		@param vpn VPN object of the orchestrator
+		"""
+		import Service.service as service
+		vpnService = vpn.service
+		serviceStart = vpnService.start
+		serviceStop = vpnService.stop
+
+		def start(*args, **kwargs):
+			self.serviceStarting()
+			status = serviceStart(*args, **kwargs)
+			if (status == service.RUNNING):
+				self.serviceStarted()
+			return status
+
+		def stop(*args, **kwargs):
+			serviceStop(*args, **kwargs)
+			self.setTunnel(False)
+
+		vpnService.start = start
+		vpnService.stop = stop
+		self.t.vpnSetRoutesAndRules = self.setRoutes
+
+	def setRoutes(self, vpn):
+		with self.lock:
+			if (self.routeFailures > 0):
+				self.routeFailures -= 1
+				return self.t.ERROR
+		return self.t.SUCCESS
+
+	def stallFile(self):
+		return os.path.join(self.env.path, "stall", self.env.vpnServiceName())
+
+	def serviceStarting(self):
+		"""
+		A VPN (re)start: a pending stall applies to it, the tunnel failures are cleared by it
+		"""
+		with self.lock:
+			self.starts += 1
+			if (self.firstStart is None):
+				self.firstStart = time.monotonic()
+			if (self.stalls > 0):
+				self.stalls -= 1
+				os.makedirs(os.path.dirname(self.stallFile()), exist_ok = True)
+				with open(self.stallFile(), 'w') as f:
+					f.write("%g" % (self.stall))
+			self.faults.discard("service")
+			if (self.survive > 0):
+				self.survive -= 1
+			else:
+				self.faults.clear()
+			self.dnsServer.muted = ("dns" in self.faults)
+
+	def serviceStarted(self):
+		with self.lock:
+			if (self.timer is not None):
+				self.timer.cancel()
+			self.timer = threading.Timer(self.tunnelDelay, self.setTunnel, (True,))
+			self.timer.daemon = True
+			self.timer.start()
+
+	def setTunnel(self, up):
+		"""
+		Bring the tunnel up (unless it vanished for good) or down
+		"""
+		with self.lock:
+			if (self.timer is not None):
+				self.timer.cancel()
+				self.timer = None
+			if (self.tunnelUp):
+				self.tunnel.down()
+				self.tunnelUp = False
+			if (up and ("iface" not in self.faults)):
+				self.tunnel.up("icmp" not in self.faults)
+				self.tunnelUp = True
+
+	def healthy(self):
+		"""
+		@return True if no failure is left and the tunnel is up (the ground truth)
+		"""
+		with self.lock:
+			return ((not self.faults) and (self.routeFailures == 0) and self.tunnelUp)
+
+	def reset(self, rpc):
+		"""
+		Back to the healthy, active state
+		@param rpc bench.FakeRpcServer object
+		"""
+		with self.lock:
+			self.faults = set()
+			self.survive = 0
+			self.stalls = 0
+			self.routeFailures = 0
+			self.dnsServer.muted = False
+			if (os.path.exists(self.stallFile())):
+				os.unlink(self.stallFile())
+		self.env.setScenario("active", rpc)
+		self.setTunnel(False)
+		self.setTunnel(True)
+		with self.lock:
+			self.starts = 0
+			self.firstStart = None
+
+	def inject(self, scenario):
+		"""
+		Apply the failure of a scenario
+		@param scenario Scenario name (see SCENARIOS)
+		"""
+		serviceDies = scenario in ("service-down", "service-stall", "route-error")
+		with self.lock:
+			self.survive = self.persist
+			if (serviceDies):
+				self.faults.add("service")
+			if (scenario == "service-stall"):
+				self.stalls = 1 + self.persist
+			elif (scenario == "iface-vanish"):
+				self.faults.add("iface")
+			elif (scenario == "route-error"):
+				self.routeFailures = 1 + self.persist
+			if (scenario in ("peer-icmp", "blackout")):
+				self.faults.add("icmp")
+				self.tunnel.setIcmp(False)
+			if (scenario in ("dns-timeout", "blackout")):
+				self.faults.add("dns")
+				self.dnsServer.muted = True
+		if (serviceDies):
+			self.env.setService(self.env.vpnServiceName(), False)
+		if (serviceDies or (scenario == "iface-vanish")):
+			self.setTunnel(False)
+		if (self.t.GlobalState.externalIpResolver is not None):
+			# As if the cached result had just expired
+			self.t.GlobalState.externalIpResolver.clearCache()
+
+def counterTotal(counter):
+	"""
+	@return Sum of a counter over all its label sets
+	"""
+	with counter.lock:
+		return sum(counter.values.values())
+
+def runScenario(t, rpc, injector, vpn, transmission, scenario, interval, timeout):
+	"""
+	Inject a failure and run cycles until the VPN is healthy again (or the timeout expires)
+	The failure happens at a random point of the interval between two cycles.
+
+	@return Result dictionary, None if the VPN was not healthy before the failure
+	"""
+	injector.reset(rpc)
+	if ((t.runCycleSafe(vpn, transmission) != t.SUCCESS) or (not injector.healthy())):
+		return None
+	restarts = counterTotal(t.VPN_RESTARTS)
+
+	failTime = time.monotonic()
+	injector.inject(scenario)
+	time.sleep(random.uniform(0, interval))
+	cycles = failed = masked = 0
+	recovered = False
+	while True:
+		result = t.runCycleSafe(vpn, transmission)
+		cycles += 1
+		if ((result == t.SUCCESS) and (t.VPN_HEALTHY.values.get((), 0) == 1)):
+			if (injector.healthy()):
+				recovered = True
+				break
+			masked += 1
+		else:
+			failed += 1
+		if (time.monotonic() - failTime >= timeout):
+			break
+		time.sleep(interval)
+
+	return {"recovered": recovered, "seconds": time.monotonic() - failTime,
+			"detect": (injector.firstStart - failTime) if (injector.firstStart is not None) else None,
+			"cycles": cycles, "failedCycles": failed, "maskedCycles": masked,
+			"restarts": counterTotal(t.VPN_RESTARTS) - restarts, "starts": injector.starts}
+
+def summarise(runs):
+	"""
+	@param runs Result dictionaries of the repetitions of a scenario
+	@return Statistics dictionary (times in seconds, of the recovered runs)
+	"""
+	mean = lambda key: sum(r[key] for r in runs) / len(runs)
+	times = sorted(r["seconds"] for r in runs if r["recovered"])
+	detects = sorted(r["detect"] for r in runs if (r["detect"] is not None))
+	summary = {"n": len(runs), "recovered": len(times), "cycles": mean("cycles"), "restarts": mean("restarts"),
+			   "starts": mean("starts"), "failedCycles": mean("failedCycles"), "maskedCycles": mean("maskedCycles"),
+			   "detectP50": bench.percentile(detects, 0.5) if detects else None}
+	for name, fraction in (("p50", 0.5), ("p90", 0.9)):
+		summary[name] = bench.percentile(times, fraction) if times else None
+	summary["max"] = times[-1] if times else None
+	return summary
+
+def printResults(results):
+	"""
+	Print the statistics per scenario
+	"""
+	fmt = lambda v: ("%8.2f" % (v)) if (v is not None) else "%8s" % ("-")
+	print("%-14s %7s %8s %8s %8s %8s %7s %8s %7s %7s" % ("scenario", "healthy", "p50 s", "p90 s", "max s", "detect s",
+														  "cycles", "restarts", "starts", "masked"))
+	for name, r in results.items():
+		print("%-14s %3d/%-3d %s %s %s %s %7.1f %8.1f %7.1f %7.1f" % (name, r["recovered"], r["n"], fmt(r["p50"]), fmt(r["p90"]),
+																	   fmt(r["max"]), fmt(r["detectP50"]), r["cycles"],
+																	   r["restarts"], r["starts"], r["maskedCycles"]))
+
+def printUsage(appName):
+	"""
+	Print script usage
+	"""
+	print("\nUsage: %s [options]" % appName)
+	print("Available Options:")
+	print("  -h | --help                            This help message")
+	print("  -n | --repetitions   <count>           Runs per scenario (defaults to %d)" % (REPETITIONS))
+	print("  -s | --scenarios     <scenario,...>    Failures: %s (defaults to all)" % (",".join(SCENARIOS)))
+	print("  -m | --mode          <mode>            netns (default as root with iproute2) or sim")
+	print("  -i | --init-system   <init system>     Init system to emulate: systemd (default) or openRC")
+	print("  -t | --interval      <seconds>         Time between cycles (defaults to %g)" % (INTERVAL))
+	print("  -T | --timeout       <seconds>         Time after which a run counts as not recovered (defaults to %g)" % (RUN_TIMEOUT))
+	print("       --stall         <seconds>         Duration of a stalled service start (defaults to %g)" % (STALL))
+	print("       --tunnel-delay  <seconds>         Time from service start to tunnel address (defaults to %g)" % (TUNNEL_DELAY))
+	print("       --persist       <count>           Restarts a failure survives (defaults to 0)")
+	print("       --no-extip                        Disable the external IP check (ping only)")
+	print("  -o | --save          <results file>    Store the results (JSON)")
+	sys.exit()
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hn:s:m:i:t:T:o:", ["help","repetitions=","scenarios=","mode=","init-system=",
+									"interval=","timeout=","stall=","tunnel-delay=","persist=","no-extip","save="])
+	except getopt.GetoptError as goe:
+		print(goe)
+		printUsage(sys.argv[0])
+
+	repetitions = REPETITIONS
+	scenarios = list(SCENARIOS)
+	mode = "netns" if (NetnsTunnel.available()) else "sim"
+	initSystem = "systemd"
+	interval = INTERVAL
+	timeout = RUN_TIMEOUT
+	stall = STALL
+	tunnelDelay = TUNNEL_DELAY
+	persist = 0
+	extIp = True
+	saveFile = None
+	try:
+		for opt, arg in opts:
+			if opt in ("-h", "--help"):
+				printUsage(sys.argv[0])
+			elif opt in ("-n", "--repetitions"):
+				repetitions = int(arg)
+			elif opt in ("-s", "--scenarios"):
+				scenarios = arg.split(",")
+			elif opt in ("-m", "--mode"):
+				mode = arg
+			elif opt in ("-i", "--init-system"):
+				initSystem = arg
+			elif opt in ("-t", "--interval"):
+				interval = float(arg)
+			elif opt in ("-T", "--timeout"):
+				timeout = float(arg)
+			elif opt == "--stall":
+				stall = float(arg)
+			elif opt == "--tunnel-delay":
+				tunnelDelay = float(arg)
+			elif opt == "--persist":
+				persist = int(arg)
+			elif opt == "--no-extip":
+				extIp = False
+			elif opt in ("-o", "--save"):
+				saveFile = arg
+	except ValueError:
+		print("Error: counts and times must be numbers")
+		sys.exit(1)
+	if ((not set(scenarios) <= set(SCENARIOS)) or (mode not in MODES) or (initSystem not in ("systemd", "openRC"))):
+		printUsage(sys.argv[0])
+	if ((mode == "netns") and (not NetnsTunnel.available())):
+		print("Error: netns mode needs root and iproute2")
+		sys.exit(1)
+
+	revision = bench.gitRevision()
+	tunnelClass = NetnsTunnel if (mode == "netns") else SimTunnel
+	# Namespaces first: the threads started below inherit the namespace
+	tunnel = tunnelClass(None)
+	tunnel.setup()
+	rpc = None
+	env = None
+	dnsServer = None
+	results = {}
+	runs = {}
+	try:
+		dnsServer = tunnel.dnsServer()
+		dnsServer.start()
+		rpc = bench.FakeRpcServer()
+		env = bench.BenchEnv.create(initSystem, rpc.port())
+		tunnel.env = env
+		t = bench.loadOrchestrator(env)
+		if (mode == "netns"):
+			os.environ["BENCH_NETIFACES"] = "kernel"
+		if (not tunnel.linkEvents):
+			import Network.netlink as netlink
+
+			class NoLinkEvents:
+				def __init__(self, verbose = False):
+					raise netlink.NetlinkError("the simulated tunnel has no link events")
+			netlink.LinkWatcher = NoLinkEvents
+		vpn, transmission = bench.setupOrchestrator(t, env)
+		if (extIp):
+			t.GlobalState.ispIpFirstOctet = ISP_FIRST_OCTET
+		t.GlobalState.vpnExternalIpResolver = tunnel.resolverAddr
+		if (os.geteuid() != 0):
+			t.GlobalState.vpnMark = "0" # Marking needs CAP_NET_ADMIN
+		t.getExternalIpResolver().port = dnsServer.port()
+
+		injector = FaultInjector(t, env, tunnel, dnsServer, tunnelDelay, stall, persist)
+		injector.attach(vpn)
+		print("Mode %s, interval %g s, %d run(s) per scenario, external IP check %s" % (mode, interval, repetitions, "on" if extIp else "off"))
+		for scenario in scenarios:
+			runs[scenario] = []
+			for i in range(repetitions):
+				run = runScenario(t, rpc, injector, vpn, transmission, scenario, interval, timeout)
+				if (run is None):
+					print("%s: the VPN was not healthy before the failure, see %s" % (scenario, env.logFile))
+					continue
+				runs[scenario].append(run)
+			if (runs[scenario]):
+				results[scenario] = summarise(runs[scenario])
+	finally:
+		if (env is not None):
+			injector = None
+			env.setService(env.vpnServiceName(), False)
+		if (dnsServer is not None):
+			dnsServer.stop()
+		if (rpc is not None):
+			rpc.stop()
+		tunnel.down()
+		tunnel.cleanup()
+		if (env is not None):
+			env.cleanup()
+
+	printResults(results)
+	if (saveFile is not None):
+		content = {"meta": {"time": datetime.datetime.now().isoformat(timespec = "seconds"), "revision": revision,
+							"python": platform.python_version(), "host": socket.gethostname(), "mode": mode,
+							"initSystem": initSystem, "interval": interval, "timeout": timeout, "stall": stall,
+							"tunnelDelay": tunnelDelay, "persist": persist, "externalIp": extIp},
+				   "results": results, "runs": runs}
+		with open(saveFile, 'w') as f:
+			json.dump(content, f, indent = 1, sort_keys = True)
+		print("Results saved to %s" % (saveFile))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,193 @@
+'''
+Asynchronous, size bounded logging
+Records (including the console output, see ConsoleWriter) are put on a queue
+by the checks and written by a listener thread, so the checks never wait for
+log I/O. The log file lives in tmpfs and is rotated at a fixed size; rotated
+logs are either dropped or compressed into a spill directory on disk.
+'''
+import os
+import sys
+import gzip
+import json
+import queue
+import shutil
+import atexit
+import datetime
+import logging
+import logging.handlers
+
+CONSOLE_LOGGER = "console"
+
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+MAX_BYTES = 1024 * 1024
+BACKUP_COUNT = 1
+SPILL_COUNT = 10
+
+# Extra record attributes that are copied into JSON records
+JSON_EXTRA_FIELDS = ("cycle", "event", "result", "durationMs")
+
+class CycleFilter(logging.Filter):
+	"""
+	Tags every record with the number of the current check cycle
+	"""
+	cycle = 0
+
+	def filter(self, record):
+		if (not hasattr(record, "cycle")):
+			record.cycle = CycleFilter.cycle
+		return True
+
+class ConsoleFilter(logging.Filter):
+	"""
+	Selects the console records (console=True) or all other records (console=False)
+	"""
+	def __init__(self, console):
+		logging.Filter.__init__(self)
+		self.console = console
+
+	def filter(self, record):
+		return ((record.name == CONSOLE_LOGGER) == self.console)
+
+class JsonFormatter(logging.Formatter):
+	"""
+	Formats records as single line JSON objects
+	"""
+	def format(self, record):
+		entry = {
+			"time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec = "milliseconds"),
+			"level": record.levelname,
+			"logger": record.name,
+			"msg": record.getMessage()}
+		for field in JSON_EXTRA_FIELDS:
+			if (hasattr(record, field)):
+				entry[field] = getattr(record, field)
+		if (record.exc_info):
+			entry["exc"] = self.formatException(record.exc_info)
+		return json.dumps(entry)
+
+class ConsoleWriter:
+	"""
+	File-like object that replaces sys.stdout: every printed line becomes a
+	record of the console logger, so console output shares the log queue
+	"""
+	def __init__(self, logger):
+		"""
+		Constructor
+		@param logger Logger the printed lines are sent to
+		"""
+		self.logger = logger
+		self.buffer = ""
+
+	def write(self, text):
+		self.buffer += text
+		while ("\n" in self.buffer):
+			line, self.buffer = self.buffer.split("\n", 1)
+			self.logger.info(line)
+		return len(text)
+
+	def flush(self):
+		if (self.buffer):
+			self.logger.info(self.buffer)
+			self.buffer = ""
+
+	def isatty(self):
+		return False
+
+class SpillRotator:
+	"""
+	Rotator for RotatingFileHandler that compresses the rotated log into a
+	directory on disk (keeping the newest spillCount files) instead of keeping
+	it in tmpfs
+	"""
+	def __init__(self, spillDir, spillCount = SPILL_COUNT):
+		"""
+		Constructor
+		@param spillDir Directory the compressed logs are written to
+		@param spillCount Number of compressed logs to keep
+		"""
+		self.spillDir = spillDir
+		self.spillCount = spillCount
+
+	def __call__(self, source, dest):
+		name = "%s.%s.gz" % (os.path.basename(source), datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f"))
+		try:
+			os.makedirs(self.spillDir, exist_ok = True)
+			with open(source, 'rb') as src, gzip.open(os.path.join(self.spillDir, name), 'wb') as dst:
+				shutil.copyfileobj(src, dst)
+			prefix = os.path.basename(source) + "."
+			spilled = sorted(f for f in os.listdir(self.spillDir) if (f.startswith(prefix) and f.endswith(".gz")))
+			for f in spilled[:-self.spillCount]:
+				os.unlink(os.path.join(self.spillDir, f))
+		except OSError as oe:
+			sys.__stderr__.write("Log: unable to spill %s to %s: %s\n" % (source, self.spillDir, oe))
+		os.unlink(source)
+
+listener = None
+
+def startCycle():
+	"""
+	Start tagging records with the next cycle number
+
+	@return The new cycle number
+	"""
+	CycleFilter.cycle += 1
+	return CycleFilter.cycle
+
+def setup(logFile, logFormat = FORMAT_TEXT, maxBytes = MAX_BYTES, backupCount = BACKUP_COUNT,
+		  spillDir = None, spillCount = SPILL_COUNT, console = True):
+	"""
+	Route all logging (and, optionally, the console output) through a queue
+	@param logFile Log file (typically in tmpfs)
+	@param logFormat FORMAT_TEXT or FORMAT_JSON
+	@param maxBytes Size (in bytes) at which the log file is rotated (0 disables rotation)
+	@param backupCount Number of rotated logs kept next to the log file (without spillDir)
+	@param spillDir Directory rotated logs are compressed into (None to keep them in place)
+	@param spillCount Number of compressed logs kept in spillDir
+	@param console Also send sys.stdout through the queue
+	"""
+	global listener
+	fileHandler = logging.handlers.RotatingFileHandler(logFile, maxBytes = maxBytes, backupCount = max(backupCount, 1))
+	if (spillDir):
+		fileHandler.rotator = SpillRotator(spillDir, spillCount)
+	if (logFormat == FORMAT_JSON):
+		fileHandler.setFormatter(JsonFormatter())
+	else:
+		fileHandler.setFormatter(logging.Formatter(TEXT_FORMAT))
+	fileHandler.addFilter(ConsoleFilter(False))
+
+	consoleHandler = logging.StreamHandler(sys.__stdout__)
+	consoleHandler.setFormatter(logging.Formatter("%(message)s"))
+	consoleHandler.addFilter(ConsoleFilter(True))
+
+	logQueue = queue.Queue(-1)
+	queueHandler = logging.handlers.QueueHandler(logQueue)
+	queueHandler.addFilter(CycleFilter())
+	root = logging.getLogger()
+	for h in list(root.handlers):
+		root.removeHandler(h)
+	root.addHandler(queueHandler)
+	root.setLevel(logging.INFO)
+
+	listener = logging.handlers.QueueListener(logQueue, fileHandler, consoleHandler, respect_handler_level = True)
+	listener.start()
+	atexit.register(stop)
+
+	if (console):
+		sys.stdout = ConsoleWriter(logging.getLogger(CONSOLE_LOGGER))
+
+def stop():
+	"""
+	Write out the queued records and stop the listener thread
+	"""
+	global listener
+	if (isinstance(sys.stdout, ConsoleWriter)):
+		sys.stdout.flush()
+		sys.stdout = sys.__stdout__
+	if (listener is not None):
+		listener.stop()
+		for h in listener.handlers:
+			h.close()
+		listener = None
@@ -0,0 +1,313 @@
+'''
+Metrics (counters, gauges and fixed-bucket histograms)
+The modules define their metrics at import time in the shared REGISTRY and
+update them in place. After each check the registry is exported, atomically,
+as a Prometheus textfile (for node_exporter's textfile collector) and as a JSON
+snapshot. The snapshot is read back on start-up, so counters keep counting
+across one-shot (cron) runs.
+'''
+import os
+import json
+import time
+import math
+import logging
+import threading
+
+JSON_FILE = "/dev/shm/torrent_vpn.metrics.json"
+SNAPSHOT_VERSION = 1
+
+# Default histogram buckets
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+MS_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+class MetricsError(RuntimeError):
+	"""
+	Metrics related exception
+	"""
+	def __init__(self, arg):
+		self.args = arg
+
+def labelKey(labels):
+	"""
+	@return Hashable, ordered form of a label dictionary
+	"""
+	return tuple(sorted(labels.items()))
+
+def formatValue(value):
+	"""
+	@return Value in the Prometheus exposition format
+	"""
+	if (math.isinf(value)):
+		return "+Inf" if (value > 0) else "-Inf"
+	if (float(value).is_integer()):
+		return "%d" % (value)
+	return repr(float(value))
+
+def formatLabels(key, extra = None):
+	"""
+	@param key Label key (see labelKey)
+	@param extra Additional (name, value) tuple, eg the "le" of a bucket
+	@return Label set in the Prometheus exposition format ('' without labels)
+	"""
+	items = list(key) + ([extra] if extra else [])
+	if (not items):
+		return ""
+	escaped = ((n, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for n, v in items)
+	return "{%s}" % (",".join('%s="%s"' % (n, v) for n, v in escaped))
+
+class Metric:
+	"""
+	Base class: a named metric with one value per label set
+	"""
+	kind = None
+
+	def __init__(self, name, helpText, lock):
+		"""
+		Constructor
+		@param name Metric name
+		@param helpText Description
+		@param lock Registry lock
+		"""
+		self.name = name
+		self.helpText = helpText
+		self.lock = lock
+		self.values = {}
+
+	def samples(self):
+		"""
+		@return List of (name suffix, label key, extra label, value) tuples
+		"""
+		with self.lock:
+			return [("", key, None, value) for key, value in sorted(self.values.items())]
+
+	def snapshot(self):
+		"""
+		@return JSON serialisable list of the values
+		"""
+		with self.lock:
+			return [{"labels": dict(key), "value": value} for key, value in sorted(self.values.items())]
+
+	def restore(self, entries):
+		"""
+		Take over the values of a snapshot
+		@param entries List as returned by snapshot()
+		"""
+		with self.lock:
+			for entry in entries:
+				self.values[labelKey(entry["labels"])] = entry["value"]
+
+class Counter(Metric):
+	"""
+	Monotonically increasing count
+	"""
+	kind = COUNTER
+
+	def inc(self, amount = 1, **labels):
+		"""
+		Increase the count
+		@param amount Increment (not negative)
+		@param labels Label values
+		"""
+		key = labelKey(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+	"""
+	Value that goes up and down
+	"""
+	kind = GAUGE
+
+	def set(self, value, **labels):
+		"""
+		Set the value
+		@param value New value
+		@param labels Label values
+		"""
+		with self.lock:
+			self.values[labelKey(labels)] = value
+
+class Histogram(Metric):
+	"""
+	Distribution of observations over fixed buckets
+	"""
+	kind = HISTOGRAM
+
+	def __init__(self, name, helpText, lock, buckets = SECONDS_BUCKETS):
+		"""
+		Constructor
+		@param buckets Sorted upper bounds of the buckets (+Inf is implied)
+		"""
+		Metric.__init__(self, name, helpText, lock)
+		self.buckets = tuple(buckets)
+
+	def observe(self, value, **labels):
+		"""
+		Record an observation
+		@param value Observed value
+		@param labels Label values
+		"""
+		key = labelKey(labels)
+		with self.lock:
+			entry = self.values.get(key)
+			if (entry is None):
+				entry = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+			for i, bound in enumerate(self.buckets):
+				if (value <= bound):
+					entry["counts"][i] += 1
+					break
+			entry["sum"] += value
+			entry["count"] += 1
+
+	def samples(self):
+		samples = []
+		with self.lock:
+			for key, entry in sorted(self.values.items()):
+				cumulative = 0
+				for bound, count in zip(self.buckets, entry["counts"]):
+					cumulative += count
+					samples.append(("_bucket", key, ("le", formatValue(bound)), cumulative))
+				samples.append(("_bucket", key, ("le", "+Inf"), entry["count"]))
+				samples.append(("_sum", key, None, entry["sum"]))
+				samples.append(("_count", key, None, entry["count"]))
+		return samples
+
+	def snapshot(self):
+		with self.lock:
+			return [{"labels": dict(key), "counts": list(entry["counts"]), "sum": entry["sum"], "count": entry["count"]}
+					for key, entry in sorted(self.values.items())]
+
+	def restore(self, entries):
+		with self.lock:
+			for entry in entries:
+				# Observations cannot be rebucketed, a changed layout starts afresh
+				if (len(entry["counts"]) == len(self.buckets)):
+					self.values[labelKey(entry["labels"])] = {"counts": list(entry["counts"]), "sum": entry["sum"], "count": entry["count"]}
+
+class Registry:
+	"""
+	Set of metrics that are exported together
+	"""
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.metrics = {}
+
+	def register(self, metric):
+		"""
+		Add a metric, or return the metric of the same name that was added before
+		@param metric Metric object
+
+		@return Registered metric object
+		@throws MetricsError if the name is taken by a metric of another type
+		"""
+		with self.lock:
+			existing = self.metrics.get(metric.name)
+			if (existing is None):
+				self.metrics[metric.name] = metric
+				return metric
+			if (existing.kind != metric.kind):
+				raise MetricsError("Metric %s already registered as a %s" % (metric.name, existing.kind))
+			return existing
+
+	def toPrometheus(self):
+		"""
+		@return All metrics in the Prometheus text exposition format
+		"""
+		lines = []
+		for name in sorted(self.metrics):
+			metric = self.metrics[name]
+			samples = metric.samples()
+			if (not samples):
+				continue
+			lines.append("# HELP %s %s" % (name, metric.helpText))
+			lines.append("# TYPE %s %s" % (name, metric.kind))
+			for suffix, key, extra, value in samples:
+				lines.append("%s%s%s %s" % (name, suffix, formatLabels(key, extra), formatValue(value)))
+		return "\n".join(lines) + "\n"
+
+	def toJson(self):
+		"""
+		@return Snapshot dictionary of all metrics
+		"""
+		content = {"version": SNAPSHOT_VERSION, "timestamp": time.time(), "metrics": {}}
+		for name in sorted(self.metrics):
+			metric = self.metrics[name]
+			entry = {"type": metric.kind, "help": metric.helpText, "values": metric.snapshot()}
+			if (metric.kind == HISTOGRAM):
+				entry["buckets"] = list(metric.buckets)
+			content["metrics"][name] = entry
+		return content
+
+	def load(self, jsonFile):
+		"""
+		Take over the values of an earlier snapshot (of registered metrics of the same type)
+		@param jsonFile Snapshot file
+
+		@return True if a snapshot was loaded
+		"""
+		try:
+			with open(jsonFile, 'r') as f:
+				content = json.load(f)
+			if (content.get("version") != SNAPSHOT_VERSION):
+				return False
+			for name, entry in content["metrics"].items():
+				metric = self.metrics.get(name)
+				if ((metric is not None) and (metric.kind == entry.get("type"))):
+					metric.restore(entry["values"])
+		except FileNotFoundError:
+			return False
+		except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+			logging.info("Metrics: ignoring snapshot %s: %s" % (jsonFile, e))
+			return False
+		return True
+
+	def export(self, textFile = None, jsonFile = JSON_FILE):
+		"""
+		Write the metrics (each file atomically, so collectors never see a partial file)
+		@param textFile Prometheus textfile (should end in .prom), None to skip
+		@param jsonFile JSON snapshot file, None to skip
+		"""
+		with self.lock:
+			outputs = []
+			if (textFile):
+				outputs.append((textFile, self.toPrometheus()))
+			if (jsonFile):
+				outputs.append((jsonFile, json.dumps(self.toJson(), sort_keys = True)))
+		for path, content in outputs:
+			# The temporary file is not picked up by the collector (no .prom suffix)
+			tmpFile = "%s.%d.tmp" % (path, os.getpid())
+			try:
+				with open(tmpFile, 'w') as f:
+					f.write(content)
+				os.chmod(tmpFile, 0o644)
+				os.replace(tmpFile, path)
+			except OSError as oe:
+				logging.info("Metrics: unable to write %s: %s" % (path, oe))
+				try:
+					os.unlink(tmpFile)
+				except OSError:
+					pass
+
+REGISTRY = Registry()
+
+def counter(name, helpText):
+	"""
+	@return Counter of the shared registry
+	"""
+	return REGISTRY.register(Counter(name, helpText, REGISTRY.lock))
+
+def gauge(name, helpText):
+	"""
+	@return Gauge of the shared registry
+	"""
+	return REGISTRY.register(Gauge(name, helpText, REGISTRY.lock))
+
+def histogram(name, helpText, buckets = SECONDS_BUCKETS):
+	"""
+	@return Histogram of the shared registry
+	"""
+	return REGISTRY.register(Histogram(name, helpText, REGISTRY.lock, buckets))
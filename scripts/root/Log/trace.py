@@ -0,0 +1,323 @@
+'''
+Per-phase profiling (--profile)
+Phases of the check cycle and the subprocesses are recorded as timed spans and
+written as a Chrome trace-event file (chrome://tracing, Perfetto). Commands
+started through subprocess.run (which subprocess.check_output uses as well) are
+recorded automatically; commands started otherwise (Popen, asyncio) are wrapped
+in commandSpan() where they are started. The cycles
+can additionally be run under cProfile, and the import cost of netifaces and
+the local modules is measured in a child interpreter with -X importtime.
+When profiling is not enabled the spans cost a single global lookup.
+'''
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import threading
+import functools
+import subprocess
+
+MAX_EVENTS = 200000 # Events kept in memory (a long running daemon stops recording after that)
+IMPORT_TIMEOUT = 30 # s
+IMPORT_TID = 1 # Track of the import spans (thread idents are never this low)
+
+# Root packages whose import cost is measured (besides the local modules)
+IMPORT_EXTRA = ("netifaces",)
+
+tracer = None
+
+class Tracer:
+	"""
+	Collects complete ("X") trace events
+	"""
+	def __init__(self, traceFile, statsFile = None, maxEvents = MAX_EVENTS):
+		"""
+		Constructor
+		@param traceFile Chrome trace-event JSON output file
+		@param statsFile cProfile (pstats) output file, None to disable cProfile
+		@param maxEvents Maximum number of events to record
+		"""
+		self.traceFile = traceFile
+		self.statsFile = statsFile
+		self.maxEvents = maxEvents
+		self.events = []
+		self.dropped = 0
+		self.pid = os.getpid()
+		self.origin = time.perf_counter()
+		self.threads = {}
+		self.profiler = cProfile.Profile() if (statsFile) else None
+		self.profileLock = threading.Lock()
+
+	def now(self):
+		"""
+		@return Microseconds since the tracer was created
+		"""
+		return (time.perf_counter() - self.origin) * 1e6
+
+	def record(self, name, category, start, end, args = None):
+		"""
+		Record a complete event
+		@param name Event name
+		@param category Event category (phase, subprocess, import, ...)
+		@param start Start time (us, see now())
+		@param end End time (us)
+		@param args Dictionary shown with the event, None for none
+		"""
+		if (len(self.events) >= self.maxEvents):
+			self.dropped += 1
+			return
+		thread = threading.current_thread()
+		self.threads[thread.ident] = thread.name
+		event = {"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": thread.ident,
+				 "ts": round(start, 1), "dur": round(end - start, 1)}
+		if (args):
+			event["args"] = args
+		self.events.append(event)
+
+	def summary(self):
+		"""
+		@return List of (name, count, total us, max us) tuples of the phase spans, slowest first
+		"""
+		totals = {}
+		for event in self.events:
+			if (event["cat"] != "phase"):
+				continue
+			count, total, longest = totals.get(event["name"], (0, 0.0, 0.0))
+			totals[event["name"]] = (count + 1, total + event["dur"], max(longest, event["dur"]))
+		return sorted(((n,) + totals[n] for n in totals), key = lambda t: t[2], reverse = True)
+
+	def write(self):
+		"""
+		Write the trace (atomically)
+		"""
+		events = [{"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": "torrent_vpn"}}]
+		for ident, name in self.threads.items():
+			events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": ident, "args": {"name": name}})
+		tmpFile = self.traceFile + ".tmp"
+		with open(tmpFile, 'w') as f:
+			json.dump({"traceEvents": events + self.events, "displayTimeUnit": "ms",
+					   "otherData": {"droppedEvents": self.dropped}}, f)
+		os.replace(tmpFile, self.traceFile)
+
+class Span:
+	"""
+	Context manager recording the time spent in its block
+	"""
+	__slots__ = ("name", "category", "args", "start")
+
+	def __init__(self, name, category, args):
+		self.name = name
+		self.category = category
+		self.args = args
+
+	def __enter__(self):
+		self.start = tracer.now()
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		if (excType is not None):
+			self.args = dict(self.args or {}, error = excType.__name__)
+		tracer.record(self.name, self.category, self.start, tracer.now(), self.args)
+		return False
+
+class NullSpan:
+	"""
+	Span used when profiling is disabled
+	"""
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		return False
+
+NULL_SPAN = NullSpan()
+
+def span(name, category = "phase", **args):
+	"""
+	Time a block: with trace.span("vpn.start"): ...
+	@param name Span name
+	@param category Span category
+	@param args Values shown with the span
+
+	@return Context manager
+	"""
+	if (tracer is None):
+		return NULL_SPAN
+	return Span(name, category, args)
+
+def traced(func):
+	"""
+	Decorator recording every call of a function as a phase span
+	"""
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		if (tracer is None):
+			return func(*args, **kwargs)
+		with Span(func.__name__, "phase", None):
+			return func(*args, **kwargs)
+	return wrapper
+
+def commandSpan(cmd):
+	"""
+	Time a command until it completed: with trace.commandSpan(cmd): ...
+	@param cmd Command (list, or string for a shell command)
+
+	@return Context manager recording a subprocess span named after the executable
+	"""
+	if (tracer is None):
+		return NULL_SPAN
+	if (isinstance(cmd, (list, tuple))):
+		name = os.path.basename(str(cmd[0])) if cmd else "?"
+		cmdLine = " ".join(str(c) for c in cmd)
+	else:
+		name = os.path.basename(str(cmd).split(" ", 1)[0])
+		cmdLine = str(cmd)
+	return Span(name, "subprocess", {"cmd": cmdLine})
+
+def _tracedRun(run):
+	"""
+	Wrap subprocess.run in a subprocess span named after the executable
+	"""
+	@functools.wraps(run)
+	def wrapper(*popenargs, **kwargs):
+		if (tracer is None):
+			return run(*popenargs, **kwargs)
+		with commandSpan(popenargs[0] if popenargs else kwargs.get("args")):
+			return run(*popenargs, **kwargs)
+	wrapper.traceOriginal = run
+	return wrapper
+
+def start(traceFile, statsFile = None):
+	"""
+	Start recording
+	@param traceFile Chrome trace-event JSON output file
+	@param statsFile cProfile (pstats) output file, None to disable cProfile
+	"""
+	global tracer
+	tracer = Tracer(traceFile, statsFile)
+	if (not hasattr(subprocess.run, "traceOriginal")):
+		subprocess.run = _tracedRun(subprocess.run)
+
+def profileCall(func, *args):
+	"""
+	Call a function, under cProfile if a stats file was requested
+	Cycles never overlap, but may run in different (executor) threads, so the
+	profiler is enabled in the calling thread for the duration of the call.
+	@param func Function to call
+	@param args Function arguments
+
+	@return Return value of func
+	"""
+	if ((tracer is None) or (tracer.profiler is None)):
+		return func(*args)
+	with tracer.profileLock:
+		tracer.profiler.enable()
+		try:
+			return func(*args)
+		finally:
+			tracer.profiler.disable()
+
+def localModules(basePath):
+	"""
+	@param basePath Directory holding the local packages
+	@return Sorted names of the loaded modules that live under basePath
+	"""
+	basePath = os.path.join(os.path.realpath(basePath), "")
+	names = []
+	for name, module in list(sys.modules.items()):
+		path = getattr(module, "__file__", None)
+		if (path and (name != "__main__") and os.path.realpath(path).startswith(basePath)):
+			names.append(name)
+	return sorted(names)
+
+def parseImportTime(output, roots):
+	"""
+	Turn -X importtime output into spans laid out back to back
+	@param output stderr text of the child interpreter
+	@param roots Top level module names to keep (with everything they imported)
+
+	@return List of (name, start us, duration us, self us, depth) tuples
+	"""
+	spans = []
+	pending = {} # depth -> spans of already imported children at that depth
+	cursor = 0
+	for line in output.splitlines():
+		if (not line.startswith("import time:")):
+			continue
+		fields = line[len("import time:"):].split("|")
+		if (len(fields) != 3):
+			continue
+		try:
+			selfUs = int(fields[0])
+			cumulativeUs = int(fields[1])
+		except ValueError:
+			continue # Header line
+		module = fields[2].rstrip()
+		stripped = module.lstrip()
+		depth = (len(module) - len(stripped) - 1) // 2
+		# Children are reported before their parent, parents start where their first child did
+		children = pending.pop(depth + 1, [])
+		start = children[0][1] if children else cursor
+		entry = (stripped, start, cumulativeUs, selfUs, depth)
+		if (depth == 0):
+			if (stripped in roots):
+				spans.extend(children)
+				spans.append(entry)
+				cursor = start + cumulativeUs
+		else:
+			pending.setdefault(depth, []).extend(children)
+			pending[depth].append(entry)
+			cursor = start + cumulativeUs
+	return spans
+
+def measureImports(basePath, modules = None):
+	"""
+	Measure the import cost of netifaces and the local modules in a fresh
+	interpreter (python -X importtime) and add it to the trace on its own track
+	@param basePath Directory holding the local packages
+	@param modules Module names to import, defaults to netifaces and the loaded local modules
+	"""
+	if (tracer is None):
+		return
+	if (modules is None):
+		modules = list(IMPORT_EXTRA) + localModules(basePath)
+	# Plain import statements: importlib.import_module() is not timed by -X importtime
+	script = "".join("try:\n\timport %s\nexcept Exception:\n\tpass\n" % (m) for m in modules)
+	env = dict(os.environ, PYTHONPATH = os.pathsep.join(p for p in (basePath, os.environ.get("PYTHONPATH")) if p))
+	try:
+		result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd = basePath, env = env,
+								stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, timeout = IMPORT_TIMEOUT)
+	except (OSError, subprocess.TimeoutExpired) as e:
+		logging.info("Profile: unable to measure import time: %s" % (e))
+		return
+
+	spans = parseImportTime(result.stderr.decode("utf-8", "replace"), set(modules))
+	tracer.threads[IMPORT_TID] = "imports (-X importtime, separate interpreter)"
+	for name, start, duration, selfUs, depth in spans:
+		tracer.events.append({"name": name, "cat": "import", "ph": "X", "pid": tracer.pid, "tid": IMPORT_TID,
+							  "ts": start, "dur": duration, "args": {"selfUs": selfUs, "cumulativeUs": duration}})
+	for name, start, duration, selfUs, depth in spans:
+		if (depth == 0):
+			logging.info("Profile: import %s: %.1f ms" % (name, duration / 1000))
+
+def stop():
+	"""
+	Stop recording and write the trace (and cProfile stats)
+	"""
+	global tracer
+	if (tracer is None):
+		return
+	current = tracer
+	for name, count, total, longest in current.summary():
+		logging.info("Profile: %s: %d calls, %.1f ms total, %.1f ms max" % (name, count, total / 1000, longest / 1000))
+	try:
+		current.write()
+		logging.info("Profile: trace written to %s" % (current.traceFile))
+		if (current.profiler is not None):
+			current.profiler.dump_stats(current.statsFile)
+			logging.info("Profile: cProfile stats written to %s" % (current.statsFile))
+	except OSError as oe:
+		logging.info("Profile: unable to write profile output: %s" % (oe))
+	tracer = None
@@ -0,0 +1,219 @@
+'''
+Minimal DNS (A record) client
+Intended for single lookups like the OpenDNS "myip" query. The socket can be
+marked (SO_MARK) so that the query follows the same policy routing as the
+VPN user's traffic.
+'''
+import socket
+import struct
+import random
+import time
+import logging
+
+TYPE_A = 1
+CLASS_IN = 1
+
+FLAG_RD = 0x0100
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+RCODE_MASK = 0x000f
+
+DNS_HDR = struct.Struct("!HHHHHH")
+RR_HDR = struct.Struct("!HHIH")
+
+# Not exported by all Python versions
+SO_MARK = getattr(socket, "SO_MARK", 36)
+
+OPENDNS_RESOLVER = "208.67.222.222" # resolver1.opendns.com
+OPENDNS_MYIP = "myip.opendns.com"
+
+class DnsError(RuntimeError):
+	"""
+	DNS related exception
+	"""
+	def __init__(self, arg):
+		self.args = arg
+
+def encodeName(name):
+	"""
+	Encode a domain name in DNS label format
+	@param name Domain name (eg myip.opendns.com)
+
+	@return Encoded name bytes
+	"""
+	out = b""
+	for label in name.rstrip(".").split("."):
+		raw = label.encode("ascii")
+		if ((len(raw) == 0) or (len(raw) > 63)):
+			raise DnsError("Invalid domain name: %s" % (name))
+		out += struct.pack("!B", len(raw)) + raw
+	return out + b"\0"
+
+def skipName(msg, offset):
+	"""
+	Skip over a (possibly compressed) name in a DNS message
+	@param msg Message bytes
+	@param offset Offset of the name
+
+	@return Offset of the first byte after the name
+	"""
+	while True:
+		if (offset >= len(msg)):
+			raise DnsError("Truncated name in DNS response")
+		length = msg[offset]
+		if ((length & 0xc0) == 0xc0):
+			return offset + 2 # Compression pointer ends the name
+		if (length == 0):
+			return offset + 1
+		offset += 1 + length
+
+def buildQuery(qid, name, qtype = TYPE_A):
+	"""
+	Build a DNS query message
+	@param qid Query identifier
+	@param name Domain name to query
+	@param qtype Record type
+
+	@return Query message bytes
+	"""
+	return DNS_HDR.pack(qid, FLAG_RD, 1, 0, 0, 0) + encodeName(name) + struct.pack("!HH", qtype, CLASS_IN)
+
+def parseResponse(msg, qid):
+	"""
+	Extract the A records from a DNS response
+	@param msg Response message bytes
+	@param qid Expected query identifier
+
+	@return List of (address, ttl) tuples
+	@throws DnsError on a malformed or unsuccessful response
+	"""
+	if (len(msg) < DNS_HDR.size):
+		raise DnsError("Short DNS response")
+	rid, flags, qdCount, anCount, nsCount, arCount = DNS_HDR.unpack_from(msg)
+	if ((rid != qid) or (not (flags & FLAG_QR))):
+		raise DnsError("Unexpected DNS response")
+	if (flags & FLAG_TC):
+		raise DnsError("Truncated DNS response")
+	if (flags & RCODE_MASK):
+		raise DnsError("DNS error response (rcode %d)" % (flags & RCODE_MASK))
+
+	offset = DNS_HDR.size
+	for i in range(0, qdCount):
+		offset = skipName(msg, offset) + 4
+
+	records = []
+	for i in range(0, anCount):
+		offset = skipName(msg, offset)
+		if (offset + RR_HDR.size > len(msg)):
+			raise DnsError("Truncated DNS answer")
+		rrType, rrClass, ttl, rdLen = RR_HDR.unpack_from(msg, offset)
+		offset += RR_HDR.size
+		rdata = msg[offset:offset + rdLen]
+		offset += rdLen
+		if ((rrType == TYPE_A) and (rrClass == CLASS_IN) and (rdLen == 4)):
+			records.append((socket.inet_ntoa(rdata), ttl))
+	return records
+
+class DnsResolver:
+	"""
+	Sends A queries to a single DNS server over UDP, with a timeout, retries and
+	a short result cache
+	"""
+	def __init__(self, server, port = 53, timeout = 1.0, retries = 1, mark = 0, cacheTtl = 30, verbose = False):
+		"""
+		Constructor
+		@param server IPv4 address of the DNS server
+		@param port DNS server port
+		@param timeout Time (in seconds) to wait for each answer
+		@param retries Number of times a query is resent after a timeout
+		@param mark Firewall mark to set on the socket (0 to disable; requires CAP_NET_ADMIN)
+		@param cacheTtl Time (in seconds) a result is reused (0 to disable caching)
+		@param verbose Indicate whether or not verbose mode should be used
+		"""
+		self.server = server
+		self.port = port
+		self.timeout = timeout
+		self.retries = retries
+		self.mark = mark
+		self.cacheTtl = cacheTtl
+		self.verbose = verbose
+		self.cache = {}
+
+	def openSocket(self):
+		"""
+		Create the (marked) query socket
+
+		@return UDP socket
+		@throws DnsError if the socket cannot be created or marked
+		"""
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			if (self.mark):
+				sock.setsockopt(socket.SOL_SOCKET, SO_MARK, self.mark)
+			sock.settimeout(self.timeout)
+			sock.connect((self.server, self.port))
+		except OSError as oe:
+			sock.close()
+			raise DnsError("Unable to set up DNS socket: %s" % (oe))
+		return sock
+
+	def clearCache(self):
+		"""
+		Forget all cached results (eg after the route to the server changed)
+		"""
+		self.cache = {}
+
+	def queryA(self, name):
+		"""
+		Resolve the A records of a name
+		@param name Domain name to resolve
+
+		@return List of IPv4 addresses (as strings)
+		@throws DnsError if no answer could be obtained
+		"""
+		now = time.monotonic()
+		cached = self.cache.get(name)
+		if ((cached is not None) and (cached[0] > now)):
+			if (self.verbose):
+				print("DNS: %s (cached) -> %s" % (name, cached[1]))
+			return cached[1]
+
+		qid = random.randint(0, 0xffff)
+		query = buildQuery(qid, name)
+		sock = self.openSocket()
+		try:
+			for attempt in range(0, self.retries + 1):
+				try:
+					sock.send(query)
+					while True:
+						# Ignore stray datagrams that do not match the query
+						msg = sock.recv(4096)
+						try:
+							records = parseResponse(msg, qid)
+							break
+						except DnsError:
+							if ((len(msg) >= 2) and (struct.unpack_from("!H", msg)[0] == qid)):
+								raise
+				except socket.timeout:
+					logging.info("DNS: %s query to %s timed out [%d/%d]" % (name, self.server, attempt + 1, self.retries + 1))
+					continue
+				except ConnectionRefusedError:
+					raise DnsError("DNS server %s:%d refused the query" % (self.server, self.port))
+				except OSError as oe:
+					# eg ENETUNREACH/EHOSTUNREACH while the tunnel goes down
+					raise DnsError("DNS query to %s:%d failed: %s" % (self.server, self.port, oe))
+
+				addrs = [r[0] for r in records]
+				if (len(addrs) == 0):
+					raise DnsError("No A records for %s" % (name))
+				# The record TTL is deliberately not used: myip.opendns.com answers
+				# with a TTL of 0, the cache lifetime is a local policy instead
+				if (self.cacheTtl > 0):
+					self.cache[name] = (time.monotonic() + self.cacheTtl, addrs)
+				logging.info("DNS: %s -> %s" % (name, addrs))
+				if (self.verbose):
+					print("DNS: %s -> %s" % (name, addrs))
+				return addrs
+		finally:
+			sock.close()
+		raise DnsError("No answer from %s for %s" % (self.server, name))
@@ -0,0 +1,404 @@
+'''
+nftables firewall backend
+Renders the VPN user policy (see vpn_route.sh for the iptables equivalent) as a
+single nftables table, which is replaced atomically with "nft -f" and only
+when its content changed, or when the loaded table no longer carries the
+ruleset's id (eg after "nft flush ruleset" or a firewall service restart).
+Blocklist ranges are kept in an interval set in a table of their own, updated
+with add/delete deltas so that list refreshes never reload the whole set.
+'''
+import os
+import json
+import array
+import hashlib
+import subprocess
+import logging
+
+PORT_DNS = 53
+PORT_TRANSMISSION_WEB = 9091
+PORT_SSH = 22
+
+VPN_DNS_SERVER_1 = "45.76.95.185"
+VPN_DNS_SERVER_2 = "45.76.76.54"
+
+TABLE_NAME = "torrent_vpn"
+HASH_FILE = "/dev/shm/torrent_vpn.nft.sha256"
+# Rule comment placeholder, replaced by the ruleset id (hash) when the ruleset is loaded
+RULESET_ID = "@RULESET_ID@"
+
+BLOCKLIST_TABLE_NAME = "torrent_vpn_blocklist"
+BLOCKLIST_SET_NAME = "blocklist"
+BLOCKLIST_STATE_FILE = "/dev/shm/torrent_vpn.blocklist.json"
+BLOCKLIST_CHUNK = 4096 # Elements per add/delete statement
+
+# Chain priorities (numeric, for older nft versions without the symbolic names)
+PRIO_MANGLE = -150
+PRIO_DSTNAT = -100
+PRIO_FILTER = 0
+PRIO_SRCNAT = 100
+
+class FirewallError(RuntimeError):
+	"""
+	Firewall related exception
+	"""
+	def __init__(self, arg):
+		self.args = arg
+
+def runNft(script, verbose = False):
+	"""
+	Apply an nftables script as a single transaction
+	@param script Script text (for "nft -f")
+	@param verbose Indicate whether or not verbose mode should be used
+
+	@throws FirewallError if nft rejects the script
+	"""
+	cmd = ["nft", "-f", "-"]
+	if (verbose):
+		print("Command to execute [%d]: %s" % (len(cmd), cmd))
+	try:
+		subprocess.run(cmd, input = script.encode("utf-8"), stdout = subprocess.PIPE,
+					   stderr = subprocess.STDOUT, check = True)
+	except subprocess.CalledProcessError as cpe:
+		outString = cpe.output.decode("utf-8")
+		raise FirewallError("nft failed (%d): %s" % (cpe.returncode, outString))
+	except OSError as oe:
+		raise FirewallError("Unable to run nft: %s" % (oe))
+
+class NftFirewall:
+	"""
+	Class to represent the nftables ruleset for the VPN user
+	"""
+	def __init__(self, tableName = TABLE_NAME, hashFile = HASH_FILE, verbose = False):
+		"""
+		Constructor
+		@param tableName Name of the (ip family) nftables table owned by this class
+		@param hashFile File the hash of the applied ruleset is stored in
+		@param verbose Indicate whether or not verbose mode should be used
+		"""
+		self.tableName = tableName
+		self.hashFile = hashFile
+		self.verbose = verbose
+
+	def render(self, lanIf, lanNets, vpnIf, vpnUser, vpnMark,
+			   dnsServers = (VPN_DNS_SERVER_1, VPN_DNS_SERVER_2), blockedPorts = (PORT_SSH, PORT_TRANSMISSION_WEB)):
+		"""
+		Render the ruleset
+		@param lanIf LAN interface ID
+		@param lanNets List of LAN networks (<ip>/<prefix length>)
+		@param vpnIf VPN interface ID
+		@param vpnUser User whose traffic is sent through the VPN
+		@param vpnMark Mark for packets to be routed through the VPN table
+		@param dnsServers Tuple of (UDP, TCP) DNS servers the VPN user's LAN DNS traffic is sent to
+		@param blockedPorts TCP ports that may not be reached via the tunnel
+
+		@return Ruleset text (for "nft -f")
+		"""
+		t = self.tableName
+		mark = "0x%x" % (int(str(vpnMark), 0))
+		user = '"%s"' % (vpnUser)
+		lines = [
+			# Creating and then deleting the table makes the replace work whether or
+			# not the table exists; "nft -f" applies the whole file as one transaction
+			"table ip %s" % (t),
+			"delete table ip %s" % (t),
+			"table ip %s {" % (t),
+			"\tset lan_nets {",
+			"\t\ttype ipv4_addr; flags interval;",
+			"\t\telements = { %s }" % (", ".join(str(n) for n in lanNets)),
+			"\t}",
+			"",
+			"\tset tunnel_blocked_ports {",
+			"\t\ttype inet_service;",
+			"\t\telements = { %s }" % (", ".join(str(p) for p in sorted(blockedPorts))),
+			"\t}",
+			"",
+			# A route chain re-routes packets whose mark changed
+			"\tchain mangle_output {",
+			"\t\ttype route hook output priority %d; policy accept;" % (PRIO_MANGLE),
+			"\t\tip daddr != @lan_nets meta skuid %s meta mark set %s" % (user, mark),
+			"\t\tip daddr @lan_nets meta l4proto { tcp, udp } th dport %d meta skuid %s meta mark set %s" % (PORT_DNS, user, mark),
+			"\t\tip saddr != @lan_nets meta mark set %s" % (mark),
+			"\t\tip daddr != @lan_nets icmp type echo-request meta skuid 0 meta mark set %s" % (mark),
+			"\t}",
+			"",
+			"\tchain filter_input {",
+			"\t\ttype filter hook input priority %d; policy accept;" % (PRIO_FILTER),
+			"\t\tiifname \"%s\" tcp dport @tunnel_blocked_ports drop" % (vpnIf),
+			"\t\tct state established,related accept",
+			"\t\tiifname vmap { \"%s\" : drop, \"%s\" : accept, \"lo\" : accept }" % (vpnIf, lanIf),
+			"\t}",
+			"",
+			"\tchain filter_output {",
+			"\t\ttype filter hook output priority %d; policy accept;" % (PRIO_FILTER),
+			"\t\toifname { \"lo\", \"%s\" } meta skuid %s accept" % (vpnIf, user),
+			"\t\toifname vmap { \"%s\" : accept, \"lo\" : accept } comment \"%s\"" % (lanIf, RULESET_ID),
+			"\t}",
+			"",
+			"\tchain nat_output {",
+			"\t\ttype nat hook output priority %d; policy accept;" % (PRIO_DSTNAT),
+			"\t\tip daddr @lan_nets udp dport %d meta skuid %s dnat to %s" % (PORT_DNS, user, dnsServers[0]),
+			"\t\tip daddr @lan_nets tcp dport %d meta skuid %s dnat to %s" % (PORT_DNS, user, dnsServers[1]),
+			"\t}",
+			"",
+			"\tchain nat_postrouting {",
+			"\t\ttype nat hook postrouting priority %d; policy accept;" % (PRIO_SRCNAT),
+			"\t\toifname \"%s\" masquerade" % (vpnIf),
+			"\t}",
+			"}",
+			""]
+		return "\n".join(lines)
+
+	def getAppliedHash(self):
+		"""
+		@return Hash of the last applied ruleset, None if unknown
+		"""
+		try:
+			with open(self.hashFile, 'r') as f:
+				return f.read().strip()
+		except OSError:
+			return None
+
+	def isLoaded(self, rulesetId):
+		"""
+		Check that the table is loaded with its rules (it may have been flushed or
+		deleted from outside, eg by "nft flush ruleset")
+		@param rulesetId Id of the ruleset (see apply())
+
+		@return True if the table exists and carries the ruleset id
+		"""
+		try:
+			result = subprocess.run(["nft", "list", "table", "ip", self.tableName], stdout = subprocess.PIPE,
+									stderr = subprocess.DEVNULL)
+		except OSError:
+			return False
+		return ((result.returncode == 0) and (rulesetId.encode("utf-8") in result.stdout))
+
+	def apply(self, ruleset, force = False):
+		"""
+		Load the ruleset atomically, unless the same ruleset is already loaded
+		@param ruleset Ruleset text, as returned by render()
+		@param force Load the ruleset even if its hash matches the applied one
+
+		@return True if the ruleset was loaded, False if it was already current
+		@throws FirewallError if nft rejects the ruleset
+		"""
+		digest = hashlib.sha256(ruleset.encode("utf-8")).hexdigest()
+		rulesetId = "%s:%s" % (self.tableName, digest[:16])
+		if ((not force) and (digest == self.getAppliedHash())):
+			if (self.isLoaded(rulesetId)):
+				logging.info("Firewall: nftables ruleset unchanged (%s)" % (digest[:12]))
+				if (self.verbose):
+					print("Firewall: nftables ruleset unchanged")
+				return False
+			logging.info("Firewall: nftables table %s missing or flushed, reloading" % (self.tableName))
+
+		runNft(ruleset.replace(RULESET_ID, rulesetId), self.verbose)
+
+		tmpFile = self.hashFile + ".tmp"
+		with open(tmpFile, 'w') as f:
+			f.write(digest + "\n")
+		os.replace(tmpFile, self.hashFile)
+		logging.info("Firewall: nftables ruleset loaded (%s)" % (digest[:12]))
+		return True
+
+def formatRange(start, end):
+	"""
+	@return nftables element for an (integer) IPv4 range
+	"""
+	first = "%d.%d.%d.%d" % (start >> 24, (start >> 16) & 0xff, (start >> 8) & 0xff, start & 0xff)
+	if (start == end):
+		return first
+	return first + "-%d.%d.%d.%d" % (end >> 24, (end >> 16) & 0xff, (end >> 8) & 0xff, end & 0xff)
+
+class NftBlocklist:
+	"""
+	Blocklist ranges in an nftables interval set, dropped for the VPN user's
+	(marked) outgoing traffic and for traffic coming in over the tunnel
+
+	The loaded ranges are remembered (in tmpfs), so that a changed list is
+	applied as the difference to the loaded one. The table is checked before
+	the remembered state is trusted, as it may have been removed from outside.
+	"""
+	def __init__(self, tableName = BLOCKLIST_TABLE_NAME, stateFile = BLOCKLIST_STATE_FILE, verbose = False):
+		"""
+		Constructor
+		@param tableName Name of the (ip family) nftables table owned by this class
+		@param stateFile File describing the loaded rules and ranges (the ranges are kept next to it)
+		@param verbose Indicate whether or not verbose mode should be used
+		"""
+		self.tableName = tableName
+		self.stateFile = stateFile
+		self.rangesFile = stateFile + ".ranges"
+		self.verbose = verbose
+		try:
+			with open(self.stateFile, 'r') as f:
+				self.state = json.load(f)
+		except (OSError, ValueError):
+			self.state = {}
+
+	def saveState(self):
+		"""
+		Write the state back (atomically)
+		"""
+		with open(self.stateFile + ".tmp", 'w') as f:
+			json.dump(self.state, f)
+		os.replace(self.stateFile + ".tmp", self.stateFile)
+
+	def loadRanges(self):
+		"""
+		@return Set of the loaded (start, end) ranges, None if unknown
+		"""
+		try:
+			with open(self.rangesFile, 'rb') as f:
+				values = array.array('I')
+				values.frombytes(f.read())
+		except OSError:
+			return None
+		return set(zip(values[0::2], values[1::2]))
+
+	def saveRanges(self, starts, ends):
+		"""
+		Remember the loaded ranges
+		@param starts array('I') of range starts
+		@param ends array('I') of the matching range ends
+		"""
+		values = array.array('I', [0]) * (2 * len(starts))
+		values[0::2] = starts
+		values[1::2] = ends
+		with open(self.rangesFile + ".tmp", 'wb') as f:
+			values.tofile(f)
+		os.replace(self.rangesFile + ".tmp", self.rangesFile)
+
+	def isLoaded(self):
+		"""
+		Check that the table still has the set and both filter rules (it may have been
+		flushed or deleted from outside, eg by "nft flush ruleset" or a firewall restart)
+		The listing is terse, so the set elements are not printed.
+
+		@return True if the table exists with the set and the rules using it
+		"""
+		try:
+			result = subprocess.run(["nft", "-t", "list", "table", "ip", self.tableName], stdout = subprocess.PIPE,
+									stderr = subprocess.DEVNULL)
+		except OSError:
+			return False
+		setName = BLOCKLIST_SET_NAME.encode("utf-8")
+		return ((result.returncode == 0) and ((b"set " + setName + b" {") in result.stdout) and
+				(result.stdout.count(b"@" + setName + b" drop") >= 2))
+
+	def setRules(self, vpnIf, vpnMark):
+		"""
+		Create the table, set and filter rules (if not already set up for this interface/mark)
+		Existing set elements are kept. If the table went missing, the remembered state
+		is dropped (see reset()) and the set has to be reloaded completely.
+		@param vpnIf VPN interface ID
+		@param vpnMark Mark of the VPN user's packets
+
+		@return True if the rules were (re)created, False if they were already set
+		@throws FirewallError if nft rejects the rules
+		"""
+		t = self.tableName
+		mark = "0x%x" % (int(str(vpnMark), 0))
+		if (self.state.get("rules") == [vpnIf, mark]):
+			if (self.isLoaded()):
+				return False
+			logging.info("Firewall: nftables table %s missing or flushed, reloading the blocklist" % (t))
+			if (self.verbose):
+				print("Firewall: blocklist table missing or flushed, reloading")
+			self.reset()
+		lines = [
+			# "add" leaves existing objects (and the set elements) alone
+			"add table ip %s" % (t),
+			"add set ip %s %s { type ipv4_addr; flags interval; }" % (t, BLOCKLIST_SET_NAME),
+			"add chain ip %s output { type filter hook output priority %d; policy accept; }" % (t, PRIO_FILTER),
+			"add chain ip %s input { type filter hook input priority %d; policy accept; }" % (t, PRIO_FILTER),
+			"flush chain ip %s output" % (t),
+			"flush chain ip %s input" % (t),
+			"add rule ip %s output meta mark %s ip daddr @%s drop" % (t, mark, BLOCKLIST_SET_NAME),
+			"add rule ip %s input iifname \"%s\" ip saddr @%s drop" % (t, vpnIf, BLOCKLIST_SET_NAME),
+			""]
+		runNft("\n".join(lines), self.verbose)
+		self.state["rules"] = [vpnIf, mark]
+		self.saveState()
+		logging.info("Firewall: blocklist rules set for %s/%s" % (vpnIf, mark))
+		return True
+
+	def elementStatements(self, verb, ranges):
+		"""
+		@return List of "add/delete element" statements for the ranges (in chunks)
+		"""
+		ranges = sorted(ranges)
+		statements = []
+		for i in range(0, len(ranges), BLOCKLIST_CHUNK):
+			elements = ", ".join(formatRange(s, e) for s, e in ranges[i:i + BLOCKLIST_CHUNK])
+			statements.append("%s element ip %s %s { %s }" % (verb, self.tableName, BLOCKLIST_SET_NAME, elements))
+		return statements
+
+	def sync(self, ranges, force = False):
+		"""
+		Bring the set to the given (merged, non overlapping) ranges
+		Only the difference to the loaded ranges is applied; the set is reloaded
+		completely if the loaded ranges are unknown or applying the difference fails.
+		@param ranges iprange.RangeSet (or any object with starts/ends arrays)
+		@param force Reload the set completely
+
+		@return Tuple of (number of ranges added, number of ranges removed)
+		@throws FirewallError if nft rejects the ranges
+		"""
+		wanted = set(zip(ranges.starts, ranges.ends))
+		loaded = None if force else self.loadRanges()
+		if (loaded is not None):
+			added = wanted - loaded
+			removed = loaded - wanted
+			if (added or removed):
+				# Deletes go first: a changed range may overlap its replacement
+				script = self.elementStatements("delete", removed) + self.elementStatements("add", added)
+				try:
+					runNft("\n".join(script) + "\n", self.verbose)
+				except FirewallError as fe:
+					logging.info("Firewall: blocklist delta failed (%s), reloading the set" % (''.join(fe.args)))
+					loaded = None
+		if (loaded is None):
+			added = wanted
+			removed = set()
+			script = ["flush set ip %s %s" % (self.tableName, BLOCKLIST_SET_NAME)] + self.elementStatements("add", added)
+			runNft("\n".join(script) + "\n", self.verbose)
+		self.saveRanges(ranges.starts, ranges.ends)
+		logging.info("Firewall: blocklist set: %d ranges added, %d removed" % (len(added), len(removed)))
+		if (self.verbose):
+			print("Firewall: blocklist set: %d ranges added, %d removed" % (len(added), len(removed)))
+		return len(added), len(removed)
+
+	def reset(self):
+		"""
+		Forget what was loaded (eg after the ruleset was changed behind our back),
+		so that the next update sets the rules and reloads the set completely
+		"""
+		self.state = {}
+		for f in (self.stateFile, self.rangesFile):
+			try:
+				os.unlink(f)
+			except FileNotFoundError:
+				pass
+
+	def isCurrent(self, listFile):
+		"""
+		Check whether a list file was already loaded (same mtime and size)
+		@param listFile Merged p2p list file
+
+		@return True if the set holds the file's ranges
+		"""
+		try:
+			st = os.stat(listFile)
+		except OSError:
+			return False
+		return self.state.get("source") == [listFile, st.st_mtime_ns, st.st_size]
+
+	def markCurrent(self, listFile):
+		"""
+		Record the list file the set was loaded from
+		@param listFile Merged p2p list file
+		"""
+		st = os.stat(listFile)
+		self.state["source"] = [listFile, st.st_mtime_ns, st.st_size]
+		self.saveState()
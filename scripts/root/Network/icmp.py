@@ -0,0 +1,204 @@
+'''
+In-process ICMP echo prober
+Uses an unprivileged datagram ICMP socket (see net.ipv4.ping_group_range) where
+possible, falling back to a raw socket (requires root/CAP_NET_RAW).
+'''
+import os
+import socket
+import struct
+import select
+import time
+import logging
+import threading
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+ICMP_HDR = struct.Struct("!BBHHH")
+
+class IcmpError(RuntimeError):
+	"""
+	ICMP related exception
+	"""
+	def __init__(self, arg):
+		self.args = arg
+
+class PingStats:
+	"""
+	Result of a burst of echo requests
+	"""
+	def __init__(self, target, sent, rtts):
+		"""
+		Constructor
+		@param target Address that was probed
+		@param sent Number of echo requests sent
+		@param rtts List of round trip times (in ms) of the replies received
+		"""
+		self.target = target
+		self.sent = sent
+		self.received = len(rtts)
+		self.loss = 1.0 if (sent == 0) else (sent - self.received) / sent
+		if (self.received > 0):
+			self.rttMin = min(rtts)
+			self.rttAvg = sum(rtts) / self.received
+			self.rttMax = max(rtts)
+		else:
+			self.rttMin = self.rttAvg = self.rttMax = None
+
+	def __str__(self):
+		if (self.received == 0):
+			return "%s: %d sent, 0 received, 100%% loss" % (self.target, self.sent)
+		return "%s: %d sent, %d received, %.0f%% loss, rtt min/avg/max %.3f/%.3f/%.3f ms" % (
+			self.target, self.sent, self.received, self.loss * 100, self.rttMin, self.rttAvg, self.rttMax)
+
+def checksum(data):
+	"""
+	Internet checksum (RFC 1071)
+	@param data Bytes to checksum
+
+	@return 16 bit checksum
+	"""
+	if (len(data) % 2):
+		data += b"\0"
+	total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+	total = (total >> 16) + (total & 0xffff)
+	total += (total >> 16)
+	return (~total) & 0xffff
+
+class IcmpProber:
+	"""
+	Sends bursts of ICMP echo requests and collects the replies
+	The probes of a prober are serialised: a probe thread that was given up on
+	(cancelled probe) would otherwise take the replies of the next probe.
+	"""
+	def __init__(self, verbose = False):
+		"""
+		Constructor
+		@param verbose Indicate whether or not verbose mode should be used
+
+		@throws IcmpError if neither a datagram nor a raw ICMP socket can be opened
+		"""
+		self.verbose = verbose
+		self.ident = os.getpid() & 0xffff
+		self.seq = 0
+		self.sock = None
+		self.raw = False
+		self.target = None
+		self.lock = threading.Lock()
+		try:
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+		except OSError as dgramError:
+			try:
+				self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+				self.raw = True
+			except OSError as rawError:
+				raise IcmpError("Unable to open ICMP socket (datagram: %s; raw: %s)" % (dgramError, rawError))
+		self.sock.setblocking(False)
+		if (self.verbose):
+			print("ICMP: using %s socket" % ("raw" if self.raw else "datagram"))
+
+	def buildRequest(self, seq, payload):
+		"""
+		Build an echo request packet
+		@param seq Sequence number
+		@param payload Payload bytes
+
+		@return Packet bytes
+		"""
+		hdr = ICMP_HDR.pack(ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+		csum = checksum(hdr + payload)
+		return ICMP_HDR.pack(ICMP_ECHO_REQUEST, 0, csum, self.ident, seq) + payload
+
+	def parseReply(self, packet):
+		"""
+		Extract the sequence number from an echo reply
+		@param packet Received bytes
+
+		@return Sequence number, None if the packet is not one of our echo replies
+		"""
+		if (self.raw):
+			# Raw sockets include the IP header (and receive all ICMP traffic)
+			ihl = (packet[0] & 0x0f) * 4
+			packet = packet[ihl:]
+		if (len(packet) < ICMP_HDR.size):
+			return None
+		icmpType, code, csum, ident, seq = ICMP_HDR.unpack_from(packet)
+		if (icmpType != ICMP_ECHO_REPLY):
+			return None
+		# For datagram sockets the kernel rewrites the identifier, and only
+		# delivers replies for this socket
+		if (self.raw and (ident != self.ident)):
+			return None
+		return seq
+
+	def probe(self, target, count = 5, interval = 0.02, timeout = 1.0):
+		"""
+		Send a burst of echo requests and wait for the replies
+		@param target IPv4 address to probe
+		@param count Number of echo requests to send
+		@param interval Time (in seconds) between requests
+		@param timeout Time (in seconds) to wait for replies after the last request
+
+		@return PingStats object
+		"""
+		with self.lock:
+			self.target = target
+			sendTimes = {}
+			rtts = []
+			payload = struct.pack("!d", time.time()) + b"torrent_vpn"
+
+			for i in range(0, count):
+				seq = self.seq
+				self.seq = (self.seq + 1) & 0xffff
+				try:
+					self.sock.sendto(self.buildRequest(seq, payload), (target, 0))
+					sendTimes[seq] = time.monotonic()
+				except OSError as oe:
+					logging.info("ICMP: send to %s failed: %s" % (target, oe))
+				# Keep the pace even when the replies are already in
+				self.collect(sendTimes, rtts, interval, untilAnswered = False)
+
+			deadline = time.monotonic() + timeout
+			while (sendTimes and (time.monotonic() < deadline)):
+				self.collect(sendTimes, rtts, deadline - time.monotonic())
+
+		stats = PingStats(target, count, rtts)
+		logging.info("ICMP: %s" % (stats))
+		if (self.verbose):
+			print("ICMP: %s" % (stats))
+		return stats
+
+	def collect(self, sendTimes, rtts, waitTime, untilAnswered = True):
+		"""
+		Receive replies for up to waitTime seconds
+		@param sendTimes Dictionary of outstanding sequence number -> send time (answered entries are removed)
+		@param rtts List the round trip times (in ms) are appended to
+		@param waitTime Maximum time (in seconds) to wait
+		@param untilAnswered Return as soon as all requests are answered (instead of after waitTime)
+		"""
+		deadline = time.monotonic() + max(waitTime, 0)
+		while True:
+			remaining = deadline - time.monotonic()
+			readable, _, _ = select.select([self.sock], [], [], max(remaining, 0))
+			if (not readable):
+				return
+			try:
+				packet, addr = self.sock.recvfrom(2048)
+			except BlockingIOError:
+				continue
+			now = time.monotonic()
+			if (addr[0] != self.target):
+				continue
+			seq = self.parseReply(packet)
+			if ((seq is not None) and (seq in sendTimes)):
+				rtts.append((now - sendTimes.pop(seq)) * 1000.0)
+				if ((not sendTimes) and untilAnswered):
+					return
+
+	def close(self):
+		"""
+		Close the socket
+		"""
+		if (self.sock is not None):
+			self.sock.close()
+			self.sock = None
@@ -55,6 +55,18 @@ class Interface:
 				print("Interface %s not available" % (self.ifId))
 		return DOWN
 
+	def hasAddress(self):
+		"""
+		Check whether the interface exists and has an IPv4 address (without logging)
+
+		@return True if the interface has an IPv4 address
+		"""
+		try:
+			addrTypes = netifaces.ifaddresses(self.ifId)
+		except ValueError: # Interface does not exist (yet)
+			return False
+		return any(KEY_ADDR in addr for addr in addrTypes.get(self.addrType, []))
+
 	def getTunnelParams(self):
 		"""
 		Retrieve the interface tunnel parameters (if applicable)
@@ -0,0 +1,498 @@
+'''
+Minimal rtnetlink client for IPv4 policy routing
+Reads and programs the routes of a routing table and fwmark rules, without
+forking ip/ifconfig. Routes are synchronised by difference: missing routes are
+added before stale routes are removed, so the table is never left empty.
+Link and address events can be waited on instead of polling the interfaces.
+'''
+import os
+import socket
+import struct
+import select
+import time
+import errno
+import logging
+
+# Message types
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+RTM_GETRULE = 34
+
+# Multicast groups
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+# Message flags
+NLM_F_REQUEST = 0x001
+NLM_F_MULTI = 0x002
+NLM_F_ACK = 0x004
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_APPEND = 0x800
+
+# Route attributes
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_PREFSRC = 7
+RTA_TABLE = 15
+
+# Rule attributes
+FRA_PRIORITY = 6
+FRA_FWMARK = 10
+FRA_TABLE = 15
+FRA_FWMASK = 16
+
+FR_ACT_TO_TBL = 1
+
+RTPROT_KERNEL = 2
+RTPROT_BOOT = 3
+
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+
+RTN_UNICAST = 1
+RT_TABLE_COMPAT = 252
+
+NLMSG_HDR = struct.Struct("=IHHII")
+RTMSG = struct.Struct("=BBBBBBBBI")
+RTATTR = struct.Struct("=HH")
+NLMSGERR = struct.Struct("=i")
+
+RT_TABLES_FILES = ["/etc/iproute2/rt_tables", "/usr/share/iproute2/rt_tables"]
+
+class NetlinkError(RuntimeError):
+	"""
+	Netlink related exception
+	"""
+	def __init__(self, arg, err = 0):
+		self.args = arg
+		self.errno = err
+
+def align(length):
+	"""
+	@return length rounded up to the netlink 4 byte alignment
+	"""
+	return (length + 3) & ~3
+
+def packAttr(attrType, data):
+	"""
+	Pack a single route attribute
+	@param attrType Attribute type
+	@param data Attribute payload bytes
+
+	@return Packed (padded) attribute
+	"""
+	length = RTATTR.size + len(data)
+	return RTATTR.pack(length, attrType) + data + b"\0" * (align(length) - length)
+
+def parseAttrs(data, offset):
+	"""
+	Parse route attributes
+	@param data Message bytes
+	@param offset Offset of the first attribute
+
+	@return Dictionary of attribute type -> payload bytes
+	"""
+	attrs = {}
+	while (offset + RTATTR.size <= len(data)):
+		length, attrType = RTATTR.unpack_from(data, offset)
+		if (length < RTATTR.size):
+			break
+		attrs[attrType] = data[offset + RTATTR.size:offset + length]
+		offset += align(length)
+	return attrs
+
+def getTableId(table):
+	"""
+	Resolve a routing table name (as in /etc/iproute2/rt_tables) to its number
+	@param table Table name or number
+
+	@return Table number
+	@throws NetlinkError if the table name is unknown
+	"""
+	try:
+		return int(str(table), 0)
+	except ValueError:
+		pass
+	for fileName in RT_TABLES_FILES:
+		try:
+			with open(fileName, 'r') as f:
+				for line in f:
+					fields = line.split('#')[0].split()
+					if ((len(fields) >= 2) and (fields[1] == table)):
+						return int(fields[0], 0)
+		except FileNotFoundError:
+			continue
+	raise NetlinkError("Unknown routing table: %s" % (table))
+
+class Route:
+	"""
+	IPv4 route in a single routing table
+	"""
+	def __init__(self, dst = "0.0.0.0", dstLen = 0, gateway = None, dev = None, prefsrc = None,
+				 scope = RT_SCOPE_UNIVERSE, protocol = RTPROT_BOOT, priority = None, fallback = False):
+		"""
+		Constructor
+		@param dst Destination network address
+		@param dstLen Destination prefix length
+		@param gateway Gateway address (None for directly connected routes)
+		@param dev Output interface name
+		@param prefsrc Preferred source address
+		@param scope Route scope
+		@param protocol Route protocol (origin)
+		@param priority Route metric
+		@param fallback True if the route should be placed behind other routes to the same destination
+		"""
+		self.dst = dst
+		self.dstLen = dstLen
+		self.gateway = gateway
+		self.dev = dev
+		self.prefsrc = prefsrc
+		self.scope = scope
+		self.protocol = protocol
+		self.priority = priority
+		self.fallback = fallback
+
+	def key(self):
+		"""
+		@return Tuple identifying the route for comparison (protocol is ignored)
+		"""
+		return (self.dst, self.dstLen, self.gateway, self.dev, self.prefsrc, self.scope, self.priority)
+
+	def __str__(self):
+		s = "%s/%d" % (self.dst, self.dstLen)
+		if (self.gateway is not None):
+			s += " via %s" % (self.gateway)
+		if (self.dev is not None):
+			s += " dev %s" % (self.dev)
+		if (self.scope == RT_SCOPE_LINK):
+			s += " scope link"
+		if (self.prefsrc is not None):
+			s += " src %s" % (self.prefsrc)
+		if (self.priority is not None):
+			s += " metric %d" % (self.priority)
+		return s
+
+class Rule:
+	"""
+	IPv4 fwmark policy routing rule
+	"""
+	def __init__(self, fwmark, table, priority = None, fwmask = None):
+		"""
+		Constructor
+		@param fwmark Firewall mark to match
+		@param table Table number to look up
+		@param priority Rule priority (None lets the kernel choose)
+		@param fwmask Firewall mark mask
+		"""
+		self.fwmark = fwmark
+		self.table = table
+		self.priority = priority
+		self.fwmask = fwmask
+
+class RouteSocket:
+	"""
+	NETLINK_ROUTE socket
+	"""
+	def __init__(self, verbose = False):
+		"""
+		Constructor
+		@param verbose Indicate whether or not verbose mode should be used
+
+		@throws NetlinkError if the socket cannot be opened
+		"""
+		self.verbose = verbose
+		self.seq = 0
+		try:
+			self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+			self.sock.bind((0, 0))
+		except (OSError, AttributeError) as e:
+			raise NetlinkError("Unable to open netlink socket: %s" % (e))
+
+	def close(self):
+		"""
+		Close the socket
+		"""
+		self.sock.close()
+
+	def request(self, msgType, flags, payload):
+		"""
+		Send a request and collect the replies
+		@param msgType Netlink message type
+		@param flags Netlink flags (NLM_F_REQUEST is added)
+		@param payload Message payload
+
+		@return List of (type, body) replies (without the final DONE/ACK)
+		@throws NetlinkError if the kernel reports an error
+		"""
+		self.seq += 1
+		seq = self.seq
+		msg = NLMSG_HDR.pack(NLMSG_HDR.size + len(payload), msgType, flags | NLM_F_REQUEST, seq, 0) + payload
+		try:
+			self.sock.send(msg)
+		except OSError as oe:
+			raise NetlinkError("Netlink send failed: %s" % (oe))
+
+		replies = []
+		while True:
+			data = self.sock.recv(65536)
+			offset = 0
+			while (offset + NLMSG_HDR.size <= len(data)):
+				length, rType, rFlags, rSeq, rPid = NLMSG_HDR.unpack_from(data, offset)
+				body = data[offset + NLMSG_HDR.size:offset + length]
+				offset += align(length)
+				if (rSeq != seq):
+					continue
+				if (rType == NLMSG_DONE):
+					return replies
+				if (rType == NLMSG_ERROR):
+					err = -NLMSGERR.unpack_from(body)[0]
+					if (err == 0):
+						return replies # ACK
+					raise NetlinkError("Netlink error: %s" % (os.strerror(err)), err)
+				replies.append((rType, body))
+				if (not (rFlags & NLM_F_MULTI)):
+					return replies
+
+	def getRoutes(self, table):
+		"""
+		Retrieve the IPv4 routes of a routing table
+		@param table Table number
+
+		@return List of Route objects, in kernel order
+		"""
+		payload = RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+		routes = []
+		for rType, body in self.request(RTM_GETROUTE, NLM_F_DUMP, payload):
+			family, dstLen, srcLen, tos, rtTable, protocol, scope, routeType, rtFlags = RTMSG.unpack_from(body)
+			attrs = parseAttrs(body, RTMSG.size)
+			if (RTA_TABLE in attrs):
+				rtTable = struct.unpack("=I", attrs[RTA_TABLE])[0]
+			if ((rtTable != table) or (routeType != RTN_UNICAST)):
+				continue
+			dev = None
+			if (RTA_OIF in attrs):
+				try:
+					dev = socket.if_indextoname(struct.unpack("=I", attrs[RTA_OIF])[0])
+				except OSError:
+					dev = None
+			routes.append(Route(socket.inet_ntoa(attrs[RTA_DST]) if (RTA_DST in attrs) else "0.0.0.0",
+								dstLen,
+								socket.inet_ntoa(attrs[RTA_GATEWAY]) if (RTA_GATEWAY in attrs) else None,
+								dev,
+								socket.inet_ntoa(attrs[RTA_PREFSRC]) if (RTA_PREFSRC in attrs) else None,
+								scope,
+								protocol,
+								struct.unpack("=I", attrs[RTA_PRIORITY])[0] if (RTA_PRIORITY in attrs) else None))
+		return routes
+
+	def routeMsg(self, route, table):
+		"""
+		Build the payload for a route add/delete request
+		@param route Route object
+		@param table Table number
+
+		@return Message payload
+		"""
+		payload = RTMSG.pack(socket.AF_INET, route.dstLen, 0, 0, table if (table < 256) else RT_TABLE_COMPAT,
+							 route.protocol, route.scope, RTN_UNICAST, 0)
+		payload += packAttr(RTA_TABLE, struct.pack("=I", table))
+		if (route.dstLen > 0):
+			payload += packAttr(RTA_DST, socket.inet_aton(route.dst))
+		if (route.gateway is not None):
+			payload += packAttr(RTA_GATEWAY, socket.inet_aton(route.gateway))
+		if (route.dev is not None):
+			try:
+				payload += packAttr(RTA_OIF, struct.pack("=I", socket.if_nametoindex(route.dev)))
+			except OSError:
+				raise NetlinkError("Unknown interface: %s" % (route.dev))
+		if (route.prefsrc is not None):
+			payload += packAttr(RTA_PREFSRC, socket.inet_aton(route.prefsrc))
+		if (route.priority is not None):
+			payload += packAttr(RTA_PRIORITY, struct.pack("=I", route.priority))
+		return payload
+
+	def addRoute(self, route, table):
+		"""
+		Add a route; fallback routes are appended behind existing routes to the
+		same destination, other routes are placed in front of them
+		@param route Route object
+		@param table Table number
+		"""
+		flags = NLM_F_CREATE | NLM_F_ACK
+		if (route.fallback):
+			flags |= NLM_F_APPEND
+		self.request(RTM_NEWROUTE, flags, self.routeMsg(route, table))
+
+	def delRoute(self, route, table):
+		"""
+		Delete a route
+		@param route Route object
+		@param table Table number
+		"""
+		self.request(RTM_DELROUTE, NLM_F_ACK, self.routeMsg(route, table))
+
+	def getRules(self):
+		"""
+		Retrieve the IPv4 policy routing rules
+
+		@return List of Rule objects (only rules with a table action)
+		"""
+		payload = RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+		rules = []
+		for rType, body in self.request(RTM_GETRULE, NLM_F_DUMP, payload):
+			family, dstLen, srcLen, tos, rtTable, res1, res2, action, ruleFlags = RTMSG.unpack_from(body)
+			if (action != FR_ACT_TO_TBL):
+				continue
+			attrs = parseAttrs(body, RTMSG.size)
+			if (FRA_TABLE in attrs):
+				rtTable = struct.unpack("=I", attrs[FRA_TABLE])[0]
+			rules.append(Rule(struct.unpack("=I", attrs[FRA_FWMARK])[0] if (FRA_FWMARK in attrs) else None,
+							  rtTable,
+							  struct.unpack("=I", attrs[FRA_PRIORITY])[0] if (FRA_PRIORITY in attrs) else None,
+							  struct.unpack("=I", attrs[FRA_FWMASK])[0] if (FRA_FWMASK in attrs) else None))
+		return rules
+
+	def addRule(self, rule):
+		"""
+		Add a fwmark rule
+		@param rule Rule object
+		"""
+		payload = RTMSG.pack(socket.AF_INET, 0, 0, 0, rule.table if (rule.table < 256) else RT_TABLE_COMPAT,
+							 0, 0, FR_ACT_TO_TBL, 0)
+		payload += packAttr(FRA_TABLE, struct.pack("=I", rule.table))
+		payload += packAttr(FRA_FWMARK, struct.pack("=I", rule.fwmark))
+		if (rule.fwmask is not None):
+			payload += packAttr(FRA_FWMASK, struct.pack("=I", rule.fwmask))
+		if (rule.priority is not None):
+			payload += packAttr(FRA_PRIORITY, struct.pack("=I", rule.priority))
+		self.request(RTM_NEWRULE, NLM_F_CREATE | NLM_F_EXCL | NLM_F_ACK, payload)
+
+	def ensureRule(self, rule):
+		"""
+		Add a fwmark rule, unless a rule for the same mark and table already exists
+		@param rule Rule object
+
+		@return True if the rule was added, False if it already existed
+		"""
+		for r in self.getRules():
+			if ((r.fwmark == rule.fwmark) and (r.table == rule.table)):
+				return False
+		self.addRule(rule)
+		logging.info("Netlink: added rule fwmark 0x%x lookup %d" % (rule.fwmark, rule.table))
+		return True
+
+	def syncRoutes(self, table, desired):
+		"""
+		Bring a routing table to the desired state, touching only the routes that differ
+		Missing routes are added first and stale routes removed afterwards, so
+		traffic always has a route.
+		@param table Table number
+		@param desired List of Route objects
+
+		@return Tuple of (added, removed) route lists
+		"""
+		current = self.getRoutes(table)
+		currentKeys = set(r.key() for r in current)
+		desiredKeys = set(r.key() for r in desired)
+
+		added = []
+		for r in desired:
+			if (r.key() not in currentKeys):
+				self.addRoute(r, table)
+				added.append(r)
+				currentKeys.add(r.key())
+
+		removed = []
+		for r in current:
+			if (r.key() not in desiredKeys):
+				try:
+					self.delRoute(r, table)
+				except NetlinkError as ne:
+					# Routes via a vanished device are removed by the kernel
+					if (ne.errno != errno.ESRCH):
+						raise
+				removed.append(r)
+
+		for r in added:
+			logging.info("Netlink: table %d: added %s" % (table, r))
+		for r in removed:
+			logging.info("Netlink: table %d: removed %s" % (table, r))
+		if (self.verbose):
+			print("Netlink: table %d: %d routes added, %d removed" % (table, len(added), len(removed)))
+		return added, removed
+
+class LinkWatcher:
+	"""
+	Waits for link/address changes (RTM_NEWLINK, RTM_NEWADDR, ...) instead of polling
+	"""
+	def __init__(self, verbose = False):
+		"""
+		Constructor
+		@param verbose Indicate whether or not verbose mode should be used
+
+		@throws NetlinkError if the event socket cannot be opened
+		"""
+		self.verbose = verbose
+		try:
+			self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+		except (OSError, AttributeError) as e:
+			raise NetlinkError("Unable to open netlink socket: %s" % (e))
+		try:
+			self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+			self.sock.setblocking(False)
+		except OSError as oe:
+			self.sock.close()
+			raise NetlinkError("Unable to subscribe to link events: %s" % (oe), oe.errno)
+
+	def close(self):
+		"""
+		Close the event socket
+		"""
+		if (self.sock is not None):
+			self.sock.close()
+			self.sock = None
+
+	def drain(self):
+		"""
+		Discard pending events (they are only used as a trigger to re-check)
+		"""
+		while True:
+			try:
+				if (not self.sock.recv(65536)):
+					return
+			except BlockingIOError:
+				return
+			except OSError:
+				# Most likely ENOBUFS (events were lost), re-checking covers it
+				return
+
+	def wait(self, check, timeout):
+		"""
+		Wait until a condition holds, re-evaluating it on every link/address event
+		The subscription is made before the first check, so no event is missed.
+		@param check Function returning True once the condition is met (eg the interface has an address)
+		@param timeout Maximum time (in seconds) to wait
+
+		@return True if the condition was met, False on timeout
+		"""
+		deadline = time.monotonic() + timeout
+		while True:
+			if (check()):
+				return True
+			remaining = deadline - time.monotonic()
+			if (remaining <= 0):
+				return False
+			readable, _, _ = select.select([self.sock], [], [], remaining)
+			if (readable):
+				if (self.verbose):
+					print("Netlink: link/address event")
+				self.drain()
@@ -0,0 +1,157 @@
+'''
+Concurrent health probe engine
+Probes are started together, each with its own deadline. As soon as the
+collected results allow a decision, the remaining probes are cancelled (and
+their processes killed).
+'''
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import time
+
+import Log.trace as trace
+
+# Probe results
+PASS = 1
+FAIL = 0
+TIMEOUT = -1
+FAILED_TO_RUN = -2
+
+RESULT_NAMES = {PASS: "pass", FAIL: "fail", TIMEOUT: "timeout", FAILED_TO_RUN: "error"}
+
+class Probe:
+	"""
+	Base class for a single health probe
+	"""
+	def __init__(self, name, timeout):
+		"""
+		Constructor
+		@param name Probe name (key in the result dictionary)
+		@param timeout Deadline (in seconds) after which the probe is cancelled
+		"""
+		self.name = name
+		self.timeout = timeout
+
+	async def run(self):
+		"""
+		Run the probe
+
+		@return PASS or FAIL
+		"""
+		raise NotImplementedError
+
+class CommandProbe(Probe):
+	"""
+	Probe running an external command; the command (and anything it spawned) is
+	killed when the probe is cancelled or times out
+	"""
+	def __init__(self, name, cmd, timeout, interpret):
+		"""
+		Constructor
+		@param name Probe name
+		@param cmd Command (list) to execute
+		@param timeout Deadline in seconds
+		@param interpret Function (returncode, outString) -> PASS/FAIL
+		"""
+		Probe.__init__(self, name, timeout)
+		self.cmd = cmd
+		self.interpret = interpret
+
+	async def run(self):
+		with trace.commandSpan(self.cmd):
+			proc = await asyncio.create_subprocess_exec(*self.cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+														start_new_session = True)
+			try:
+				output, _ = await proc.communicate()
+			except asyncio.CancelledError:
+				try:
+					os.killpg(proc.pid, signal.SIGKILL)
+				except ProcessLookupError:
+					pass
+				await proc.wait()
+				raise
+		return self.interpret(proc.returncode, output.decode("utf-8", "replace"))
+
+class CallableProbe(Probe):
+	"""
+	Probe calling a (blocking) function in a worker thread
+	Note that a blocking function cannot be interrupted; on cancellation its
+	result is simply ignored.
+	"""
+	def __init__(self, name, func, timeout):
+		"""
+		Constructor
+		@param name Probe name
+		@param func Function without arguments returning PASS/FAIL
+		@param timeout Deadline in seconds
+		"""
+		Probe.__init__(self, name, timeout)
+		self.func = func
+
+	async def run(self):
+		loop = asyncio.get_event_loop()
+		return await loop.run_in_executor(None, self.func)
+
+async def _timedRun(probe):
+	"""
+	Run a probe within its deadline
+
+	@return Tuple of (result, elapsed seconds)
+	"""
+	start = time.monotonic()
+	try:
+		result = await asyncio.wait_for(probe.run(), probe.timeout)
+	except asyncio.TimeoutError:
+		result = TIMEOUT
+	except asyncio.CancelledError:
+		raise
+	except Exception as e:
+		logging.info("Probe: %s raised %s" % (probe.name, e))
+		result = FAILED_TO_RUN
+	return result, time.monotonic() - start
+
+async def runProbesAsync(probes, decide):
+	"""
+	Run probes concurrently until a decision can be made
+	@param probes List of Probe objects
+	@param decide Function (results dictionary) -> verdict, or None if the results so far are inconclusive
+
+	@return Tuple of (verdict, results); verdict is None if all probes completed without a conclusive answer
+	"""
+	tasks = {}
+	for p in probes:
+		tasks[asyncio.ensure_future(_timedRun(p))] = p
+
+	results = {}
+	verdict = None
+	try:
+		while (tasks and (verdict is None)):
+			done, _ = await asyncio.wait(list(tasks.keys()), return_when = asyncio.FIRST_COMPLETED)
+			for t in done:
+				p = tasks.pop(t)
+				result, elapsed = t.result()
+				results[p.name] = result
+				logging.info("Probe: %s -> %s (%.3f s)" % (p.name, RESULT_NAMES.get(result, result), elapsed))
+			verdict = decide(results)
+	finally:
+		for t in tasks:
+			t.cancel()
+		if (tasks):
+			await asyncio.gather(*tasks.keys(), return_exceptions = True)
+			logging.info("Probe: cancelled %s" % (", ".join(p.name for p in tasks.values())))
+	return verdict, results
+
+def runProbes(probes, decide):
+	"""
+	Synchronous wrapper around runProbesAsync (uses a private event loop, so it can
+	be called from any thread)
+
+	@return Tuple of (verdict, results)
+	"""
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(runProbesAsync(probes, decide))
+	finally:
+		loop.close()
@@ -0,0 +1,165 @@
+'''
+Main routing table reader
+Parses /proc/net/route (no route/net-tools fork) and caches the result until a
+route change is announced over netlink.
+'''
+import socket
+import struct
+import logging
+
+PROC_NET_ROUTE = "/proc/net/route"
+
+# Route flags (see linux/route.h)
+RTF_UP = 0x0001
+RTF_GATEWAY = 0x0002
+RTF_HOST = 0x0004
+
+# Netlink multicast group for IPv4 route changes
+RTMGRP_IPV4_ROUTE = 0x40
+
+class RouteEntry:
+	"""
+	Single entry of the main routing table
+	"""
+	def __init__(self, iface, dest, gateway, flags, metric, mask, mtu):
+		"""
+		Constructor
+		@param iface Interface ID
+		@param dest Destination address (dotted quad)
+		@param gateway Gateway address (dotted quad)
+		@param flags RTF_* flags
+		@param metric Route metric
+		@param mask Destination netmask (dotted quad)
+		@param mtu Route MTU (0 if not set)
+		"""
+		self.iface = iface
+		self.dest = dest
+		self.gateway = gateway
+		self.flags = flags
+		self.metric = metric
+		self.mask = mask
+		self.mtu = mtu
+
+	def isDefault(self):
+		"""
+		@return True if this is an active default route via a gateway
+		"""
+		return ((self.dest == "0.0.0.0") and (self.mask == "0.0.0.0") and
+				((self.flags & (RTF_UP | RTF_GATEWAY)) == (RTF_UP | RTF_GATEWAY)))
+
+	def __str__(self):
+		return "%s/%s via %s dev %s metric %d" % (self.dest, self.mask, self.gateway, self.iface, self.metric)
+
+def hexToAddr(value):
+	"""
+	Convert a /proc/net/route address (host byte order hex) to a dotted quad
+	@param value Hex string
+
+	@return Dotted quad address
+	"""
+	return socket.inet_ntoa(struct.pack("=I", int(value, 16)))
+
+def parseRoutes(text):
+	"""
+	Parse the contents of /proc/net/route
+	@param text File contents
+
+	@return List of RouteEntry objects
+	"""
+	routes = []
+	lines = text.splitlines()
+	for line in lines[1:]: # The first line is the column header
+		fields = line.split()
+		if (len(fields) < 11):
+			continue
+		routes.append(RouteEntry(fields[0], hexToAddr(fields[1]), hexToAddr(fields[2]), int(fields[3], 16),
+								 int(fields[6]), hexToAddr(fields[7]), int(fields[8])))
+	return routes
+
+class RouteTable:
+	"""
+	Cached view of the main routing table
+	"""
+	def __init__(self, procFile = PROC_NET_ROUTE, watch = True, verbose = False):
+		"""
+		Constructor
+		@param procFile Route file to parse
+		@param watch Subscribe to netlink route change events to invalidate the cache
+					 (without it, every call rereads the route file)
+		@param verbose Indicate whether or not verbose mode should be used
+		"""
+		self.procFile = procFile
+		self.verbose = verbose
+		self.routes = None
+		self.sock = None
+		if (watch):
+			try:
+				self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+				self.sock.bind((0, RTMGRP_IPV4_ROUTE))
+				self.sock.setblocking(False)
+			except (OSError, AttributeError) as e:
+				logging.info("Routes: route change events unavailable (%s), not caching" % (e))
+				self.sock = None
+
+	def changed(self):
+		"""
+		Drain pending route change events
+
+		@return True if routes changed since the last call (or if changes cannot be tracked)
+		"""
+		if (self.sock is None):
+			return True
+		changed = False
+		while True:
+			try:
+				if (not self.sock.recv(65536)):
+					break
+				changed = True
+			except BlockingIOError:
+				break
+			except OSError:
+				# Most likely ENOBUFS (events were lost); assume a change
+				changed = True
+				break
+		return changed
+
+	def getRoutes(self):
+		"""
+		Retrieve the routes of the main table
+
+		@return List of RouteEntry objects
+		"""
+		if (self.changed() or (self.routes is None)):
+			with open(self.procFile, 'r') as f:
+				self.routes = parseRoutes(f.read())
+			if (self.verbose):
+				print("Routes: read %d routes from %s" % (len(self.routes), self.procFile))
+		return self.routes
+
+	def getDefaultRoutes(self):
+		"""
+		Retrieve the default routes, best (lowest metric) first
+
+		@return List of RouteEntry objects
+		"""
+		return sorted([r for r in self.getRoutes() if r.isDefault()], key = lambda r: r.metric)
+
+	def getDefaultRoute(self, exclude = ()):
+		"""
+		Retrieve the preferred default route
+		@param exclude Interface IDs to ignore (eg the VPN tunnel)
+
+		@return RouteEntry object, None if there is no default route
+		"""
+		for r in self.getDefaultRoutes():
+			if (r.iface not in exclude):
+				return r
+		return None
+
+	def close(self):
+		"""
+		Stop listening for route changes
+		"""
+		if (self.sock is not None):
+			self.sock.close()
+			self.sock = None
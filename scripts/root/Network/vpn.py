@@ -1,9 +1,14 @@
 import subprocess
+import socket
+import ipaddress
 import logging
 import time
 
 import Network.interface as interface
+import Network.icmp as icmp
+import Network.netlink as netlink
 import Service.service as service
+import Log.metrics as metrics
 
 DOWN = -1
 UP = 0
@@ -12,6 +17,19 @@ KEY_ADDR = 'addr'
 KEY_PEER = 'peer'
 KEY_PING = 'ping'
 
+VPN_CONF_DIR = "/etc/openvpn"
+
+# Default peer probe policy
+PING_COUNT = 5
+PING_MAX_LOSS = 0.5
+PING_MAX_RTT = 0 # ms, 0 to disable
+
+VPN_STARTS = metrics.counter("torrent_vpn_vpn_starts_total", "VPN start attempts by result")
+VPN_START_SECONDS = metrics.histogram("torrent_vpn_vpn_start_seconds", "Time from the VPN service start to a configured tunnel interface (or failure)")
+PEER_RTT = metrics.gauge("torrent_vpn_peer_rtt_ms", "Average round trip time to the tunnel peer in the last probe")
+PEER_RTT_MS = metrics.histogram("torrent_vpn_peer_rtt_distribution_ms", "Average round trip time to the tunnel peer per probe", metrics.MS_BUCKETS)
+PEER_LOSS = metrics.gauge("torrent_vpn_peer_loss_ratio", "Packet loss to the tunnel peer in the last probe (0.0 - 1.0)")
+
 class VPNError(RuntimeError):
 	"""
 	VPN related exception
@@ -41,6 +59,7 @@ class VPN:
 		self.pingOne = pingOne
 		self.ifParams = {}
 		self.verbose = verbose
+		self.prober = None
 
 		try:
 			if (self.initSystem == "openRC"):
@@ -103,23 +122,46 @@ class VPN:
 			self.service.stop() # Make sure service is stopped
 		return DOWN
 
+	def waitForTunnel(self, timeout):
+		"""
+		Wait for the tunnel interface to come up with an address
+		Link/address events are used when available, polling with exponential
+		backoff otherwise.
+		@param timeout Maximum time (in seconds) to wait
+
+		@return True if the tunnel interface has an address
+		"""
+		try:
+			watcher = netlink.LinkWatcher(self.verbose)
+		except netlink.NetlinkError as ne:
+			logging.info("VPN: link events unavailable (%s), polling" % (ne))
+			return service.waitFor(self.vpnIf.hasAddress, timeout)
+		try:
+			return watcher.wait(self.vpnIf.hasAddress, timeout)
+		finally:
+			watcher.close()
+
 	def start(self, ifAttempts = 1, ifWaitTime = 1):
 		"""
 		Start the VPN
+		Returns as soon as the tunnel interface has an address.
+		@param ifAttempts Together with ifWaitTime, limits the time (ifAttempts * ifWaitTime seconds) to wait for the tunnel interface
+		@param ifWaitTime See ifAttempts
 
 		@return UP if VPN is active and functional, DOWN otherwise
 		"""
 		logging.info("VPN: Starting...")
+		startTime = time.monotonic()
 		status = self.service.start(5, 5)
 		if (status == service.RUNNING):
 			logging.info("VPN: Started")
 
-			for cnt in range(0, ifAttempts):
-				ifStatus = self.vpnIf.getStatus()
-				if (ifStatus == interface.UP):
-					return UP
-				else:
-					time.sleep(ifWaitTime)
+			ifStartTime = time.monotonic()
+			if (self.waitForTunnel(ifAttempts * ifWaitTime)):
+				logging.info("VPN: Interface %s configured after %.2f s" % (self.ifId, time.monotonic() - ifStartTime))
+				VPN_STARTS.inc(result = "up")
+				VPN_START_SECONDS.observe(time.monotonic() - startTime, result = "up")
+				return UP
 
 			logging.info("VPN: Interface not available")
 			if (self.verbose):
@@ -133,6 +175,8 @@ class VPN:
 			# entry, stop the service
 			self.service.stop()
 		#self.service.stop()
+		VPN_STARTS.inc(result = "down")
+		VPN_START_SECONDS.observe(time.monotonic() - startTime, result = "down")
 		return
 
 	def stop(self):
@@ -167,19 +211,58 @@ class VPN:
 				print("Reconstituted peer: %s" % reconstPeer)
 			self.ifParams[KEY_PING] = reconstPeer
 
-	def pingPeer(self):
+	def getPingCmd(self):
+		"""
+		Retrieve the command used to ping the tunnel peer
+
+		@return Ping command (list), None if no interface parameters are available
+		"""
+		if (len(self.ifParams) == 0):
+			return None
+		return ["ping", "-c 1", self.ifParams[KEY_PING]]
+
+	def probePeer(self, count = PING_COUNT, timeout = 1.0):
+		"""
+		Send a burst of ICMP echo requests to the tunnel peer (in-process, no fork)
+		@param count Number of echo requests to send
+		@param timeout Time (in seconds) to wait for replies after the last request
+
+		@return icmp.PingStats object, None if no interface parameters are available
+		@throws icmp.IcmpError if no ICMP socket can be opened
+		"""
+		if (len(self.ifParams) == 0):
+			return None
+		if (self.prober is None):
+			self.prober = icmp.IcmpProber(self.verbose)
+		return self.prober.probe(self.ifParams[KEY_PING], count, timeout = timeout)
+
+	def pingPeer(self, count = PING_COUNT, maxLoss = PING_MAX_LOSS, maxRtt = PING_MAX_RTT):
 		"""
 		Ping the tunnel peer
+		A burst of requests is sent, so that a single lost packet does not mark the
+		tunnel as down. Falls back to the ping command if no ICMP socket is available.
+		@param count Number of echo requests to send
+		@param maxLoss Highest acceptable packet loss (fraction, 0.0 - 1.0); any loss above this marks the tunnel as down
+		@param maxRtt Highest acceptable average round trip time in ms (0 to disable)
 
 		@return UP if VPN is active and functional, DOWN otherwise
 		"""
-		if (len(self.ifParams) == 0):
+		cmd = self.getPingCmd()
+		if (cmd is None):
 			logging.info("No interface parameters available")
 			if (self.verbose):
 				print("No interface parameters available")
 			return
 
-		cmd = ["ping", "-c 1", self.ifParams[KEY_PING]]
+		try:
+			stats = self.probePeer(count)
+			return self.evalPing(stats, maxLoss, maxRtt)
+		except icmp.IcmpError as ie:
+			msg = ''.join(ie.args)
+			logging.info("VPN: %s, using ping command" % (msg))
+			if (self.verbose):
+				print("VPN: %s, using ping command" % (msg))
+
 		if (self.verbose):
 			print("Command to execute [%d]: %s" % (len(cmd), cmd))
 		try:
@@ -195,6 +278,59 @@ class VPN:
 			print("Exception Command output:\n%s" % outString)
 			return DOWN
 
+	def evalPing(self, stats, maxLoss = PING_MAX_LOSS, maxRtt = PING_MAX_RTT):
+		"""
+		Apply the probe thresholds to ping statistics
+		@param stats icmp.PingStats object
+		@param maxLoss Highest acceptable packet loss (fraction, 0.0 - 1.0)
+		@param maxRtt Highest acceptable average round trip time in ms (0 to disable)
+
+		@return UP if the statistics are within the thresholds, DOWN otherwise
+		"""
+		if (stats is not None):
+			PEER_LOSS.set(stats.loss)
+			if (stats.received > 0):
+				PEER_RTT.set(stats.rttAvg)
+				PEER_RTT_MS.observe(stats.rttAvg)
+		if ((stats is None) or (stats.received == 0) or (stats.loss > maxLoss)):
+			logging.info("VPN: Peer probe failed (%s)" % (stats))
+			return DOWN
+		if ((maxRtt > 0) and (stats.rttAvg > maxRtt)):
+			logging.info("VPN: Peer probe RTT too high (%s; limit %d ms)" % (stats, maxRtt))
+			return DOWN
+		return UP
+
+	def getServerAddr(self):
+		"""
+		Retrieve the address of the VPN server, from the first "remote" line of
+		the OpenVPN configuration (host names are resolved)
+
+		@return VPN server IPv4 address, None if it cannot be determined
+		"""
+		confFile = "%s/%s.conf" % (VPN_CONF_DIR, self.provider)
+		try:
+			with open(confFile, 'r') as conf:
+				for line in conf:
+					fields = line.split()
+					if ((len(fields) >= 2) and (fields[0] == "remote")):
+						try:
+							return str(ipaddress.IPv4Address(fields[1]))
+						except ValueError:
+							return socket.gethostbyname(fields[1])
+		except (OSError, socket.gaierror) as e:
+			logging.info("VPN: Unable to determine server address from %s: %s" % (confFile, e))
+			if (self.verbose):
+				print("VPN: Unable to determine server address from %s: %s" % (confFile, e))
+		return None
+
+	def getPeer(self):
+		"""
+		Retrieve the VPN tunnel peer (gateway) address
+
+		@return The VPN tunnel peer address
+		"""
+		return self.ifParams[KEY_PEER]
+
 	def getAddr(self):
 		"""
 		Retrieve the VPN tunnel IP address
@@ -23,14 +23,21 @@ VPN_MARK=""
 VPN_TABLE=""
 VPN_USER=""
 
+# Set to skip the rule and route setup (done over netlink by the caller)
+FIREWALL_ONLY=""
+# Set to skip the iptables setup (done with nftables by the caller)
+ROUTES_ONLY=""
+
 function help {
     echo "Usage:"
     echo $0 "[options]"
+    echo "  -f  --firewall-only         Only set up the firewall; rules and routes are set up by the caller"
     echo "  -g  --lan_gw        <arg>   LAN gateway IP"
     echo "  -l  --lan_if        <arg>   LAN interface ID (eg. eth0)"
     echo "  -m  --mark          <arg>   Mark to use for packets matching the routin rule"
     echo "  -n  --lan_nw        <arg>   LAN network (form of <ip>/<prefix length>)"
     echo "  -p  --provider      <arg>   VPN provider"
+    echo "  -r  --routes-only           Only set up rules and routes; the firewall is set up by the caller"
     echo "  -s  --system        <arg>   Init system (eg. OpenRC, systemd)"
     echo "  -t  --table         <arg>   Routing table to use"
     echo "  -u  --user          <arg>   VPN user (eg. transmission)"
@@ -39,7 +46,7 @@ function help {
 }
 
 # Options may be followed by one colon to indicate they have a required argument
-if ! OPTIONS=$(getopt -o g:hl:m:n:p:s:t:u:v: -l lan_gw:,help,lan_if:,mark:,lan_nw:,provider:,system:,table:,user:,vpn_if: -- "$@"); then
+if ! OPTIONS=$(getopt -o fg:hl:m:n:p:rs:t:u:v: -l firewall-only,lan_gw:,help,lan_if:,mark:,lan_nw:,provider:,routes-only,system:,table:,user:,vpn_if: -- "$@"); then
     # Something went wrong, getopt will put out an error message for us
     exit 1
 fi
@@ -48,6 +55,8 @@ set -- $OPTIONS
 
 while [ $# -gt 0 ]; do
     case $1 in
+        -f|--firewall-only) FIREWALL_ONLY=1 ;;
+        -r|--routes-only) ROUTES_ONLY=1 ;;
         # For options with required arguments, an additional shift is required
         -g|--lan_gw) LAN_GW=`echo $2 | tr -d \'` ; shift;;
         -h|--help) help ;;
@@ -126,6 +135,7 @@ else
 	exit 1;
 fi
 
+if [ -z $FIREWALL_ONLY ]; then
 #############################################################################
 # Set up the IP rule (if necessary)
 #############################################################################
@@ -155,6 +165,11 @@ ip route add $LAN_NW dev $LAN_IF table $VPN_TABLE
 
 ip route show table $VPN_TABLE
 ip route flush cache
+fi
+
+if [ -n "$ROUTES_ONLY" ]; then
+	exit 0
+fi
 
 #############################################################################
 # Set up the firewall (iptables) rules
@@ -1,14 +1,61 @@
 '''
 Linux service wrapper and abstraction
 '''
+import os
 import subprocess
 import time
 import logging
 
+import Log.metrics as metrics
+
+try:
+	import dbus
+except ImportError:
+	dbus = None
+
 # Some "Constant" values
 STOPPED = 0
 RUNNING = 1
 
+# Time (in seconds) a retrieved status is reused
+STATUS_CACHE_TIME = 2.0
+
+OPENRC_RUN_DIR = "/run/openrc"
+OPENRC_INIT_DIR = "/etc/init.d"
+
+# cgroup hierarchies systemd places the units in: unified (v2), legacy (v1)
+SYSTEMD_CGROUP_ROOTS = ("/sys/fs/cgroup", "/sys/fs/cgroup/systemd")
+
+SYSTEMD_BUS_NAME = "org.freedesktop.systemd1"
+SYSTEMD_PATH = "/org/freedesktop/systemd1"
+SYSTEMD_MANAGER_IFACE = "org.freedesktop.systemd1.Manager"
+SYSTEMD_UNIT_IFACE = "org.freedesktop.systemd1.Unit"
+DBUS_PROPS_IFACE = "org.freedesktop.DBus.Properties"
+
+SERVICE_ACTIONS = metrics.counter("torrent_vpn_service_actions_total", "Service start/stop requests by service, action and result")
+SERVICE_ACTION_SECONDS = metrics.histogram("torrent_vpn_service_action_seconds", "Time taken by service start/stop requests (including the wait for the running status)")
+
+def waitFor(check, timeout, initialDelay = 0.05, maxDelay = 2.0):
+	"""
+	Poll a condition with exponential backoff
+	@param check Function returning True once the condition is met
+	@param timeout Maximum time (in seconds) to wait
+	@param initialDelay First delay (in seconds) between checks
+	@param maxDelay Largest delay (in seconds) between checks
+
+	@return True if the condition was met, False on timeout
+	"""
+	deadline = time.monotonic() + timeout
+	delay = initialDelay
+	while True:
+		if (check()):
+			return True
+		remaining = deadline - time.monotonic()
+		if (remaining <= 0):
+			return False
+		time.sleep(min(delay, remaining))
+		delay = min(delay * 2, maxDelay)
+
 class ServiceError(RuntimeError):
 	"""
 	Service related exception
@@ -32,6 +79,9 @@ class Service:
 		self.name = name
 		self.initSystem = initSystem
 		self.verbose = verbose
+		self.cachedStatus = None
+		self.cachedTime = 0
+		self.bus = None
 
 		if (self.initSystem == "openRC"):
 			self.OK_STR = "[ ok ]"
@@ -57,7 +107,7 @@ class Service:
 		"""
 		theCmd = ""
 		if (self.initSystem == "openRC"):
-			theCmd = ["/etc/init.d/" + self.name] + [action]
+			theCmd = [os.path.join(OPENRC_INIT_DIR, self.name)] + [action]
 		elif (self.initSystem == "systemd"):
 			theCmd = ["systemctl", action, self.name]
 		else:
@@ -67,9 +117,116 @@ class Service:
 			raise ServiceError("Unsupported init system type: %s" % (self.initSystem))
 		return theCmd
 
-	def getStatus(self):
+	def parseStatus(self, outString):
 		"""
-		Retrieve service status
+		Interpret the output of a (successful) status command
+		@param outString Status command output
+
+		@return RUNNING if service is active, STOPPED otherwise
+		"""
+		if (self.STATUS_STARTED_STR in outString):
+			logging.info("Service: %s status: Running" % (self.name))
+			return RUNNING
+		elif (self.STATUS_STOPPED_STR in outString):
+			logging.info("Service: %s status: Stopped" % (self.name))
+			return STOPPED
+		else:
+			logging.info("Service: %s status: Unknown state" % (self.name))
+			if (self.verbose):
+				print("Unknown state")
+			return STOPPED
+
+	def getUnitName(self):
+		"""
+		Retrieve the systemd unit name of the service
+
+		@return Unit name (with the .service suffix added if no unit type is given)
+		"""
+		if ('.' in self.name):
+			return self.name
+		return self.name + ".service"
+
+	def getStatusMarker(self):
+		"""
+		Retrieve a path that exists while the service runs, so a stopped service can be
+		confirmed with a stat call: the cgroup of the systemd unit, or the OpenRC started marker
+
+		@return Path, None if no such path is available on this system
+		"""
+		if (self.initSystem == "systemd"):
+			unit = self.getUnitName()
+			unitSlice = "system.slice"
+			if ('@' in unit):
+				# Template instances live in a slice of their own, eg system-openvpn.slice
+				unitSlice = os.path.join(unitSlice, "system-%s.slice" % (unit.split('@')[0].replace('-', '\\x2d')))
+			for root in SYSTEMD_CGROUP_ROOTS:
+				if (os.path.isdir(os.path.join(root, "system.slice"))):
+					return os.path.join(root, unitSlice, unit)
+		elif (self.initSystem == "openRC"):
+			if (os.path.isdir(OPENRC_RUN_DIR)):
+				return os.path.join(OPENRC_RUN_DIR, "started", self.name)
+		return None
+
+	def hasNativeStatus(self):
+		"""
+		Test if the status can be retrieved without running a status command
+
+		@return True if a native status backend is available
+		"""
+		if (self.initSystem == "systemd"):
+			return (dbus is not None)
+		elif (self.initSystem == "openRC"):
+			return os.path.isdir(OPENRC_RUN_DIR)
+		return False
+
+	def getStatusSystemd(self):
+		"""
+		Retrieve the service status from systemd over D-Bus
+
+		@return RUNNING or STOPPED, None if D-Bus is not available
+		"""
+		if (dbus is None):
+			return None
+		try:
+			if (self.bus is None):
+				self.bus = dbus.SystemBus()
+			manager = dbus.Interface(self.bus.get_object(SYSTEMD_BUS_NAME, SYSTEMD_PATH), SYSTEMD_MANAGER_IFACE)
+			unit = self.bus.get_object(SYSTEMD_BUS_NAME, manager.LoadUnit(self.getUnitName()))
+			activeState = str(unit.Get(SYSTEMD_UNIT_IFACE, "ActiveState", dbus_interface = DBUS_PROPS_IFACE))
+			subState = str(unit.Get(SYSTEMD_UNIT_IFACE, "SubState", dbus_interface = DBUS_PROPS_IFACE))
+		except dbus.DBusException as de:
+			logging.info("Service: %s D-Bus status error: %s" % (self.name, de))
+			if (self.verbose):
+				print("Service: %s D-Bus status error: %s" % (self.name, de))
+			self.bus = None
+			return None
+
+		if (self.verbose):
+			print("Service: %s state %s (%s)" % (self.name, activeState, subState))
+		# Same condition as the "active (running)" text of systemctl status
+		if ((activeState == "active") and (subState == "running")):
+			logging.info("Service: %s status: Running" % (self.name))
+			return RUNNING
+		logging.info("Service: %s status: Stopped (%s/%s)" % (self.name, activeState, subState))
+		return STOPPED
+
+	def getStatusOpenRC(self):
+		"""
+		Retrieve the service status from the OpenRC state directory
+
+		@return RUNNING or STOPPED, None if the state directory is not available
+		"""
+		if (not os.path.isdir(OPENRC_RUN_DIR)):
+			return None
+		if (os.path.exists(os.path.join(OPENRC_RUN_DIR, "started", self.name))):
+			logging.info("Service: %s status: Running" % (self.name))
+			return RUNNING
+		logging.info("Service: %s status: Stopped" % (self.name))
+		return STOPPED
+
+	def getStatusCmd(self):
+		"""
+		Retrieve service status by running the status command
 
 		@return RUNNING if service is active, STOPPED otherwise
 		"""
@@ -81,17 +238,7 @@ class Service:
 			outString = output.decode("utf-8")
 			if (self.verbose):
 				print("Command output:\n%s" % outString)
-			if (self.STATUS_STARTED_STR in outString):
-				logging.info("Service: %s status: Running" % (self.name))
-				return RUNNING
-			elif (self.STATUS_STOPPED_STR in outString):
-				logging.info("Service: %s status: Stopped" % (self.name))
-				return STOPPED
-			else:
-				logging.info("Service: %s status: Unknown state" % (self.name))
-				if (self.verbose):
-					print("Unknown state")
-				return STOPPED
+			return self.parseStatus(outString)
 		except subprocess.CalledProcessError as cpe:
 			# An exception here does not necessarily mean an error, so don't automatically
 			# print the output
@@ -106,15 +253,68 @@ class Service:
 			print("Service: %s status: Exception occured, assuming Stopped" % (self.name))
 		return STOPPED
 
+	def getStatus(self, maxAge = STATUS_CACHE_TIME):
+		"""
+		Retrieve service status
+		The native backend for the init system is used if available, otherwise
+		the output of the status command is parsed.
+		@param maxAge Maximum age (in seconds) of a cached status that may be returned (0 to always query)
+
+		@return RUNNING if service is active, STOPPED otherwise
+		"""
+		now = time.monotonic()
+		if ((self.cachedStatus is not None) and ((now - self.cachedTime) < maxAge)):
+			return self.cachedStatus
+
+		status = None
+		if (self.initSystem == "systemd"):
+			status = self.getStatusSystemd()
+		elif (self.initSystem == "openRC"):
+			status = self.getStatusOpenRC()
+		if (status is None):
+			status = self.getStatusCmd()
+
+		self.cachedStatus = status
+		self.cachedTime = time.monotonic()
+		return status
+
+	def invalidateStatus(self):
+		"""
+		Forget the cached status (the service state is about to change)
+		"""
+		self.cachedStatus = None
+
+	def recordAction(self, action, success, startTime):
+		"""
+		Update the service action metrics
+		@param action Action name (start/stop)
+		@param success True if the action succeeded
+		@param startTime time.monotonic() value at the start of the action
+		"""
+		SERVICE_ACTIONS.inc(service = self.name, action = action, result = "success" if (success) else "error")
+		SERVICE_ACTION_SECONDS.observe(time.monotonic() - startTime, service = self.name, action = action)
+
 	def start(self, maxAttempts = 1, waitTime = 3):
 		"""
 		Start service
-		@param maxAttempts The maximum number of attempts that should be made to start the service (defaults to 1)
-		@param waitTime The time to wait (in seconds) between failed attempts to avoid false negatives (defaults to 3)
+		@param maxAttempts Together with waitTime, limits the time (maxAttempts * waitTime seconds) to wait for the service to run (defaults to 1)
+		@param waitTime The longest time to wait (in seconds) between status checks (defaults to 3)
+
+		@return RUNNING on successful service start, STOPPED otherwise
+		"""
+		startTime = time.monotonic()
+		status = self.startAndWait(maxAttempts, waitTime)
+		self.recordAction("start", status == RUNNING, startTime)
+		return status
+
+	def startAndWait(self, maxAttempts, waitTime):
+		"""
+		Start the service and wait for it to run (see start())
 
 		@return RUNNING on successful service start, STOPPED otherwise
 		"""
 		cmd = self.getCmd("start")
+		self.invalidateStatus()
 		if (self.verbose):
 			print("Command to execute [%d]: %s" % (len(cmd), cmd))
 		try:
@@ -142,22 +342,21 @@ class Service:
 				if (self.verbose):
 					print("OK string not found")
 				return STOPPED
-		# Here the service have most likely started, but is not yet listed as running
-		for cnt in range(0, maxAttempts):
-			logging.info("Service: %s started, testing status [%d/%d]" % (self.name, cnt, maxAttempts))
+		# Here the service have most likely started, but is not yet listed as running.
+		# systemctl start only returns once the start job completed, so on systemd the
+		# first check normally succeeds; otherwise poll the (cheap) status with
+		# exponential backoff for at most maxAttempts * waitTime seconds
+		logging.info("Service: %s started, waiting for running status (max %d s)" % (self.name, maxAttempts * waitTime))
+		if (self.verbose):
+			print("Waiting for running status (max %d s)" % (maxAttempts * waitTime))
+		if (waitFor(lambda: self.getStatus(0) == RUNNING, maxAttempts * waitTime, maxDelay = waitTime)):
 			if (self.verbose):
-				print("Testing service status [%d/%d]" % (cnt, maxAttempts))
-			status = self.getStatus()
-			if (status == RUNNING):
-				if (self.verbose):
-					print("Start -> status is running")
-				return RUNNING
-			else:
-				time.sleep(waitTime)
+				print("Start -> status is running")
+			return RUNNING
 
-		logging.info("Service: %s not started yet after %d test attempts" % (self.name, maxAttempts))
+		logging.info("Service: %s not started yet after %d s" % (self.name, maxAttempts * waitTime))
 		if (self.verbose):
-			print("Service not started yet after %d test attempts" % (maxAttempts))
+			print("Service not started yet after %d s" % (maxAttempts * waitTime))
 		return STOPPED
 
 	def stop(self):
@@ -165,15 +364,19 @@ class Service:
 		Stop the serivce
 		"""
 		cmd = self.getCmd("stop")
+		self.invalidateStatus()
 		if (self.verbose):
 			print("Command to execute [%d]: %s" % (len(cmd), cmd))
+		startTime = time.monotonic()
 		try:
 			output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
 			#output = subprocess.run(cmd) # python 3.5
+			self.recordAction("stop", True, startTime)
 			if (self.verbose):
 				outString = output.decode("utf-8")
 				print("Command output:\n%s" % outString)
 		except subprocess.CalledProcessError as cpe:
+			self.recordAction("stop", False, startTime)
 			outString = cpe.output.decode("utf-8")
 			logging.info("Service: %s stop error" % (self.name))
 			logging.info("Exception Command output:\n%s" % outString)
@@ -182,3 +385,32 @@ class Service:
 				#print("Exception stderr output:\n%s" % cpe.stderr) # python 3.5
 				print("Exception Command output:\n%s" % outString)
 		return STOPPED
+
+	def reload(self):
+		"""
+		Ask the service to reload its configuration (typically SIGHUP to the daemon)
+
+		@return True if the reload request was accepted, False otherwise
+		"""
+		cmd = self.getCmd("reload")
+		self.invalidateStatus()
+		if (self.verbose):
+			print("Command to execute [%d]: %s" % (len(cmd), cmd))
+		try:
+			output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+			if (self.verbose):
+				outString = output.decode("utf-8")
+				print("Command output:\n%s" % outString)
+		except subprocess.CalledProcessError as cpe:
+			outString = cpe.output.decode("utf-8")
+			logging.info("Service: %s reload error" % (self.name))
+			logging.info("Exception Command output:\n%s" % outString)
+			if (self.verbose):
+				print("Service reload error: %d" % cpe.returncode)
+				print("Exception Command output:\n%s" % outString)
+			return False
+		except OSError as oe:
+			logging.info("Service: %s reload error: %s" % (self.name, oe))
+			return False
+		logging.info("Service: %s reloaded" % (self.name))
+		return True
@@ -0,0 +1,158 @@
+'''
+State snapshot and idle fast path
+Most one-shot (cron) runs have nothing to do: no Flexget window, no torrents,
+VPN and torrent daemon stopped. At the end of every one-shot run the state the
+next run depends on is written to tmpfs: the service states, the VPN and bind
+addresses, and the modification times of the configuration, the daemon
+settings and the torrent directories, plus the paths that must not appear
+(tunnel interface, service status markers, completion spool). When the
+previous run was idle, the next one decides from stat calls alone whether
+anything changed, and if not exits before loading anything else: no
+subprocess is started. The full checks still run once the snapshot is older
+than its revalidation interval.
+This module is imported before the other modules, so it only uses os, json
+and time.
+'''
+import os
+import json
+import time
+
+STATE_FILE = "/dev/shm/torrent_vpn.state.json"
+SNAPSHOT_VERSION = 1
+REVALIDATE = 900 # s, maximum age of a snapshot the fast path trusts
+SYS_NET_DIR = "/sys/class/net"
+
+def flexgetWindow(hour, minute):
+	"""
+	@return True during the Flexget window (the first 5 minutes of every even hour)
+	"""
+	return (((hour % 2) == 0) and (minute < 5))
+
+def mtimeNs(path):
+	"""
+	@return Modification time (in ns) of a file or directory, None if it does not exist
+	"""
+	try:
+		return os.stat(path).st_mtime_ns
+	except OSError:
+		return None
+
+class StateSnapshot:
+	"""
+	State recorded at the end of a one-shot run
+	"""
+	def __init__(self, argv, revalidate = REVALIDATE):
+		"""
+		Constructor
+		@param argv Command line arguments of the run (without the program name)
+		@param revalidate Time (in seconds) the snapshot may be used for
+		"""
+		self.argv = list(argv)
+		self.cwd = os.getcwd()
+		self.revalidate = revalidate
+		self.validated = time.time()
+		self.idle = False
+		self.services = {}
+		self.vpnAddr = None
+		self.bindIp = None
+		self.mtimes = {}
+		self.absent = []
+
+	def watch(self, path):
+		"""
+		Record the modification time of a file or directory (a change ends the fast path)
+		@param path Path to watch
+		"""
+		path = os.path.abspath(path)
+		self.mtimes[path] = mtimeNs(path)
+
+	def requireAbsent(self, path):
+		"""
+		Record a path that does not exist (its appearance ends the fast path)
+		@param path Path to watch
+		"""
+		self.absent.append(os.path.abspath(path))
+
+	def changed(self):
+		"""
+		@return Description of the first change since the snapshot was taken, None if nothing changed
+		"""
+		for path, mtime in self.mtimes.items():
+			if (mtimeNs(path) != mtime):
+				return "%s changed" % (path)
+		for path in self.absent:
+			if (os.path.lexists(path)):
+				return "%s exists" % (path)
+		return None
+
+	def save(self):
+		"""
+		Write the snapshot (atomically)
+
+		@throws OSError if the snapshot cannot be written
+		"""
+		tmpFile = "%s.%d.tmp" % (STATE_FILE, os.getpid())
+		try:
+			with open(tmpFile, 'w') as f:
+				json.dump({"version": SNAPSHOT_VERSION, "argv": self.argv, "cwd": self.cwd, "revalidate": self.revalidate,
+						   "validated": self.validated, "idle": self.idle, "services": self.services,
+						   "vpnAddr": self.vpnAddr, "bindIp": self.bindIp, "mtimes": self.mtimes,
+						   "absent": self.absent}, f, sort_keys = True)
+			os.replace(tmpFile, STATE_FILE)
+		except OSError:
+			try:
+				os.unlink(tmpFile)
+			except OSError:
+				pass
+			raise
+
+	@classmethod
+	def load(cls):
+		"""
+		Read the snapshot of the previous run
+
+		@return StateSnapshot object, None if there is no (usable) snapshot
+		"""
+		try:
+			with open(STATE_FILE, 'r') as f:
+				content = json.load(f)
+			if (content.get("version") != SNAPSHOT_VERSION):
+				return None
+			snap = cls(content["argv"], content["revalidate"])
+			for key in ("cwd", "validated", "idle", "services", "vpnAddr", "bindIp", "mtimes", "absent"):
+				setattr(snap, key, content[key])
+		except (OSError, ValueError, KeyError, TypeError, AttributeError):
+			return None
+		return snap
+
+def discard():
+	"""
+	Remove the snapshot (the next run does the full checks)
+	"""
+	try:
+		os.unlink(STATE_FILE)
+	except OSError:
+		pass
+
+def idleFastPath(argv):
+	"""
+	Decide, from the snapshot of the previous run, that there is nothing to do
+	@param argv Command line arguments (without the program name)
+
+	@return True if the run can end here
+	"""
+	snap = StateSnapshot.load()
+	if ((snap is None) or (not snap.idle) or (snap.argv != list(argv)) or (snap.cwd != os.getcwd())):
+		return False
+	now = time.time()
+	age = now - snap.validated
+	if ((age < 0) or (age >= snap.revalidate)):
+		return False
+	local = time.localtime(now)
+	if (flexgetWindow(local.tm_hour, local.tm_min)):
+		return False
+	if (snap.changed() is not None):
+		return False
+	if (("-v" in argv) or ("--verbose" in argv)):
+		print("Idle: nothing changed since the checks %d s ago, nothing to do" % (age))
+	return True
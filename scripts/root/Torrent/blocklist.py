@@ -0,0 +1,308 @@
+'''
+Transmission blocklist updater
+Downloads the iblocklist lists concurrently, only when they changed on the
+server (ETag/If-Modified-Since), decompresses them while downloading and
+swaps each one in atomically. The daemon is only asked to reload its
+blocklists (SIGHUP) when the merged content of all lists changed.
+
+Usage: PYTHONPATH=<scripts/root> python3 -m Torrent.blocklist [options] <blocklist dir>
+'''
+import os
+import sys
+import pwd
+import grp
+import json
+import zlib
+import getopt
+import hashlib
+import logging
+import urllib.request
+import urllib.error
+import concurrent.futures
+
+import Service.service as service
+import Torrent.iprange as iprange
+
+LOG_FILE = "/dev/shm/update_blocklist.log"
+
+BLOCKLISTS = ["level1", "level2", "level3", "templist", "ads", "rangetest", "spyware", "hijacked"]
+URL_TEMPLATE = "http://list.iblocklist.com/?list=bt_%s&fileformat=p2p&archiveformat=gz"
+
+STATE_FILE = ".update_state.json"
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 60 # s
+
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+class BlocklistError(RuntimeError):
+	"""
+	Blocklist related exception
+	"""
+	def __init__(self, arg):
+		self.args = arg
+
+def loadState(blocklistDir):
+	"""
+	Read the validators (ETag/Last-Modified) and merged hash of the previous update
+	@param blocklistDir Blocklist directory
+
+	@return State dictionary
+	"""
+	try:
+		with open(os.path.join(blocklistDir, STATE_FILE), 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def saveState(blocklistDir, state):
+	"""
+	Write the update state (atomically)
+	@param blocklistDir Blocklist directory
+	@param state State dictionary
+	"""
+	path = os.path.join(blocklistDir, STATE_FILE)
+	with open(path + ".tmp", 'w') as f:
+		json.dump(state, f, indent = 1, sort_keys = True)
+	os.replace(path + ".tmp", path)
+
+def fetchList(name, url, blocklistDir, validators, owner = None, timeout = TIMEOUT):
+	"""
+	Download a single list if it changed on the server
+	The response is decompressed while it is received, into a temporary file
+	that replaces the list (and its stale compiled .bin) only once complete.
+	@param name List name (file name in the blocklist directory)
+	@param url Download URL (gzip compressed p2p list)
+	@param blocklistDir Blocklist directory
+	@param validators Dictionary with the "etag"/"lastModified" of the current file (may be empty)
+	@param owner Tuple of (uid, gid) to give the new file, None to keep the default
+
+	@return Tuple of (UPDATED/UNCHANGED/FAILED, new validators dictionary)
+	"""
+	path = os.path.join(blocklistDir, name)
+	request = urllib.request.Request(url)
+	if (os.path.exists(path)):
+		if (validators.get("etag")):
+			request.add_header("If-None-Match", validators["etag"])
+		if (validators.get("lastModified")):
+			request.add_header("If-Modified-Since", validators["lastModified"])
+
+	tmpPath = path + ".tmp"
+	try:
+		with urllib.request.urlopen(request, timeout = timeout) as response:
+			# wbits 16 + MAX_WBITS: expect a gzip header
+			decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			size = 0
+			with open(tmpPath, 'wb') as f:
+				while True:
+					chunk = response.read(CHUNK_SIZE)
+					if (not chunk):
+						break
+					data = decomp.decompress(chunk)
+					f.write(data)
+					size += len(data)
+				data = decomp.flush()
+				f.write(data)
+				size += len(data)
+				if (not decomp.eof):
+					raise BlocklistError("truncated gzip stream")
+				if (size == 0):
+					raise BlocklistError("empty list")
+				f.flush()
+				os.fsync(f.fileno())
+			newValidators = {"etag": response.headers.get("ETag"), "lastModified": response.headers.get("Last-Modified")}
+		os.chmod(tmpPath, 0o644)
+		if (owner is not None):
+			os.chown(tmpPath, owner[0], owner[1])
+		os.replace(tmpPath, path)
+	except urllib.error.HTTPError as he:
+		if (he.code == 304):
+			logging.info("Blocklist: %s not modified" % (name))
+			return UNCHANGED, validators
+		logging.info("Blocklist: %s download failed: HTTP %d" % (name, he.code))
+		return FAILED, validators
+	except (urllib.error.URLError, OSError, zlib.error, BlocklistError) as e:
+		logging.info("Blocklist: %s download failed: %s" % (name, e))
+		try:
+			os.unlink(tmpPath)
+		except OSError:
+			pass
+		return FAILED, validators
+
+	# Transmission keeps a compiled copy next to each list
+	try:
+		os.unlink(path + ".bin")
+	except FileNotFoundError:
+		pass
+	logging.info("Blocklist: %s updated (%d bytes)" % (name, size))
+	return UPDATED, newValidators
+
+def mergedHash(blocklistDir, names):
+	"""
+	Hash the content of all lists (in a fixed order)
+	@param blocklistDir Blocklist directory
+	@param names List names
+
+	@return Hex SHA256 digest
+	"""
+	digest = hashlib.sha256()
+	for name in sorted(names):
+		try:
+			with open(os.path.join(blocklistDir, name), 'rb') as f:
+				digest.update(name.encode("utf-8") + b"\0")
+				while True:
+					chunk = f.read(CHUNK_SIZE)
+					if (not chunk):
+						break
+					digest.update(chunk)
+		except FileNotFoundError:
+			continue
+	return digest.hexdigest()
+
+def updateBlocklists(blocklistDir, names = BLOCKLISTS, urlTemplate = URL_TEMPLATE, owner = None, jobs = None, timeout = TIMEOUT, verbose = False):
+	"""
+	Update all lists concurrently
+	@param blocklistDir Blocklist directory
+	@param names List names
+	@param urlTemplate Download URL with a %s for the list name
+	@param owner Tuple of (uid, gid) to give new files, None to keep the default
+	@param jobs Maximum number of concurrent downloads (defaults to one per list)
+	@param timeout Time (in seconds) to wait for each server response
+	@param verbose Indicate whether or not verbose mode should be used
+
+	@return Tuple of (dictionary of list name -> UPDATED/UNCHANGED/FAILED, merged content hash, True if the merged
+			content changed since it was last applied); the hash is only stored by saveMergedHash, once applied
+	"""
+	state = loadState(blocklistDir)
+	lists = state.setdefault("lists", {})
+	results = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers = jobs or len(names)) as executor:
+		futures = {}
+		for name in names:
+			futures[executor.submit(fetchList, name, urlTemplate % (name), blocklistDir, lists.get(name, {}), owner, timeout)] = name
+		for future in concurrent.futures.as_completed(futures):
+			name = futures[future]
+			results[name], lists[name] = future.result()
+			if (verbose):
+				print("%s: %s" % (name, results[name]))
+
+	digest = mergedHash(blocklistDir, names)
+	changed = (digest != state.get("mergedHash"))
+	saveState(blocklistDir, state)
+	return results, digest, changed
+
+def saveMergedHash(blocklistDir, digest):
+	"""
+	Record the merged content hash once the lists were merged and the daemon reloaded,
+	so a failed merge or reload is done again by the next update
+	@param blocklistDir Blocklist directory
+	@param digest Merged content hash (from updateBlocklists)
+	"""
+	state = loadState(blocklistDir)
+	state["mergedHash"] = digest
+	saveState(blocklistDir, state)
+
+def printUsage(appName):
+	"""
+	Print script usage
+	"""
+	print("\nUsage: %s [options] <blocklist dir>" % appName)
+	print("Available Options:")
+	print("  -h | --help                            This help message")
+	print("  -d | --daemon-name   <name>            Torrent daemon service to reload (defaults to transmission)")
+	print("  -i | --init-system   <init system>     Init system: systemd (default) or openRC")
+	print("  -m | --merge-to      <list file>       Merge all lists into this single list (for the daemon's blocklist dir;")
+	print("                                         the blocklist dir then only holds the sources)")
+	print("  -n | --no-reload                       Never reload the daemon (eg when the merged list is enforced by nftables)")
+	print("  -o | --owner         <user:group>      Owner of the list files (defaults to transmission:users)")
+	print("  -v | --verbose                         Enable verbose mode")
+	sys.exit()
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hd:i:m:no:v", ["help","daemon-name=","init-system=","merge-to=","no-reload","owner=","verbose"])
+	except getopt.GetoptError as goe:
+		print(goe)
+		printUsage(sys.argv[0])
+
+	daemonName = "transmission"
+	initSystem = "systemd"
+	ownerSpec = "transmission:users"
+	mergeTo = None
+	reload = True
+	verbose = False
+	for opt, arg in opts:
+		if opt in ("-h", "--help"):
+			printUsage(sys.argv[0])
+		elif opt in ("-d", "--daemon-name"):
+			daemonName = arg
+		elif opt in ("-i", "--init-system"):
+			initSystem = arg
+		elif opt in ("-m", "--merge-to"):
+			mergeTo = arg
+		elif opt in ("-n", "--no-reload"):
+			reload = False
+		elif opt in ("-o", "--owner"):
+			ownerSpec = arg
+		elif opt in ("-v", "--verbose"):
+			verbose = True
+	if (len(args) != 1):
+		printUsage(sys.argv[0])
+	blocklistDir = args[0]
+
+	logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s %(message)s')
+	logging.info("===== Update Transmission blocklists - Start =====")
+
+	owner = None
+	if (os.geteuid() == 0):
+		try:
+			user, group = ownerSpec.split(':')
+			owner = (pwd.getpwnam(user).pw_uid, grp.getgrnam(group).gr_gid)
+		except (ValueError, KeyError) as e:
+			logging.info("Blocklist: unknown owner %s (%s), keeping default ownership" % (ownerSpec, e))
+
+	if (not os.path.isdir(blocklistDir)):
+		logging.info("Blocklist: unable to access %s, aborting" % (blocklistDir))
+		print("Unable to access %s" % (blocklistDir))
+		sys.exit(1)
+
+	results, digest, changed = updateBlocklists(blocklistDir, owner = owner, verbose = verbose)
+	failed = [n for n in results if results[n] == FAILED]
+	logging.info("Blocklist: %d updated, %d unchanged, %d failed" % (
+		list(results.values()).count(UPDATED), list(results.values()).count(UNCHANGED), len(failed)))
+
+	if (changed and (mergeTo is not None)):
+		try:
+			ranges = iprange.RangeSet.fromFiles([os.path.join(blocklistDir, n) for n in BLOCKLISTS if os.path.exists(os.path.join(blocklistDir, n))])
+			ranges.write(mergeTo)
+			if (owner is not None):
+				os.chown(mergeTo, owner[0], owner[1])
+			try:
+				os.unlink(mergeTo + ".bin")
+			except FileNotFoundError:
+				pass
+		except OSError as oe:
+			logging.info("Blocklist: unable to merge the lists into %s: %s, retrying on the next update" % (mergeTo, oe))
+			print("Unable to merge the lists into %s: %s" % (mergeTo, oe))
+			sys.exit(1)
+		logging.info("Blocklist: %d ranges merged into %d (%d bytes saved)" % (ranges.inputCount, len(ranges), ranges.memorySaved()))
+
+	if (changed and (not reload)):
+		logging.info("Blocklist: merged content changed, not reloading %s (disabled)" % (daemonName))
+	elif (changed):
+		logging.info("Blocklist: merged content changed, reloading %s" % (daemonName))
+		daemon = service.Service(daemonName, initSystem, verbose)
+		if ((daemon.getStatus() == service.RUNNING) and (not daemon.reload())):
+			logging.info("Blocklist: unable to reload %s, retrying on the next update" % (daemonName))
+			print("Unable to reload %s" % (daemonName))
+			sys.exit(1)
+	else:
+		logging.info("Blocklist: merged content unchanged, not reloading %s" % (daemonName))
+	if (changed):
+		saveMergedHash(blocklistDir, digest)
+	logging.info("=====  Update Transmission blocklists - End  =====")
+	sys.exit(1 if (len(failed) == len(results)) else 0)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,142 @@
+'''
+Completion spool
+Transmission's done-script (scripts/transmission/torrent-clean.sh) only appends
+the hash of each finished torrent to a spool file. The orchestrator takes the
+queued hashes in batches, once no new completion arrived for a short window,
+and removes each batch with a single torrent-remove RPC. A failed batch is
+retried after an increasing delay, and given up after a few attempts.
+'''
+import os
+import time
+import threading
+import logging
+
+SPOOL_FILE = "/dev/shm/torrent_vpn.completed"
+BATCH_WINDOW = 2.0 # s without new completions before a batch is taken
+MAX_ATTEMPTS = 5 # failed removals of a batch before it is given up
+RETRY_DELAY = 5.0 # s before the first retry of a failed batch (doubled after each failure)
+
+class CompletionSpool:
+	"""
+	Append-only spool of finished torrent hashes
+
+	Taking a batch renames the spool away (the done-script then starts a new
+	one) into a work file, which is only deleted once the batch was handled,
+	so a failed batch is retried together with the next one. The failed
+	attempts and the time of the last one are kept in a file as well (one-shot
+	runs do not share memory). Within a process, lock is held while a batch is
+	taken and handled (the check cycle and the daemon's completion loop both
+	drain the spool).
+	"""
+	def __init__(self, spoolFile = SPOOL_FILE, window = BATCH_WINDOW, verbose = False, maxAttempts = MAX_ATTEMPTS, retryDelay = RETRY_DELAY):
+		"""
+		Constructor
+		@param spoolFile File the done-script appends to
+		@param window Time (in seconds) without new entries before a batch is ready
+		@param verbose Indicate whether or not verbose mode should be used
+		@param maxAttempts Failed removals of a batch before it is given up
+		@param retryDelay Time (in seconds) before the first retry of a failed batch
+		"""
+		self.spoolFile = spoolFile
+		self.workFile = spoolFile + ".work"
+		self.attemptsFile = spoolFile + ".attempts"
+		self.window = window
+		self.verbose = verbose
+		self.maxAttempts = maxAttempts
+		self.retryDelay = retryDelay
+		self.lock = threading.Lock()
+
+	def isReady(self):
+		"""
+		Check whether a batch should be taken (cheap: at most two stats, unless a batch failed)
+
+		@return True if entries are queued and the spool was quiet for the batch window,
+				or if a failed batch is due for its retry
+		"""
+		if (os.path.exists(self.workFile)):
+			return self.isRetryDue()
+		try:
+			st = os.stat(self.spoolFile)
+		except FileNotFoundError:
+			return False
+		return (st.st_size > 0) and ((time.time() - st.st_mtime) >= self.window)
+
+	def isRetryDue(self):
+		"""
+		Check whether the work file's batch may be retried: the delay after the
+		last failure doubles with each failed attempt
+
+		@return True if the batch never failed or its retry delay has passed
+		"""
+		attempts, lastFailure = self.readAttempts()
+		if (attempts == 0):
+			return True
+		return (time.time() - lastFailure) >= self.retryDelay * (2 ** (attempts - 1))
+
+	def readAttempts(self):
+		"""
+		@return Tuple of (number of failed attempts, time of the last failure) of the work file's batch
+		"""
+		try:
+			with open(self.attemptsFile, 'r') as f:
+				fields = f.read().split()
+			return int(fields[0]), float(fields[1])
+		except (OSError, ValueError, IndexError):
+			return 0, 0.0
+
+	def take(self):
+		"""
+		Move the queued entries into the work file
+
+		@return Sorted list of unique torrent hashes in the work file
+		"""
+		batchFile = "%s.%d" % (self.spoolFile, os.getpid())
+		try:
+			os.rename(self.spoolFile, batchFile)
+			with open(batchFile, 'r') as f:
+				data = f.read()
+			with open(self.workFile, 'a') as f:
+				f.write(data)
+			os.unlink(batchFile)
+		except FileNotFoundError:
+			pass
+
+		try:
+			with open(self.workFile, 'r') as f:
+				hashes = sorted(set(line.strip() for line in f if line.strip()))
+		except FileNotFoundError:
+			return []
+		if (self.verbose):
+			print("Completion: %d torrents queued" % (len(hashes)))
+		return hashes
+
+	def commit(self):
+		"""
+		Drop the work file once its batch was handled
+		"""
+		for path in (self.workFile, self.attemptsFile):
+			try:
+				os.unlink(path)
+			except FileNotFoundError:
+				pass
+
+	def fail(self):
+		"""
+		Record a failed removal of the work file's batch (delaying its retry); the
+		batch is dropped once it failed maxAttempts times
+
+		@return True if the batch was given up, False if it will be retried
+		"""
+		attempts = self.readAttempts()[0] + 1
+		if (attempts >= self.maxAttempts):
+			logging.info("Completion: giving up on the queued torrents after %d failed attempts" % (attempts))
+			if (self.verbose):
+				print("Completion: giving up after %d failed attempts" % (attempts))
+			self.commit()
+			return True
+		try:
+			with open(self.attemptsFile, 'w') as f:
+				f.write("%d %f\n" % (attempts, time.time()))
+		except OSError as oe:
+			logging.info("Completion: unable to write %s: %s" % (self.attemptsFile, oe))
+		return False
@@ -0,0 +1,375 @@
+'''
+Flexget runner
+Running Flexget from scratch means a login shell for the VPN user, a Python
+interpreter, loading all plugins and opening the Flexget database, every time.
+With the daemon enabled, a long-lived "flexget daemon" is kept running under
+the VPN user, and executions are handed to it over its IPC channel (rpyc on
+localhost; port and password are read from the lock file in the Flexget config
+directory), so a run only costs the feed work. The daemon is (re)started when
+it is not running or its config.yml changed. Whenever the daemon cannot be
+used (no rpyc, daemon does not come up, IPC failure) Flexget is started
+directly, as before (--cron, so without console output).
+The per-task summaries are taken from the console output the daemon sends
+back (at verbose level), or for a direct run from the lines it added to
+flexget.log (--cron keeps an explicit --loglevel verbose for the log file).
+'''
+import os
+import re
+import shlex
+import signal
+import subprocess
+import tempfile
+import logging
+
+try:
+	import rpyc
+except ImportError:
+	rpyc = None
+
+import Service.service as service
+import Log.trace as trace
+
+# Lock file Flexget writes next to config.yml ("PID", and for a daemon "port"/"password")
+LOCK_FILE = ".config-lock"
+CONFIG_FILE = "config.yml"
+LOG_FILE = "flexget.log"
+
+# Replies of the daemon's IPC authenticator (flexget/ipc.py)
+AUTH_SUCCESS = b"authentication success"
+AUTH_ERROR = b"authentication error"
+IPC_HOST = "127.0.0.1"
+IPC_CONNECT_TIMEOUT = 5 # s
+
+DAEMON_START_TIMEOUT = 60 # s, for the daemon to load its plugins and open its IPC port
+DAEMON_STOP_TIMEOUT = 30 # s
+RUN_TIMEOUT = 900 # s, for a single execution
+
+METHOD_IPC = "ipc"
+METHOD_EXEC = "exec"
+
+RESULT_SUCCESS = "success"
+RESULT_ERROR = "error"
+RESULT_TIMEOUT = "timeout"
+
+# Verbose level task summary (details plugin) and task abort messages; the task name precedes the message
+SUMMARY_RE = re.compile(r"(?P<task>\S+)\s+Summary - Accepted: (?P<accepted>\d+) \(Rejected: (?P<rejected>\d+) Undecided: (?P<undecided>\d+) Failed: (?P<failed>\d+)\)")
+ABORT_RE = re.compile(r"(?P<task>\S+)\s+Aborting task")
+# The scheduler of the daemon must be off: tasks may only run when the VPN is up
+SCHEDULES_OFF_RE = re.compile(r"^schedules:\s*(no|false|off)\s*(#.*)?$", re.IGNORECASE | re.MULTILINE)
+
+class FlexgetError(RuntimeError):
+	"""
+	Flexget related exception
+	"""
+	def __init__(self, arg):
+		self.args = arg
+
+def readLock(lockFile):
+	"""
+	Read a Flexget lock file
+	@param lockFile Path of the lock file
+
+	@return Dictionary of the (lower case) keys, with numerical values as int; None if there is no valid lock
+	"""
+	try:
+		with open(lockFile, 'r', encoding = "utf-8") as f:
+			lines = f.readlines()
+	except OSError:
+		return None
+	lock = {}
+	for line in lines:
+		key, sep, value = line.partition(":")
+		if (not sep):
+			continue
+		value = value.strip()
+		lock[key.strip().lower()] = int(value) if value.isdigit() else value
+	if (not lock.get("pid")):
+		return None
+	return lock
+
+def processAlive(pid):
+	"""
+	@return True if a process with the given PID exists
+	"""
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+def parseTasks(output):
+	"""
+	Extract the per-task results from Flexget console output
+	@param output Console output (verbose level)
+
+	@return Dictionary of task name -> {"accepted", "rejected", "undecided", "failed": counts, "aborted": bool}
+	"""
+	tasks = {}
+	for match in SUMMARY_RE.finditer(output):
+		counts = tasks.setdefault(match.group("task"), {"aborted": False})
+		for key in ("accepted", "rejected", "undecided", "failed"):
+			counts[key] = int(match.group(key))
+	for match in ABORT_RE.finditer(output):
+		counts = tasks.setdefault(match.group("task"), {"accepted": 0, "rejected": 0, "undecided": 0, "failed": 0})
+		counts["aborted"] = True
+	return tasks
+
+class FlexgetRun:
+	"""
+	Outcome of a Flexget execution
+	"""
+	def __init__(self, method, result, output, returnCode = None, log = ""):
+		"""
+		Constructor
+		@param method How Flexget was run (METHOD_IPC or METHOD_EXEC)
+		@param result RESULT_SUCCESS, RESULT_ERROR or RESULT_TIMEOUT
+		@param output Captured console output
+		@param returnCode Exit code of a directly started Flexget
+		@param log Lines a directly started Flexget added to its log file
+		"""
+		self.method = method
+		self.result = result
+		self.output = output
+		self.returnCode = returnCode
+		self.log = log
+		self.tasks = parseTasks(output + "\n" + log)
+
+def clientService(lines):
+	"""
+	@return rpyc service class handing the console output of the daemon to a list of lines
+	"""
+	class ClientService(rpyc.Service):
+		def exposed_console(self, text, *args, **kwargs):
+			lines.append(str(text))
+
+		def exposed_terminal_info(self):
+			return {"size": (160, 50), "isatty": False}
+
+	return ClientService
+
+class Flexget:
+	"""
+	Runs Flexget for the VPN user, through its daemon if enabled
+	"""
+	def __init__(self, flexgetBin, user, configDir, useDaemon = False, timeout = RUN_TIMEOUT, verbose = False):
+		"""
+		Constructor
+		@param flexgetBin Flexget binary
+		@param user User to run Flexget as
+		@param configDir Flexget configuration directory (holding config.yml)
+		@param useDaemon Indicate whether executions should be handed to a Flexget daemon
+		@param timeout Maximum time (in seconds) a single execution may take
+		@param verbose Indicate whether or not verbose mode should be used
+		"""
+		self.flexgetBin = flexgetBin
+		self.user = user
+		self.lockFile = os.path.join(configDir, LOCK_FILE)
+		self.configFile = os.path.join(configDir, CONFIG_FILE)
+		self.logFile = os.path.join(configDir, LOG_FILE)
+		self.useDaemon = useDaemon
+		self.timeout = timeout
+		self.verbose = verbose
+
+	def command(self, args):
+		"""
+		@return Command running Flexget with the given arguments as the VPN user
+		"""
+		flexgetCmd = shlex.join([self.flexgetBin] + list(args))
+		return ["su", "-l", self.user, "-s", "/bin/bash", "-c", flexgetCmd]
+
+	def daemonLock(self):
+		"""
+		@return Lock of a running daemon that has its IPC port open, None if there is none
+		"""
+		lock = readLock(self.lockFile)
+		if ((lock is None) or (not lock.get("port")) or (not processAlive(lock["pid"]))):
+			return None
+		return lock
+
+	def daemonStart(self):
+		"""
+		Start the daemon (detached) and wait for its IPC port
+
+		@throws FlexgetError if the daemon does not come up
+		"""
+		try:
+			with open(self.configFile, 'r', encoding = "utf-8") as f:
+				schedulesOff = (SCHEDULES_OFF_RE.search(f.read()) is not None)
+		except OSError as oe:
+			raise FlexgetError("unable to read %s: %s" % (self.configFile, oe))
+		if (not schedulesOff):
+			raise FlexgetError("%s does not disable the daemon scheduler (schedules: no)" % (self.configFile))
+
+		logging.info("Flexget: starting daemon")
+		if (self.verbose):
+			print("Starting Flexget daemon")
+		# Output goes to a file: a pipe would be held open by the detached daemon
+		with tempfile.TemporaryFile() as outFile:
+			try:
+				subprocess.run(self.command(["daemon", "start", "-d"]), stdout = outFile, stderr = subprocess.STDOUT,
+							   timeout = DAEMON_START_TIMEOUT, check = True)
+			except subprocess.CalledProcessError as cpe:
+				outFile.seek(0)
+				raise FlexgetError("daemon start failed (%d): %s" % (cpe.returncode, outFile.read().decode("utf-8", "replace").strip()))
+			except (OSError, subprocess.TimeoutExpired) as e:
+				raise FlexgetError("daemon start failed: %s" % (e))
+		if (not service.waitFor(lambda: self.daemonLock() is not None, DAEMON_START_TIMEOUT)):
+			raise FlexgetError("daemon did not open its IPC port within %d s" % (DAEMON_START_TIMEOUT))
+
+	def daemonStop(self):
+		"""
+		Stop a running daemon (SIGTERM)
+
+		@return True if no daemon is running (anymore), False otherwise
+		"""
+		lock = readLock(self.lockFile)
+		if ((lock is None) or (not processAlive(lock["pid"]))):
+			return True
+		logging.info("Flexget: stopping daemon (PID %d)" % (lock["pid"]))
+		try:
+			os.kill(lock["pid"], signal.SIGTERM)
+		except ProcessLookupError:
+			return True
+		return service.waitFor(lambda: not processAlive(lock["pid"]), DAEMON_STOP_TIMEOUT)
+
+	def daemonEnsure(self):
+		"""
+		Make sure a daemon with the current configuration is running
+
+		@return Lock of the running daemon
+		@throws FlexgetError if no daemon could be started
+		"""
+		lock = self.daemonLock()
+		if (lock is not None):
+			try:
+				# The lock file is written when the daemon opens its IPC port
+				if (os.stat(self.configFile).st_mtime > os.stat(self.lockFile).st_mtime):
+					logging.info("Flexget: %s changed, restarting daemon" % (self.configFile))
+					if (not self.daemonStop()):
+						raise FlexgetError("daemon did not stop within %d s" % (DAEMON_STOP_TIMEOUT))
+					lock = None
+			except OSError:
+				pass
+		if (lock is None):
+			self.daemonStart()
+			lock = self.daemonLock()
+			if (lock is None):
+				raise FlexgetError("daemon stopped right after its start")
+		return lock
+
+	def runIpc(self, args):
+		"""
+		Hand an execution to the daemon (started if needed) and wait for it
+		@param args Flexget command line arguments
+
+		@return FlexgetRun object
+		@throws FlexgetError if the daemon cannot be used
+		"""
+		if (rpyc is None):
+			raise FlexgetError("the rpyc module is not available")
+		lock = self.daemonEnsure()
+		lines = []
+		try:
+			channel = rpyc.Channel(rpyc.SocketStream.connect(IPC_HOST, lock["port"], timeout = IPC_CONNECT_TIMEOUT))
+			channel.send(str(lock.get("password", "")).encode("utf-8"))
+			if (channel.recv() != AUTH_SUCCESS):
+				channel.close()
+				raise FlexgetError("IPC authentication failed")
+			conn = rpyc.connect_channel(channel, service = clientService(lines), config = {"sync_request_timeout": self.timeout})
+		except (OSError, EOFError) as e:
+			raise FlexgetError("unable to connect to the daemon on port %s: %s" % (lock["port"], e))
+
+		try:
+			conn.root.handle_cli(list(args))
+			result = RESULT_SUCCESS
+		except rpyc.AsyncResultTimeout:
+			# The daemon carries on with it; a next execution is queued behind it
+			lines.append("Execution did not complete within %d s" % (self.timeout))
+			result = RESULT_TIMEOUT
+		except (OSError, EOFError) as e:
+			lines.append("Connection to the daemon lost: %s" % (e))
+			result = RESULT_ERROR
+		except Exception as e:
+			# Remote exceptions are raised again locally
+			lines.append("Daemon error: %s" % (e))
+			result = RESULT_ERROR
+		finally:
+			conn.close()
+		return FlexgetRun(METHOD_IPC, result, "\n".join(lines))
+
+	def logSize(self):
+		"""
+		@return Current size of the Flexget log file (0 if it does not exist)
+		"""
+		try:
+			return os.stat(self.logFile).st_size
+		except OSError:
+			return 0
+
+	def readLog(self, offset):
+		"""
+		Read what was added to the Flexget log file
+		@param offset Size of the log file before the run (the whole file is read if it was rotated since)
+
+		@return Added text
+		"""
+		try:
+			with open(self.logFile, 'rb') as f:
+				if (os.fstat(f.fileno()).st_size >= offset):
+					f.seek(offset)
+				return f.read().decode("utf-8", "replace")
+		except OSError:
+			return ""
+
+	def runExec(self, args):
+		"""
+		Start Flexget directly and wait for it (it is killed, including its children, on timeout)
+		@param args Flexget command line arguments
+
+		@return FlexgetRun object
+		"""
+		logOffset = self.logSize()
+		cmd = self.command(args)
+		with trace.commandSpan(cmd):
+			try:
+				proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, start_new_session = True)
+			except OSError as oe:
+				return FlexgetRun(METHOD_EXEC, RESULT_ERROR, "Unable to start Flexget: %s" % (oe))
+			try:
+				output, _ = proc.communicate(timeout = self.timeout)
+			except subprocess.TimeoutExpired:
+				try:
+					os.killpg(proc.pid, signal.SIGKILL)
+				except OSError:
+					pass
+				output, _ = proc.communicate()
+				output = output + (b"\nKilled after %d s" % (self.timeout))
+				return FlexgetRun(METHOD_EXEC, RESULT_TIMEOUT, output.decode("utf-8", "replace"), proc.returncode,
+								  self.readLog(logOffset))
+		result = RESULT_SUCCESS if (proc.returncode == 0) else RESULT_ERROR
+		return FlexgetRun(METHOD_EXEC, result, output.decode("utf-8", "replace"), proc.returncode, self.readLog(logOffset))
+
+	def run(self, testMode = False):
+		"""
+		Execute all Flexget tasks
+		Test mode runs are never handed to the daemon (--test applies to a whole Flexget process).
+		Through the daemon the execution is not started with --cron: the daemon only
+		waits for a non-cron execution, and sends its console output back.
+		@param testMode Indicate whether Flexget should run in test mode
+
+		@return FlexgetRun object
+		"""
+		if ((self.useDaemon) and (not testMode)):
+			try:
+				return self.runIpc(["--loglevel", "verbose", "execute"])
+			except FlexgetError as fe:
+				msg = ''.join(fe.args)
+				logging.info("Flexget: daemon not usable (%s), running Flexget directly" % (msg))
+				if (self.verbose):
+					print("Flexget daemon not usable (%s), running Flexget directly" % (msg))
+		if (testMode):
+			return self.runExec(["--test", "execute"])
+		# --cron only lowers the log level when none was given
+		return self.runExec(["--loglevel", "verbose", "--cron", "execute"])
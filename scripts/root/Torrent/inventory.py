@@ -0,0 +1,331 @@
+'''
+Incremental inventory of the torrent files in the Flexget/Transmission directories
+'''
+import os
+import time
+import struct
+import ctypes
+import ctypes.util
+import threading
+import logging
+
+SUFFIX_TORRENT = ".torrent"
+SUFFIX_ADDED = ".added"
+SUFFIX_DEFERRED = ".deferred" # Held back (eg not enough disk space), hidden from the watch-dir scan
+SUFFIX_REJECTED = ".rejected"
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE |
+			  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HDR = struct.Struct("iIII")
+
+class Inotify:
+	"""
+	Minimal ctypes based inotify wrapper (only what the inventory needs)
+	"""
+	def __init__(self):
+		"""
+		Constructor
+
+		@throws OSError if inotify is not available on this system
+		"""
+		libName = ctypes.util.find_library("c") or "libc.so.6"
+		self.libc = ctypes.CDLL(libName, use_errno = True)
+		if (not hasattr(self.libc, "inotify_init1")):
+			raise OSError("inotify not supported by %s" % (libName))
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if (self.fd < 0):
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+
+	def addWatch(self, path, mask = WATCH_MASK):
+		"""
+		Watch a directory
+		@param path Directory to watch
+		@param mask inotify event mask
+
+		@return Watch descriptor
+		@throws OSError if the watch could not be added
+		"""
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if (wd < 0):
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err), path)
+		return wd
+
+	def readEvents(self):
+		"""
+		Read all currently queued events without blocking
+
+		@return List of (wd, mask, name) tuples
+		"""
+		events = []
+		while True:
+			try:
+				buf = os.read(self.fd, 64 * 1024)
+			except BlockingIOError:
+				break
+			if (not buf):
+				break
+			offset = 0
+			while (offset + EVENT_HDR.size <= len(buf)):
+				wd, mask, cookie, nameLen = EVENT_HDR.unpack_from(buf, offset)
+				offset += EVENT_HDR.size
+				name = os.fsdecode(buf[offset:offset + nameLen].rstrip(b"\0"))
+				offset += nameLen
+				events.append((wd, mask, name))
+		return events
+
+	def close(self):
+		"""
+		Release the inotify file descriptor
+		"""
+		if (self.fd >= 0):
+			os.close(self.fd)
+			self.fd = -1
+
+class WatchedDir:
+	"""
+	Set of (interesting) file names in a single directory
+	"""
+	def __init__(self, path, suffixes):
+		"""
+		Constructor
+		@param path Directory path
+		@param suffixes Tuple of file name suffixes to track
+		"""
+		self.path = path
+		self.suffixes = suffixes
+		self.names = set()
+		self.wd = -1
+		self.mtimeNs = None
+		self.racy = True
+
+	def wants(self, name):
+		"""
+		Test if a file name should be tracked
+		@param name File name (without directory)
+
+		@return True if the name has one of the tracked suffixes
+		"""
+		return name.endswith(self.suffixes)
+
+	def scan(self):
+		"""
+		Rebuild the name set from the directory contents
+		"""
+		try:
+			before = os.stat(self.path).st_mtime_ns
+			with os.scandir(self.path) as it:
+				self.names = set(e.name for e in it if self.wants(e.name))
+		except FileNotFoundError:
+			self.names = set()
+			self.mtimeNs = None
+			self.racy = True
+			return
+		self.mtimeNs = before
+		# Timestamps of some file systems are coarse: if the directory changed
+		# within the same second as the scan, a later change might not move the
+		# mtime, so scan again next time (same approach as git's "racy" index)
+		self.racy = ((before // 1000000000) >= (time.time_ns() // 1000000000) - 1)
+
+	def scanIfChanged(self):
+		"""
+		Rescan the directory only if its mtime moved since the previous scan
+
+		@return True if the directory was rescanned
+		"""
+		try:
+			mtimeNs = os.stat(self.path).st_mtime_ns
+		except FileNotFoundError:
+			mtimeNs = None
+		if ((mtimeNs != self.mtimeNs) or self.racy):
+			self.scan()
+			return True
+		return False
+
+class TorrentInventory:
+	"""
+	Keeps track of the pending (AddedPath/*.torrent), processed (AddedPath/*.added),
+	deferred (AddedPath/*.deferred) and active (ActivePath/*.torrent) torrent files.
+
+	When inotify is available, the directories are scanned once and then kept up
+	to date from the inotify events. Otherwise each refresh only rescans the
+	directories whose mtime changed.
+	"""
+	def __init__(self, addedPath, activePath, useInotify = True, verbose = False):
+		"""
+		Constructor
+		@param addedPath Directory Flexget drops new torrent files into (Transmission watch-dir)
+		@param activePath Directory Transmission keeps the active torrent files in
+		@param useInotify Use inotify to track changes (falls back to mtime checks if unavailable)
+		@param verbose Indicate whether or not verbose mode should be used
+		"""
+		self.verbose = verbose
+		self.lock = threading.Lock()
+		self.added = WatchedDir(addedPath, (SUFFIX_TORRENT, SUFFIX_ADDED, SUFFIX_DEFERRED))
+		self.active = WatchedDir(activePath, (SUFFIX_TORRENT,))
+		self.dirs = [self.added, self.active]
+		self.inotify = None
+
+		if (useInotify):
+			try:
+				self.inotify = Inotify()
+				for d in self.dirs:
+					d.wd = self.inotify.addWatch(d.path)
+			except OSError as oe:
+				logging.info("Inventory: inotify unavailable (%s), falling back to mtime checks" % (oe))
+				if (self.verbose):
+					print("Inventory: inotify unavailable (%s), falling back to mtime checks" % (oe))
+				if (self.inotify is not None):
+					self.inotify.close()
+				self.inotify = None
+
+		for d in self.dirs:
+			d.scan()
+
+	def fileno(self):
+		"""
+		Retrieve the file descriptor that becomes readable when a watched directory changes
+
+		@return inotify file descriptor, or None if inotify is not in use
+		"""
+		if (self.inotify is None):
+			return None
+		return self.inotify.fd
+
+	def processEvents(self):
+		"""
+		Apply queued inotify events to the inventory
+
+		@return True if a new pending torrent appeared, False otherwise
+		"""
+		newPending = False
+		with self.lock:
+			if (self.inotify is None):
+				return False
+			for wd, mask, name in self.inotify.readEvents():
+				if (mask & IN_Q_OVERFLOW):
+					logging.info("Inventory: inotify queue overflow, rescanning")
+					for d in self.dirs:
+						d.scan()
+					newPending = True
+					continue
+
+				d = next((x for x in self.dirs if x.wd == wd), None)
+				if (d is None):
+					continue
+
+				if (mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED)):
+					# The directory itself went away; try to re-establish the watch
+					logging.info("Inventory: %s removed or moved, re-adding watch" % (d.path))
+					try:
+						d.wd = self.inotify.addWatch(d.path)
+					except OSError:
+						d.wd = -1
+					d.scan()
+					continue
+
+				if ((not name) or (not d.wants(name))):
+					continue
+
+				if (mask & (IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO)):
+					d.names.add(name)
+					# Only report a torrent as new once its content has been written
+					if ((d is self.added) and name.endswith(SUFFIX_TORRENT) and (mask & (IN_CLOSE_WRITE | IN_MOVED_TO))):
+						newPending = True
+				elif (mask & (IN_DELETE | IN_MOVED_FROM)):
+					d.names.discard(name)
+
+		if (newPending and self.verbose):
+			print("Inventory: new pending torrent detected")
+		return newPending
+
+	def refresh(self):
+		"""
+		Bring the inventory up to date
+		"""
+		if (self.inotify is not None):
+			self.processEvents()
+		with self.lock:
+			for d in self.dirs:
+				# Directories without a (working) watch fall back to mtime checks
+				if ((d.wd < 0) and d.scanIfChanged() and self.verbose):
+					print("Inventory: %s changed, rescanned" % (d.path))
+
+	def getPending(self):
+		"""
+		@return Sorted list of torrent files waiting to be picked up by the client
+		"""
+		self.refresh()
+		with self.lock:
+			return sorted(n for n in self.added.names if n.endswith(SUFFIX_TORRENT))
+
+	def getAdded(self):
+		"""
+		@return Sorted list of torrent files already consumed (renamed to .added) by the client
+		"""
+		self.refresh()
+		with self.lock:
+			return sorted(n for n in self.added.names if n.endswith(SUFFIX_ADDED))
+
+	def getDeferred(self):
+		"""
+		@return Sorted list of torrent files held back from the client
+		"""
+		self.refresh()
+		with self.lock:
+			return sorted(n for n in self.added.names if n.endswith(SUFFIX_DEFERRED))
+
+	def getActive(self):
+		"""
+		@return Sorted list of torrent files the client is working on
+		"""
+		self.refresh()
+		with self.lock:
+			return sorted(self.active.names)
+
+	def removeAdded(self, name):
+		"""
+		Delete a consumed torrent file (renamed by the client, or added over RPC) and drop it from the inventory
+		@param name File name (without directory)
+		"""
+		os.remove(os.path.join(self.added.path, name))
+		with self.lock:
+			self.added.names.discard(name)
+
+	def renameAdded(self, name, newName):
+		"""
+		Rename a file in the added directory and update the inventory
+		@param name File name (without directory)
+		@param newName New file name (without directory)
+		"""
+		os.rename(os.path.join(self.added.path, name), os.path.join(self.added.path, newName))
+		with self.lock:
+			self.added.names.discard(name)
+			if (self.added.wants(newName)):
+				self.added.names.add(newName)
+
+	def close(self):
+		"""
+		Stop watching the directories
+		"""
+		with self.lock:
+			if (self.inotify is not None):
+				self.inotify.close()
+				self.inotify = None
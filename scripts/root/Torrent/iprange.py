@@ -0,0 +1,216 @@
+'''
+Merged IPv4 range index for p2p format blocklists
+The lists overlap heavily; their ranges are merged (overlapping and adjacent
+ranges joined) into two sorted arrays of range starts and ends, which take 8
+bytes per range and are searched with bisect.
+
+Usage: PYTHONPATH=<scripts/root> python3 -m Torrent.iprange compile <output list> <list>...
+       PYTHONPATH=<scripts/root> python3 -m Torrent.iprange check <list> <ip>...
+'''
+import os
+import sys
+import time
+import array
+import bisect
+import socket
+import struct
+import logging
+
+ADDR = struct.Struct("!I")
+
+# Size of one range in Transmission's compiled (.bin) blocklists
+TR_RANGE_SIZE = 8
+
+def addrToInt(addr):
+	"""
+	@return Integer value of a dotted quad IPv4 address
+	@throws OSError (socket.error) on an invalid address
+	"""
+	return ADDR.unpack(socket.inet_aton(addr))[0]
+
+def intToAddr(value):
+	"""
+	@return Dotted quad IPv4 address of an integer value
+	"""
+	return socket.inet_ntoa(ADDR.pack(value))
+
+def parseP2pLine(line):
+	"""
+	Parse one line of a p2p format list ("<description>:<first ip>-<last ip>")
+	@param line Line text
+
+	@return Tuple of (start, end) integers, None for comments, empty or malformed lines
+	"""
+	line = line.strip()
+	if ((not line) or line.startswith('#')):
+		return None
+	# The description may itself contain colons
+	desc, sep, addrs = line.rpartition(':')
+	first, sep, last = addrs.partition('-')
+	if (not sep):
+		return None
+	try:
+		start = addrToInt(first.strip())
+		end = addrToInt(last.strip())
+	except OSError:
+		return None
+	if (start > end):
+		start, end = end, start
+	return start, end
+
+class RangeSet:
+	"""
+	Sorted, merged set of IPv4 ranges
+	"""
+	def __init__(self, starts = None, ends = None):
+		"""
+		Constructor
+		@param starts array('I') of range starts (sorted, non overlapping)
+		@param ends array('I') of the matching range ends (inclusive)
+		"""
+		self.starts = starts if (starts is not None) else array.array('I')
+		self.ends = ends if (ends is not None) else array.array('I')
+		self.inputCount = len(self.starts)
+
+	@classmethod
+	def fromRanges(cls, ranges):
+		"""
+		Build a merged set from arbitrary (possibly overlapping) ranges
+		@param ranges Iterable of (start, end) integer tuples
+
+		@return RangeSet object
+		"""
+		ranges = sorted(ranges)
+		starts = array.array('I')
+		ends = array.array('I')
+		for start, end in ranges:
+			# Join ranges that overlap or touch the previous one
+			if (ends and (start <= ends[-1] + 1)):
+				if (end > ends[-1]):
+					ends[-1] = end
+			else:
+				starts.append(start)
+				ends.append(end)
+		result = cls(starts, ends)
+		result.inputCount = len(ranges)
+		return result
+
+	@classmethod
+	def fromFiles(cls, paths):
+		"""
+		Build a merged set from p2p format list files
+		@param paths List file paths
+
+		@return RangeSet object
+		"""
+		ranges = []
+		for path in paths:
+			with open(path, 'r', encoding = "latin-1") as f:
+				for line in f:
+					r = parseP2pLine(line)
+					if (r is not None):
+						ranges.append(r)
+		return cls.fromRanges(ranges)
+
+	def __len__(self):
+		return len(self.starts)
+
+	def contains(self, addr):
+		"""
+		Test whether an address is in one of the ranges
+		@param addr Dotted quad address or integer value
+
+		@return True if the address is listed
+		"""
+		if (isinstance(addr, str)):
+			addr = addrToInt(addr)
+		idx = bisect.bisect_right(self.starts, addr) - 1
+		return ((idx >= 0) and (addr <= self.ends[idx]))
+
+	def containsMany(self, addrs):
+		"""
+		Test a batch of addresses
+		@param addrs Iterable of dotted quad addresses or integer values
+
+		@return List of booleans, in the order of addrs
+		"""
+		return [self.contains(a) for a in addrs]
+
+	def addressCount(self):
+		"""
+		@return Number of addresses covered by the ranges
+		"""
+		return sum(self.ends) - sum(self.starts) + len(self.starts)
+
+	def memorySaved(self):
+		"""
+		@return Bytes Transmission saves by loading the merged ranges instead of every input range
+		"""
+		return (self.inputCount - len(self)) * TR_RANGE_SIZE
+
+	def write(self, path, description = "merged"):
+		"""
+		Write the ranges as a single p2p format list (atomically)
+		@param path Output file path
+		@param description Description used for every range
+		"""
+		tmpPath = path + ".tmp"
+		with open(tmpPath, 'w') as f:
+			for start, end in zip(self.starts, self.ends):
+				f.write("%s:%s-%s\n" % (description, intToAddr(start), intToAddr(end)))
+			f.flush()
+			os.fsync(f.fileno())
+		os.chmod(tmpPath, 0o644)
+		os.replace(tmpPath, path)
+		logging.info("Blocklist: wrote %d merged ranges to %s" % (len(self), path))
+
+def printUsage(appName):
+	"""
+	Print script usage
+	"""
+	print("\nUsage: %s compile <output list> <list>..." % appName)
+	print("       %s check <list> <ip>..." % appName)
+	print("check exits with 1 if an address is listed, 2 on invalid input")
+	sys.exit()
+
+def main():
+	if ((len(sys.argv) < 4) or (sys.argv[1] not in ("compile", "check"))):
+		printUsage(sys.argv[0])
+
+	if (sys.argv[1] == "compile"):
+		startTime = time.monotonic()
+		try:
+			ranges = RangeSet.fromFiles(sys.argv[3:])
+			ranges.write(sys.argv[2])
+		except OSError as oe:
+			print("Error: %s" % (oe))
+			sys.exit(2)
+		print("Input ranges:    %d" % (ranges.inputCount))
+		print("Merged ranges:   %d" % (len(ranges)))
+		print("Addresses:       %d" % (ranges.addressCount()))
+		print("Index memory:    %d bytes" % (ranges.starts.itemsize * len(ranges) * 2))
+		print("Memory saved:    %d bytes (in the daemon, vs. loading every input range)" % (ranges.memorySaved()))
+		print("Compile time:    %.3f s" % (time.monotonic() - startTime))
+	else:
+		try:
+			ranges = RangeSet.fromFiles([sys.argv[2]])
+		except OSError as oe:
+			print("Error: %s" % (oe))
+			sys.exit(2)
+		addrs = sys.argv[3:]
+		for addr in addrs:
+			try:
+				addrToInt(addr)
+			except OSError:
+				print("Error: invalid IPv4 address %s" % (addr))
+				sys.exit(2)
+		startTime = time.perf_counter()
+		results = ranges.containsMany(addrs)
+		elapsed = time.perf_counter() - startTime
+		for addr, listed in zip(addrs, results):
+			print("%s: %s" % (addr, "listed" if listed else "not listed"))
+		print("%d lookups in %.1f us" % (len(addrs), elapsed * 1e6))
+		sys.exit(1 if any(results) else 0)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,313 @@
+'''
+Torrent metainfo (.torrent) reader and infohash index
+Only the top level "info" dictionary is looked at: its raw byte range is
+hashed for the infohash and just the name and size related keys are decoded
+(the large "pieces" string is skipped, not copied). Files are mapped rather
+than read, so only the pages that are scanned or hashed are loaded.
+'''
+import os
+import json
+import mmap
+import hashlib
+import logging
+
+INDEX_VERSION = 1
+HASH_CHUNK = 64 * 1024 # Bytes of the info dictionary hashed at a time
+
+class BencodeError(RuntimeError):
+	"""
+	Malformed bencoded data
+	"""
+	def __init__(self, arg):
+		self.args = arg
+
+def find(data, sub, offset):
+	"""
+	@return Offset of the first occurrence of sub at or after offset (bytes and mmap alike)
+	@throws ValueError if there is none
+	"""
+	idx = data.find(sub, offset)
+	if (idx < 0):
+		raise ValueError("%r not found" % (sub))
+	return idx
+
+def skipValue(data, offset):
+	"""
+	Skip over a bencoded value without decoding it
+	@param data Bencoded bytes (or mmap)
+	@param offset Offset of the value
+
+	@return Offset of the first byte after the value
+	@throws BencodeError on malformed data
+	"""
+	try:
+		c = data[offset]
+		if (c == 0x69): # i<number>e
+			return find(data, b"e", offset) + 1
+		if ((c == 0x6c) or (c == 0x64)): # l<values>e, d<key><value>...e
+			offset += 1
+			while (data[offset] != 0x65):
+				offset = skipValue(data, offset)
+			return offset + 1
+		colon = find(data, b":", offset) # <length>:<bytes>
+		end = colon + 1 + int(data[offset:colon])
+		if (end > len(data)):
+			raise BencodeError("Truncated string at offset %d" % (offset))
+		return end
+	except BencodeError:
+		raise
+	except (IndexError, ValueError):
+		raise BencodeError("Malformed value at offset %d" % (offset))
+
+def decodeValue(data, offset):
+	"""
+	Decode a bencoded value
+	@param data Bencoded bytes (or mmap)
+	@param offset Offset of the value
+
+	@return Tuple of (value, offset of the first byte after the value)
+	@throws BencodeError on malformed data
+	"""
+	try:
+		c = data[offset]
+		if (c == 0x69):
+			end = find(data, b"e", offset)
+			return int(data[offset + 1:end]), end + 1
+		if (c == 0x6c):
+			values = []
+			offset += 1
+			while (data[offset] != 0x65):
+				value, offset = decodeValue(data, offset)
+				values.append(value)
+			return values, offset + 1
+		if (c == 0x64):
+			values = {}
+			offset += 1
+			while (data[offset] != 0x65):
+				key, offset = decodeValue(data, offset)
+				values[key], offset = decodeValue(data, offset)
+			return values, offset + 1
+		colon = find(data, b":", offset)
+		end = colon + 1 + int(data[offset:colon])
+		if (end > len(data)):
+			raise BencodeError("Truncated string at offset %d" % (offset))
+		return data[colon + 1:end], end
+	except BencodeError:
+		raise
+	except (IndexError, ValueError):
+		raise BencodeError("Malformed value at offset %d" % (offset))
+
+def iterDict(data, offset):
+	"""
+	Walk the entries of a bencoded dictionary without decoding the values
+	@param data Bencoded bytes (or mmap)
+	@param offset Offset of the dictionary
+
+	@return Generator of (key, value offset, value end offset) tuples
+	@throws BencodeError on malformed data
+	"""
+	if ((offset >= len(data)) or (data[offset] != 0x64)):
+		raise BencodeError("Dictionary expected at offset %d" % (offset))
+	offset += 1
+	while True:
+		if (offset >= len(data)):
+			raise BencodeError("Truncated dictionary")
+		if (data[offset] == 0x65):
+			return
+		key, offset = decodeValue(data, offset)
+		end = skipValue(data, offset)
+		yield key, offset, end
+		offset = end
+
+class TorrentMeta:
+	"""
+	The parts of a torrent's metainfo the orchestrator needs
+	"""
+	def __init__(self, infohash, name, totalSize):
+		"""
+		Constructor
+		@param infohash Hex SHA1 of the bencoded info dictionary
+		@param name Torrent name
+		@param totalSize Total size (in bytes) of the torrent's files
+		"""
+		self.infohash = infohash
+		self.name = name
+		self.totalSize = totalSize
+
+	def __str__(self):
+		return "%s %s (%d bytes)" % (self.infohash, self.name, self.totalSize)
+
+def sumFileLengths(data, offset):
+	"""
+	Add up the lengths in an info dictionary's "files" list, decoding only the
+	"length" values (not the paths)
+	@param data Bencoded bytes (or mmap)
+	@param offset Offset of the files list
+
+	@return Total length
+	@throws BencodeError on malformed data
+	"""
+	if ((offset >= len(data)) or (data[offset] != 0x6c)):
+		raise BencodeError("Malformed files list")
+	total = 0
+	offset += 1
+	while True:
+		if (offset >= len(data)):
+			raise BencodeError("Truncated files list")
+		if (data[offset] == 0x65):
+			return total
+		length = None
+		for key, valStart, valEnd in iterDict(data, offset):
+			if (key == b"length"):
+				length = decodeValue(data, valStart)[0]
+		offset = skipValue(data, offset)
+		if (not isinstance(length, int)):
+			raise BencodeError("Malformed files list")
+		total += length
+
+def infoHash(data, start, end):
+	"""
+	@return Hex SHA1 of a byte range, hashed a chunk at a time (no copy of the whole range)
+	"""
+	digest = hashlib.sha1()
+	for pos in range(start, end, HASH_CHUNK):
+		digest.update(data[pos:min(pos + HASH_CHUNK, end)])
+	return digest.hexdigest()
+
+def parseMetainfo(data):
+	"""
+	Extract the infohash, name and total size from metainfo
+	@param data Content of a .torrent file (bytes or mmap)
+
+	@return TorrentMeta object
+	@throws BencodeError on malformed metainfo
+	"""
+	for key, start, end in iterDict(data, 0):
+		if (key == b"info"):
+			break
+	else:
+		raise BencodeError("No info dictionary")
+
+	name = ""
+	length = None
+	filesStart = None
+	for key, valStart, valEnd in iterDict(data, start):
+		if (key == b"name"):
+			name = decodeValue(data, valStart)[0].decode("utf-8", "replace")
+		elif (key == b"length"):
+			length = decodeValue(data, valStart)[0]
+		elif (key == b"files"):
+			filesStart = valStart
+
+	if (length is None):
+		if (filesStart is None):
+			raise BencodeError("No length or files in info dictionary")
+		length = sumFileLengths(data, filesStart)
+	return TorrentMeta(infoHash(data, start, end), name, length)
+
+def readMetainfo(path):
+	"""
+	Read the metainfo of a .torrent file
+	@param path File path
+
+	@return TorrentMeta object
+	@throws BencodeError on malformed metainfo, OSError if the file cannot be read
+	"""
+	with open(path, 'rb') as f:
+		try:
+			data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		except ValueError:
+			raise BencodeError("Empty file")
+		with data:
+			return parseMetainfo(data)
+
+class TorrentIndex:
+	"""
+	Persistent path -> metainfo index
+	Files are only parsed when their mtime or size changed since they were last
+	indexed, so an unchanged directory costs one stat per file.
+	"""
+	def __init__(self, indexFile, verbose = False):
+		"""
+		Constructor
+		@param indexFile File the index is kept in
+		@param verbose Indicate whether or not verbose mode should be used
+		"""
+		self.indexFile = indexFile
+		self.verbose = verbose
+		self.entries = {}
+		self.dirty = False
+		try:
+			with open(indexFile, 'r') as f:
+				content = json.load(f)
+			if (content.get("version") == INDEX_VERSION):
+				self.entries = content.get("entries", {})
+		except (OSError, ValueError, AttributeError) as e:
+			logging.info("Index: starting a new index (%s)" % (e))
+
+	def update(self, directory, names):
+		"""
+		Bring the entries of a directory up to date
+		@param directory Directory path
+		@param names File names (without directory) currently in the directory
+
+		@return Dictionary of file name -> TorrentMeta object (None for unreadable files)
+		"""
+		metas = {}
+		parsed = 0
+		for name in names:
+			path = os.path.join(directory, name)
+			try:
+				st = os.stat(path)
+			except FileNotFoundError:
+				continue
+			entry = self.entries.get(path)
+			if ((entry is None) or (entry[0] != st.st_mtime_ns) or (entry[1] != st.st_size)):
+				try:
+					meta = readMetainfo(path)
+					entry = [st.st_mtime_ns, st.st_size, meta.infohash, meta.name, meta.totalSize]
+				except (BencodeError, OSError) as e:
+					# Possibly still being written; retried once the mtime moves
+					logging.info("Index: unable to parse %s: %s" % (path, e))
+					entry = [st.st_mtime_ns, st.st_size, None, None, None]
+				self.entries[path] = entry
+				self.dirty = True
+				parsed += 1
+			metas[name] = None if (entry[2] is None) else TorrentMeta(entry[2], entry[3], entry[4])
+
+		# Forget files that disappeared from the directory
+		prefix = os.path.join(directory, "")
+		stale = [p for p in self.entries if (p.startswith(prefix) and (os.path.basename(p) not in metas))]
+		for p in stale:
+			del self.entries[p]
+			self.dirty = True
+
+		if (self.verbose):
+			print("Index: %s: %d files, %d parsed, %d dropped" % (directory, len(metas), parsed, len(stale)))
+		return metas
+
+	def rename(self, oldPath, newPath):
+		"""
+		Carry an entry over to a renamed file (rename keeps the mtime, so no reparse is needed)
+		@param oldPath Previous file path
+		@param newPath New file path
+		"""
+		entry = self.entries.pop(oldPath, None)
+		if (entry is not None):
+			self.entries[newPath] = entry
+			self.dirty = True
+
+	def save(self):
+		"""
+		Write the index back (atomically), if it changed
+		"""
+		if (not self.dirty):
+			return
+		tmpFile = self.indexFile + ".tmp"
+		try:
+			with open(tmpFile, 'w') as f:
+				json.dump({"version": INDEX_VERSION, "entries": self.entries}, f)
+			os.replace(tmpFile, self.indexFile)
+			self.dirty = False
+		except OSError as oe:
+			logging.info("Index: unable to save %s: %s" % (self.indexFile, oe))
@@ -0,0 +1,356 @@
+'''
+Transmission daemon helpers
+Reads and atomically rewrites settings.json, checks which address the daemon's
+peer port is listening on (from /proc/net/tcp, without forking) and talks to
+the daemon over its JSON RPC interface.
+'''
+import os
+import json
+import base64
+import socket
+import struct
+import http.client
+import threading
+import logging
+
+KEY_BIND_IPV4 = "bind-address-ipv4"
+KEY_PEER_PORT = "peer-port"
+KEY_PEER_PORT_RANDOM = "peer-port-random-on-start"
+
+KEY_RPC_BIND_ADDRESS = "rpc-bind-address"
+KEY_RPC_PORT = "rpc-port"
+KEY_RPC_URL = "rpc-url"
+KEY_RPC_AUTH_REQUIRED = "rpc-authentication-required"
+KEY_RPC_USERNAME = "rpc-username"
+
+DEFAULT_PEER_PORT = 51413
+DEFAULT_RPC_PORT = 9091
+DEFAULT_RPC_URL = "/transmission/"
+
+SESSION_ID_HEADER = "X-Transmission-Session-Id"
+
+# Torrent status values (tr_torrent_activity)
+STATUS_STOPPED = 0
+STATUS_CHECK_WAIT = 1
+STATUS_CHECK = 2
+STATUS_DOWNLOAD_WAIT = 3
+STATUS_DOWNLOAD = 4
+STATUS_SEED_WAIT = 5
+STATUS_SEED = 6
+
+# Fields needed to decide whether a torrent still needs the daemon
+ACTIVITY_FIELDS = ["id", "status", "percentDone", "rateDownload", "isFinished"]
+
+PROC_NET_TCP = "/proc/net/tcp"
+TCP_LISTEN = 0x0a
+
+class TransmissionError(RuntimeError):
+	"""
+	Transmission related exception
+	"""
+	def __init__(self, arg):
+		self.args = arg
+
+def loadSettings(configFile):
+	"""
+	Read the daemon settings
+	@param configFile Path of settings.json
+
+	@return Settings dictionary
+	@throws TransmissionError if the file cannot be read or parsed
+	"""
+	try:
+		with open(configFile, 'r') as f:
+			return json.load(f)
+	except OSError as oe:
+		raise TransmissionError("Unable to read %s: %s" % (configFile, oe))
+	except ValueError as ve:
+		raise TransmissionError("Unable to parse %s: %s" % (configFile, ve))
+
+def saveSettings(configFile, settings):
+	"""
+	Write the daemon settings atomically (temporary file, fsync, rename)
+	The owner and mode of the existing file are kept, as the daemon runs as its own user.
+	@param configFile Path of settings.json
+	@param settings Settings dictionary
+
+	@throws TransmissionError if the file cannot be written
+	"""
+	tmpFile = configFile + ".tmp"
+	try:
+		st = os.stat(configFile)
+		fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, st.st_mode & 0o7777)
+		try:
+			os.fchown(fd, st.st_uid, st.st_gid)
+			with os.fdopen(fd, 'w') as f:
+				fd = None
+				# Same layout as the daemon writes itself
+				json.dump(settings, f, indent = 4, sort_keys = True)
+				f.write("\n")
+				f.flush()
+				os.fsync(f.fileno())
+		finally:
+			if (fd is not None):
+				os.close(fd)
+		os.replace(tmpFile, configFile)
+		dirFd = os.open(os.path.dirname(os.path.abspath(configFile)), os.O_RDONLY)
+		try:
+			os.fsync(dirFd)
+		finally:
+			os.close(dirFd)
+	except OSError as oe:
+		try:
+			os.unlink(tmpFile)
+		except OSError:
+			pass
+		raise TransmissionError("Unable to write %s: %s" % (configFile, oe))
+
+def getListeningAddrs(port = None, procFile = PROC_NET_TCP):
+	"""
+	Retrieve the local addresses of listening IPv4 TCP sockets
+	@param port Only return sockets listening on this port (None for all)
+	@param procFile TCP socket table to parse
+
+	@return Set of (address, port) tuples
+	"""
+	addrs = set()
+	with open(procFile, 'r') as f:
+		next(f) # Column header
+		for line in f:
+			fields = line.split()
+			if ((len(fields) < 4) or (int(fields[3], 16) != TCP_LISTEN)):
+				continue
+			hexAddr, hexPort = fields[1].split(':')
+			localPort = int(hexPort, 16)
+			if ((port is None) or (localPort == port)):
+				addrs.add((socket.inet_ntoa(struct.pack("=I", int(hexAddr, 16))), localPort))
+	return addrs
+
+def isPeerPortBound(settings, addr):
+	"""
+	Check whether the daemon's peer port listens on a given address
+	@param settings Settings dictionary (for the peer port)
+	@param addr IPv4 address the peer port should be bound to
+
+	@return True if a listening socket on addr (and the peer port, unless it is random) exists
+	"""
+	if (settings.get(KEY_PEER_PORT_RANDOM, False)):
+		port = None
+	else:
+		port = settings.get(KEY_PEER_PORT, DEFAULT_PEER_PORT)
+	try:
+		return any(a == addr for a, p in getListeningAddrs(port))
+	except OSError as oe:
+		logging.info("Transmission: unable to read listening sockets: %s" % (oe))
+		return False
+
+def isTorrentActive(torrent):
+	"""
+	Decide whether a torrent still needs the daemon (and the tunnel)
+	@param torrent Torrent dictionary with the ACTIVITY_FIELDS
+
+	@return True if the torrent is downloading, queued, being checked or seeding
+			towards its limits, False if it is paused or finished
+	"""
+	if (torrent.get("rateDownload", 0) > 0):
+		return True
+	if (torrent.get("isFinished", False) or (torrent.get("status") == STATUS_STOPPED)):
+		return False
+	return True
+
+class RpcClient:
+	"""
+	Transmission JSON RPC client
+	Keeps one HTTP connection open and reuses the session id until the daemon
+	rejects it (HTTP 409). Calls from several threads are serialised.
+	"""
+	def __init__(self, host = "127.0.0.1", port = DEFAULT_RPC_PORT, path = DEFAULT_RPC_URL + "rpc",
+				 username = None, password = None, timeout = 5.0, verbose = False):
+		"""
+		Constructor
+		@param host Address of the daemon's RPC interface
+		@param port RPC port
+		@param path RPC URL path
+		@param username RPC user name (None if authentication is not required)
+		@param password RPC password
+		@param timeout Time (in seconds) to wait for the daemon
+		@param verbose Indicate whether or not verbose mode should be used
+		"""
+		self.host = host
+		self.port = port
+		self.path = path
+		self.timeout = timeout
+		self.verbose = verbose
+		self.conn = None
+		self.sessionId = None
+		self.lock = threading.Lock()
+		self.headers = {"Content-Type": "application/json"}
+		if (username is not None):
+			token = base64.b64encode(("%s:%s" % (username, password or "")).encode("utf-8")).decode("ascii")
+			self.headers["Authorization"] = "Basic " + token
+
+	@classmethod
+	def fromSettings(cls, settings, password = None, username = None, timeout = 5.0, verbose = False):
+		"""
+		Create a client for the RPC interface described by the daemon settings
+		settings.json only holds a hash of the RPC password, so the password must be supplied.
+		@param settings Settings dictionary
+		@param password RPC password (only used if authentication is required)
+		@param username RPC user name (defaults to rpc-username)
+		@param timeout Time (in seconds) to wait for the daemon
+		@param verbose Indicate whether or not verbose mode should be used
+
+		@return RpcClient object
+		"""
+		host = settings.get(KEY_RPC_BIND_ADDRESS, "0.0.0.0")
+		if (host in ("0.0.0.0", "")):
+			host = "127.0.0.1"
+		elif (host in ("::", "::0")):
+			host = "::1"
+		url = settings.get(KEY_RPC_URL, DEFAULT_RPC_URL)
+		if (not url.endswith("/")):
+			url += "/"
+		if (not settings.get(KEY_RPC_AUTH_REQUIRED, False)):
+			username = None
+		elif (username is None):
+			username = settings.get(KEY_RPC_USERNAME, "")
+		return cls(host, settings.get(KEY_RPC_PORT, DEFAULT_RPC_PORT), url + "rpc", username, password, timeout, verbose)
+
+	def close(self):
+		"""
+		Close the HTTP connection
+		"""
+		if (self.conn is not None):
+			self.conn.close()
+			self.conn = None
+
+	def post(self, body):
+		"""
+		Send one HTTP request over the (re)used connection
+		@param body Request body bytes
+
+		@return Tuple of (HTTP status, response headers, response body bytes)
+		"""
+		if (self.conn is None):
+			self.conn = http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+		headers = dict(self.headers)
+		if (self.sessionId is not None):
+			headers[SESSION_ID_HEADER] = self.sessionId
+		self.conn.request("POST", self.path, body, headers)
+		response = self.conn.getresponse()
+		data = response.read()
+		if (response.will_close):
+			self.close()
+		return response.status, response.headers, data
+
+	def send(self, method, body):
+		"""
+		Send a request, renewing the session id and reconnecting a stale connection as needed
+		@param method RPC method name (for messages)
+		@param body Request body bytes
+
+		@return Tuple of (HTTP status, response body bytes)
+		@throws TransmissionError if the daemon cannot be reached
+		"""
+		# At most: one retry on a stale keep-alive connection, one on a new session id
+		retries = 2
+		while True:
+			reused = self.conn is not None
+			try:
+				status, headers, data = self.post(body)
+			except (http.client.HTTPException, OSError) as e:
+				self.close()
+				if (reused and (retries > 0) and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))):
+					retries -= 1
+					continue
+				raise TransmissionError("RPC %s to %s:%d failed: %s" % (method, self.host, self.port, e))
+			if ((status == 409) and (retries > 0)):
+				retries -= 1
+				self.sessionId = headers.get(SESSION_ID_HEADER)
+				if (self.verbose):
+					print("Transmission RPC: new session id %s" % (self.sessionId))
+				continue
+			break
+		return status, data
+
+	def call(self, method, arguments = None):
+		"""
+		Invoke an RPC method
+		@param method RPC method name (eg torrent-get)
+		@param arguments Method arguments dictionary
+
+		@return The "arguments" of the response
+		@throws TransmissionError if the daemon cannot be reached or the call fails
+		"""
+		request = {"method": method}
+		if (arguments is not None):
+			request["arguments"] = arguments
+		body = json.dumps(request).encode("utf-8")
+		with self.lock:
+			status, data = self.send(method, body)
+
+		if (status != 200):
+			raise TransmissionError("RPC %s failed: HTTP %d" % (method, status))
+		try:
+			response = json.loads(data.decode("utf-8"))
+		except ValueError as ve:
+			raise TransmissionError("RPC %s: invalid response: %s" % (method, ve))
+		if (response.get("result") != "success"):
+			raise TransmissionError("RPC %s failed: %s" % (method, response.get("result")))
+		return response.get("arguments", {})
+
+	def getTorrents(self, fields = ACTIVITY_FIELDS, ids = None):
+		"""
+		Retrieve torrent information in a single torrent-get call
+		@param fields List of fields to fetch
+		@param ids List of torrent ids/hashes (None for all torrents)
+
+		@return List of torrent dictionaries
+		"""
+		arguments = {"fields": fields}
+		if (ids is not None):
+			arguments["ids"] = ids
+		torrents = self.call("torrent-get", arguments).get("torrents", [])
+		if (self.verbose):
+			print("Transmission RPC: %d torrents" % (len(torrents)))
+		return torrents
+
+	def isReachable(self):
+		"""
+		Check whether the daemon answers RPC calls (eg right after it was started)
+
+		@return True if the daemon answered, False otherwise
+		"""
+		try:
+			self.call("session-get", {"fields": ["version"]})
+			return True
+		except TransmissionError:
+			return False
+
+	def addTorrent(self, metainfo, paused = False):
+		"""
+		Add a torrent from its metainfo (content of the .torrent file)
+		@param metainfo Metainfo bytes
+		@param paused Add the torrent without starting it
+
+		@return Dictionary with the id, name and hashString of the (possibly already present) torrent
+		@throws TransmissionError if the daemon rejects the torrent
+		"""
+		arguments = {"metainfo": base64.b64encode(metainfo).decode("ascii"), "paused": paused}
+		result = self.call("torrent-add", arguments)
+		if ("torrent-added" in result):
+			return result["torrent-added"]
+		if ("torrent-duplicate" in result):
+			if (self.verbose):
+				print("Transmission RPC: torrent already present")
+			return result["torrent-duplicate"]
+		raise TransmissionError("RPC torrent-add: unexpected response %s" % (result))
+
+	def removeTorrents(self, ids, deleteData = False):
+		"""
+		Remove torrents in a single torrent-remove call
+		@param ids List of torrent ids/hashes
+		@param deleteData Also delete the downloaded data
+		"""
+		self.call("torrent-remove", {"ids": ids, "delete-local-data": deleteData})
+		logging.info("Transmission: removed %d torrents" % (len(ids)))
@@ -0,0 +1,150 @@
+'''
+Blocklist downloads against a stub HTTP server (conditional requests)
+Run with: python3 -m unittest discover -s scripts/root/tests
+'''
+import os
+import sys
+import gzip
+import hashlib
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Torrent.blocklist as blocklist
+
+LAST_MODIFIED = "Sat, 01 Aug 2026 10:00:00 GMT"
+
+class StubListHandler(http.server.BaseHTTPRequestHandler):
+	"""
+	Serves gzip lists with an ETag/Last-Modified, and 304 when the client copy is current
+	"""
+	def do_GET(self):
+		server = self.server
+		name = self.path.lstrip("/")
+		server.requests.append((name, self.headers.get("If-None-Match"), self.headers.get("If-Modified-Since")))
+		if (server.status != 200):
+			self.send_error(server.status)
+			return
+		body = server.lists[name]
+		etag = '"%s"' % (hashlib.sha1(body).hexdigest()[:16]) if server.etag else None
+		if ((etag is not None) and (self.headers.get("If-None-Match") == etag)) or \
+		   ((etag is None) and (self.headers.get("If-Modified-Since") == LAST_MODIFIED)):
+			self.send_response(304)
+			self.end_headers()
+			return
+		data = gzip.compress(body) if server.gzip else body
+		self.send_response(200)
+		if (etag is not None):
+			self.send_header("ETag", etag)
+		self.send_header("Last-Modified", LAST_MODIFIED)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, *args):
+		pass
+
+class FetchListTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubListHandler)
+		self.server.lists = {"level1": b"Bad range:1.2.3.0-1.2.3.255\n", "ads": b"Ads:10.0.0.1-10.0.0.9\n"}
+		self.server.requests = []
+		self.server.status = 200
+		self.server.etag = True
+		self.server.gzip = True
+		threading.Thread(target = self.server.serve_forever, args = (0.05,), daemon = True).start()
+		self.urlTemplate = "http://127.0.0.1:%d/%%s" % (self.server.server_address[1])
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.dir)
+
+	def fetch(self, validators, name = "level1"):
+		return blocklist.fetchList(name, self.urlTemplate % (name), self.dir, validators, timeout = 2.0)
+
+	def read(self, name = "level1"):
+		with open(os.path.join(self.dir, name), 'rb') as f:
+			return f.read()
+
+	def testDownload(self):
+		result, validators = self.fetch({})
+		self.assertEqual(result, blocklist.UPDATED)
+		self.assertEqual(self.read(), self.server.lists["level1"])
+		self.assertTrue(validators["etag"])
+		self.assertEqual(validators["lastModified"], LAST_MODIFIED)
+		self.assertEqual(self.server.requests, [("level1", None, None)])
+		self.assertFalse(os.path.exists(os.path.join(self.dir, "level1.tmp")))
+
+	def testNotModifiedEtag(self):
+		result, validators = self.fetch({})
+		open(os.path.join(self.dir, "level1.bin"), 'wb').close()
+		result, again = self.fetch(validators)
+		self.assertEqual(result, blocklist.UNCHANGED)
+		self.assertEqual(again, validators)
+		self.assertEqual(self.server.requests[1], ("level1", validators["etag"], LAST_MODIFIED))
+		# Transmission's compiled copy stays valid
+		self.assertTrue(os.path.exists(os.path.join(self.dir, "level1.bin")))
+
+	def testNotModifiedLastModified(self):
+		self.server.etag = False
+		result, validators = self.fetch({})
+		self.assertIsNone(validators["etag"])
+		result, again = self.fetch(validators)
+		self.assertEqual(result, blocklist.UNCHANGED)
+		self.assertEqual(self.server.requests[1], ("level1", None, LAST_MODIFIED))
+
+	def testModified(self):
+		result, validators = self.fetch({})
+		open(os.path.join(self.dir, "level1.bin"), 'wb').close()
+		self.server.lists["level1"] = b"Bad range:1.2.4.0-1.2.4.255\n"
+		result, again = self.fetch(validators)
+		self.assertEqual(result, blocklist.UPDATED)
+		self.assertNotEqual(again["etag"], validators["etag"])
+		self.assertEqual(self.read(), self.server.lists["level1"])
+		self.assertFalse(os.path.exists(os.path.join(self.dir, "level1.bin")))
+
+	def testValidatorsWithoutFile(self):
+		# A deleted list is downloaded in full, whatever the stored validators say
+		result, validators = self.fetch({})
+		os.unlink(os.path.join(self.dir, "level1"))
+		result, again = self.fetch(validators)
+		self.assertEqual(result, blocklist.UPDATED)
+		self.assertEqual(self.server.requests[1], ("level1", None, None))
+
+	def testNotGzip(self):
+		self.fetch({})
+		self.server.gzip = False
+		self.server.lists["level1"] = b"Bad range:1.2.4.0-1.2.4.255\n"
+		result, validators = self.fetch({})
+		self.assertEqual(result, blocklist.FAILED)
+		self.assertEqual(self.read(), b"Bad range:1.2.3.0-1.2.3.255\n")
+		self.assertFalse(os.path.exists(os.path.join(self.dir, "level1.tmp")))
+
+	def testHttpError(self):
+		self.server.status = 503
+		result, validators = self.fetch({"etag": '"x"'})
+		self.assertEqual(result, blocklist.FAILED)
+		self.assertEqual(validators, {"etag": '"x"'})
+
+	def testMergedHash(self):
+		names = ["level1", "ads"]
+		results, digest, changed = blocklist.updateBlocklists(self.dir, names, self.urlTemplate, timeout = 2.0)
+		self.assertEqual(results, {"level1": blocklist.UPDATED, "ads": blocklist.UPDATED})
+		self.assertTrue(changed)
+		# Not applied (eg the merge failed): the next update applies it again
+		results, again, changed = blocklist.updateBlocklists(self.dir, names, self.urlTemplate, timeout = 2.0)
+		self.assertEqual(results, {"level1": blocklist.UNCHANGED, "ads": blocklist.UNCHANGED})
+		self.assertEqual(again, digest)
+		self.assertTrue(changed)
+		blocklist.saveMergedHash(self.dir, digest)
+		results, again, changed = blocklist.updateBlocklists(self.dir, names, self.urlTemplate, timeout = 2.0)
+		self.assertFalse(changed)
+
+if __name__ == '__main__':
+	unittest.main()
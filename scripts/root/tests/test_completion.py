@@ -0,0 +1,82 @@
+'''
+Completion spool batching and the retry delay of failed batches
+Run with: python3 -m unittest discover -s scripts/root/tests
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Torrent.completion as completion
+
+class CompletionSpoolTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.spool = completion.CompletionSpool(os.path.join(self.dir, "completed"), window = 2.0, maxAttempts = 3, retryDelay = 10.0)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def queue(self, *hashes, age = 5.0):
+		with open(self.spool.spoolFile, 'a') as f:
+			for h in hashes:
+				f.write("%s\n" % (h))
+		mtime = time.time() - age
+		os.utime(self.spool.spoolFile, (mtime, mtime))
+
+	def ageLastFailure(self, seconds):
+		attempts, lastFailure = self.spool.readAttempts()
+		with open(self.spool.attemptsFile, 'w') as f:
+			f.write("%d %f\n" % (attempts, lastFailure - seconds))
+
+	def testBatchWindow(self):
+		self.assertFalse(self.spool.isReady())
+		self.queue("bb", age = 0.0)
+		self.assertFalse(self.spool.isReady())
+		self.queue("aa", "bb")
+		self.assertTrue(self.spool.isReady())
+		self.assertEqual(self.spool.take(), ["aa", "bb"])
+		self.spool.commit()
+		self.assertFalse(self.spool.isReady())
+		self.assertFalse(os.path.exists(self.spool.workFile))
+
+	def testRetryDelay(self):
+		self.queue("aa")
+		self.spool.take()
+		self.assertFalse(self.spool.fail())
+		# A failed batch is not retried right away, even with new completions queued
+		self.queue("bb")
+		self.assertFalse(self.spool.isReady())
+		self.ageLastFailure(10.0)
+		self.assertTrue(self.spool.isReady())
+		self.assertEqual(self.spool.take(), ["aa", "bb"])
+		self.assertFalse(self.spool.fail())
+		# The delay doubles after each failure
+		self.ageLastFailure(10.0)
+		self.assertFalse(self.spool.isReady())
+		self.ageLastFailure(10.0)
+		self.assertTrue(self.spool.isReady())
+
+	def testGiveUp(self):
+		self.queue("aa")
+		self.spool.take()
+		self.assertFalse(self.spool.fail())
+		self.assertFalse(self.spool.fail())
+		self.assertTrue(self.spool.fail())
+		self.assertFalse(os.path.exists(self.spool.workFile))
+		self.assertFalse(os.path.exists(self.spool.attemptsFile))
+		self.assertFalse(self.spool.isReady())
+
+	def testInterruptedBatch(self):
+		# A work file left by an interrupted run (no failure recorded) is taken again right away
+		self.queue("aa")
+		self.spool.take()
+		self.assertTrue(self.spool.isReady())
+		self.assertEqual(self.spool.take(), ["aa"])
+
+if __name__ == '__main__':
+	unittest.main()
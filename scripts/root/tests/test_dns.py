@@ -0,0 +1,165 @@
+'''
+DNS response parsing and the UDP resolver against a stub DNS server
+Run with: python3 -m unittest discover -s scripts/root/tests
+'''
+import os
+import sys
+import socket
+import struct
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Network.dns as dns
+
+NAME = "myip.opendns.com"
+
+def buildResponse(qid, name, addrs, flags = dns.FLAG_QR | dns.FLAG_RD, ttl = 0):
+	"""
+	Build an A response the way a resolver sends it (answers point back at the question name)
+	@param qid Query identifier
+	@param name Domain name in the question
+	@param addrs IPv4 addresses to answer with
+	@param flags Header flags
+	@param ttl Record TTL
+
+	@return Response message bytes
+	"""
+	msg = dns.DNS_HDR.pack(qid, flags, 1, len(addrs), 0, 0) + dns.encodeName(name) + struct.pack("!HH", dns.TYPE_A, dns.CLASS_IN)
+	for addr in addrs:
+		msg += struct.pack("!H", 0xc000 | dns.DNS_HDR.size) + dns.RR_HDR.pack(dns.TYPE_A, dns.CLASS_IN, ttl, 4) + socket.inet_aton(addr)
+	return msg
+
+class ParseResponseTest(unittest.TestCase):
+	def testAnswers(self):
+		msg = buildResponse(0x1234, NAME, ["198.51.100.7", "198.51.100.8"], ttl = 60)
+		self.assertEqual(dns.parseResponse(msg, 0x1234), [("198.51.100.7", 60), ("198.51.100.8", 60)])
+
+	def testNoAnswers(self):
+		self.assertEqual(dns.parseResponse(buildResponse(1, NAME, []), 1), [])
+
+	def testOtherRecordTypesSkipped(self):
+		msg = bytearray(buildResponse(1, NAME, ["198.51.100.7", "198.51.100.8"]))
+		# Turn the first answer into a CNAME-typed record
+		struct.pack_into("!H", msg, len(buildResponse(1, NAME, [])) + 2, 5)
+		self.assertEqual(dns.parseResponse(bytes(msg), 1), [("198.51.100.8", 0)])
+
+	def testMismatchedId(self):
+		msg = buildResponse(0x1234, NAME, ["198.51.100.7"])
+		with self.assertRaises(dns.DnsError) as cm:
+			dns.parseResponse(msg, 0x4321)
+		self.assertIn("Unexpected", ''.join(cm.exception.args))
+
+	def testQueryIsNotResponse(self):
+		with self.assertRaises(dns.DnsError):
+			dns.parseResponse(dns.buildQuery(1, NAME), 1)
+
+	def testShort(self):
+		with self.assertRaises(dns.DnsError):
+			dns.parseResponse(b"\x12\x34\x81", 0x1234)
+
+	def testTruncatedFlag(self):
+		with self.assertRaises(dns.DnsError):
+			dns.parseResponse(buildResponse(1, NAME, ["198.51.100.7"], flags = dns.FLAG_QR | dns.FLAG_TC), 1)
+
+	def testErrorCode(self):
+		with self.assertRaises(dns.DnsError) as cm:
+			dns.parseResponse(buildResponse(1, NAME, [], flags = dns.FLAG_QR | 3), 1)
+		self.assertIn("rcode 3", ''.join(cm.exception.args))
+
+	def testTruncatedAnswer(self):
+		msg = buildResponse(1, NAME, ["198.51.100.7"])
+		with self.assertRaises(dns.DnsError):
+			dns.parseResponse(msg[:-8], 1)
+
+class StubDnsServer:
+	"""
+	UDP server answering A queries; can drop queries and send stray datagrams first
+	"""
+	def __init__(self, addrs):
+		self.addrs = addrs
+		self.drop = 0
+		self.stray = []
+		self.queries = 0
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(("127.0.0.1", 0))
+		self.port = self.sock.getsockname()[1]
+		self.thread = threading.Thread(target = self.serve, daemon = True)
+		self.thread.start()
+
+	def serve(self):
+		while True:
+			try:
+				query, peer = self.sock.recvfrom(512)
+			except OSError:
+				return
+			self.queries += 1
+			if (self.drop > 0):
+				self.drop -= 1
+				continue
+			qid = struct.unpack_from("!H", query)[0]
+			for msg in self.stray:
+				self.sock.sendto(msg(qid), peer)
+			self.sock.sendto(buildResponse(qid, NAME, self.addrs), peer)
+
+	def close(self):
+		self.sock.close()
+
+class DnsResolverTest(unittest.TestCase):
+	def setUp(self):
+		self.server = StubDnsServer(["198.51.100.7"])
+
+	def tearDown(self):
+		self.server.close()
+
+	def resolver(self, **kwargs):
+		options = {"timeout": 0.2, "retries": 1, "cacheTtl": 0}
+		options.update(kwargs)
+		return dns.DnsResolver("127.0.0.1", self.server.port, **options)
+
+	def testQuery(self):
+		self.assertEqual(self.resolver().queryA(NAME), ["198.51.100.7"])
+
+	def testStrayDatagramsIgnored(self):
+		# A late answer to an earlier query and a garbage datagram arrive first
+		self.server.stray = [lambda qid: buildResponse(qid ^ 0xffff, NAME, ["203.0.113.1"]), lambda qid: b"\0"]
+		self.assertEqual(self.resolver().queryA(NAME), ["198.51.100.7"])
+
+	def testMatchingErrorNotIgnored(self):
+		self.server.stray = [lambda qid: buildResponse(qid, NAME, [], flags = dns.FLAG_QR | 2)]
+		with self.assertRaises(dns.DnsError):
+			self.resolver().queryA(NAME)
+
+	def testRetryAfterTimeout(self):
+		self.server.drop = 1
+		self.assertEqual(self.resolver().queryA(NAME), ["198.51.100.7"])
+		self.assertEqual(self.server.queries, 2)
+
+	def testNoAnswer(self):
+		self.server.drop = 2
+		with self.assertRaises(dns.DnsError) as cm:
+			self.resolver().queryA(NAME)
+		self.assertIn("No answer", ''.join(cm.exception.args))
+
+	def testNoRecords(self):
+		self.server.addrs = []
+		with self.assertRaises(dns.DnsError):
+			self.resolver().queryA(NAME)
+
+	def testCache(self):
+		resolver = self.resolver(cacheTtl = 30)
+		resolver.queryA(NAME)
+		self.assertEqual(resolver.queryA(NAME), ["198.51.100.7"])
+		self.assertEqual(self.server.queries, 1)
+		resolver.clearCache()
+		resolver.queryA(NAME)
+		self.assertEqual(self.server.queries, 2)
+
+	def testRefused(self):
+		self.server.close()
+		with self.assertRaises(dns.DnsError):
+			self.resolver().queryA(NAME)
+
+if __name__ == '__main__':
+	unittest.main()
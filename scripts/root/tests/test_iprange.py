@@ -0,0 +1,101 @@
+'''
+Merging and lookup of p2p blocklist ranges
+Run with: python3 -m unittest discover -s scripts/root/tests
+'''
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Torrent.iprange as iprange
+
+def ranges(rangeSet):
+	return list(zip(rangeSet.starts, rangeSet.ends))
+
+class ParseP2pLineTest(unittest.TestCase):
+	def testRange(self):
+		self.assertEqual(iprange.parseP2pLine("Some org:1.2.3.0-1.2.3.255\n"), (0x01020300, 0x010203ff))
+
+	def testDescriptionWithColons(self):
+		self.assertEqual(iprange.parseP2pLine("a:b:c:10.0.0.1 - 10.0.0.2"), (0x0a000001, 0x0a000002))
+
+	def testReversedRange(self):
+		self.assertEqual(iprange.parseP2pLine("x:10.0.0.9-10.0.0.1"), (0x0a000001, 0x0a000009))
+
+	def testIgnored(self):
+		for line in ["", "   \n", "# comment:1.2.3.4-1.2.3.5", "no range here", "x:1.2.3.4", "x:1.2.3.4-1.2.3.256"]:
+			self.assertIsNone(iprange.parseP2pLine(line), line)
+
+class RangeSetTest(unittest.TestCase):
+	def testOverlapping(self):
+		rs = iprange.RangeSet.fromRanges([(10, 20), (15, 30), (5, 12)])
+		self.assertEqual(ranges(rs), [(5, 30)])
+		self.assertEqual(rs.inputCount, 3)
+
+	def testAdjacent(self):
+		# Touching ranges are joined, a gap of one address is kept
+		rs = iprange.RangeSet.fromRanges([(21, 30), (10, 20), (32, 40)])
+		self.assertEqual(ranges(rs), [(10, 30), (32, 40)])
+
+	def testContained(self):
+		rs = iprange.RangeSet.fromRanges([(10, 100), (20, 30), (40, 40), (100, 100)])
+		self.assertEqual(ranges(rs), [(10, 100)])
+
+	def testDuplicates(self):
+		rs = iprange.RangeSet.fromRanges([(1, 1), (1, 1), (3, 3)])
+		self.assertEqual(ranges(rs), [(1, 1), (3, 3)])
+		self.assertEqual(rs.memorySaved(), iprange.TR_RANGE_SIZE)
+
+	def testAddressSpaceEdges(self):
+		rs = iprange.RangeSet.fromRanges([(0, 0), (0xfffffffe, 0xffffffff), (1, 5)])
+		self.assertEqual(ranges(rs), [(0, 5), (0xfffffffe, 0xffffffff)])
+		self.assertTrue(rs.contains("255.255.255.255"))
+		self.assertTrue(rs.contains("0.0.0.0"))
+		self.assertFalse(rs.contains("0.0.0.6"))
+		self.assertEqual(rs.addressCount(), 8)
+
+	def testEmpty(self):
+		rs = iprange.RangeSet.fromRanges([])
+		self.assertEqual(len(rs), 0)
+		self.assertFalse(rs.contains("1.2.3.4"))
+		self.assertEqual(rs.addressCount(), 0)
+
+	def testMatchesNaiveSet(self):
+		rng = random.Random(1)
+		for i in range(0, 50):
+			inputRanges = []
+			for j in range(0, rng.randint(1, 20)):
+				start = rng.randint(0, 200)
+				inputRanges.append((start, start + rng.randint(0, 15)))
+			rs = iprange.RangeSet.fromRanges(inputRanges)
+			covered = set()
+			for start, end in inputRanges:
+				covered.update(range(start, end + 1))
+			self.assertEqual(rs.containsMany(range(0, 220)), [a in covered for a in range(0, 220)])
+			self.assertEqual(rs.addressCount(), len(covered))
+			# Merged ranges are sorted and neither overlap nor touch
+			for (s1, e1), (s2, e2) in zip(ranges(rs), ranges(rs)[1:]):
+				self.assertLess(e1 + 1, s2)
+
+	def testWriteRoundTrip(self):
+		tmpDir = tempfile.mkdtemp()
+		try:
+			path = os.path.join(tmpDir, "level1")
+			with open(path, 'w') as f:
+				f.write("# header\nA:1.2.3.0-1.2.3.127\nB:1.2.3.128-1.2.3.255\nC:9.9.9.9-9.9.9.9\n")
+			rs = iprange.RangeSet.fromFiles([path])
+			self.assertEqual(rs.inputCount, 3)
+			out = os.path.join(tmpDir, "merged")
+			rs.write(out)
+			with open(out, 'r') as f:
+				self.assertEqual(f.read(), "merged:1.2.3.0-1.2.3.255\nmerged:9.9.9.9-9.9.9.9\n")
+			self.assertEqual(ranges(iprange.RangeSet.fromFiles([out])), ranges(rs))
+		finally:
+			shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+	unittest.main()
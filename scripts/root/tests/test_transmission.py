@@ -0,0 +1,92 @@
+'''
+Transmission RPC client against a stub RPC server (session id handshake)
+Run with: python3 -m unittest discover -s scripts/root/tests
+'''
+import os
+import sys
+import json
+import socket
+import threading
+import unittest
+import http.server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Torrent.transmission as transmission
+
+class StubRpcHandler(http.server.BaseHTTPRequestHandler):
+	"""
+	Answers like the daemon: 409 with a session id until the current one is sent
+	"""
+	protocol_version = "HTTP/1.1"
+
+	def do_POST(self):
+		server = self.server
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		server.requests.append((self.headers.get(transmission.SESSION_ID_HEADER), json.loads(body)))
+		if (server.rotate or (self.headers.get(transmission.SESSION_ID_HEADER) != server.sessionId)):
+			if (server.rotate):
+				server.sessionId = "session-%d" % (len(server.requests))
+			self.reply(409, b"", {transmission.SESSION_ID_HEADER: server.sessionId})
+			return
+		self.reply(200, json.dumps({"result": "success", "arguments": {"torrents": []}}).encode("utf-8"))
+
+	def reply(self, status, data, headers = {}):
+		self.send_response(status)
+		for key, value in headers.items():
+			self.send_header(key, value)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, *args):
+		pass
+
+class RpcClientTest(unittest.TestCase):
+	def setUp(self):
+		self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubRpcHandler)
+		self.server.sessionId = "session-1"
+		self.server.requests = []
+		self.server.rotate = False
+		threading.Thread(target = self.server.serve_forever, args = (0.05,), daemon = True).start()
+		self.client = transmission.RpcClient("127.0.0.1", self.server.server_address[1], timeout = 2.0)
+
+	def tearDown(self):
+		self.client.close()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def testSessionIdHandshake(self):
+		self.assertEqual(self.client.getTorrents(), [])
+		self.assertEqual([r[0] for r in self.server.requests], [None, "session-1"])
+		self.assertEqual(self.server.requests[1][1]["method"], "torrent-get")
+
+	def testSessionIdReused(self):
+		self.client.getTorrents()
+		self.client.getTorrents()
+		self.assertEqual([r[0] for r in self.server.requests], [None, "session-1", "session-1"])
+
+	def testSessionIdRenewed(self):
+		self.client.getTorrents()
+		# Daemon restarted: the old id is rejected once, then the new one is used
+		self.server.sessionId = "session-2"
+		self.client.getTorrents()
+		self.assertEqual([r[0] for r in self.server.requests], [None, "session-1", "session-1", "session-2"])
+
+	def testPersistentConflict(self):
+		# A daemon that never accepts the id it hands out must not be retried forever
+		self.server.rotate = True
+		with self.assertRaises(transmission.TransmissionError):
+			self.client.getTorrents()
+		self.assertEqual(len(self.server.requests), 3)
+
+	def testUnreachable(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.bind(("127.0.0.1", 0))
+		port = sock.getsockname()[1]
+		sock.close()
+		client = transmission.RpcClient("127.0.0.1", port, timeout = 1.0)
+		self.assertFalse(client.isReachable())
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,23 +1,68 @@
 #!/usr/bin/env python3
 
+import sys
+
+import Service.snapshot as snapshot
+
+# Most one-shot runs have nothing to do: decide that from the state recorded by
+# the previous run, before the other modules are loaded (see Service/snapshot.py)
+if ((__name__ == '__main__') and snapshot.idleFastPath(sys.argv[1:])):
+	sys.exit(0)
+
 import datetime
 import time
 import os
-import sys
 import getopt
 import configparser
+import json
 import subprocess
 import logging
+import asyncio
+import random
+import signal
 
 import Service.service as service
 import Network.interface as interface
 import Network.vpn as vpnet
-#import Torrent.transmission as transmission
+import Network.probe as probe
+import Network.dns as dns
+import Network.netlink as netlink
+import Network.firewall as firewall
+import Network.routetable as routetable
+import Torrent.inventory as inventory
+import Torrent.transmission as transmissionCfg
+import Torrent.metainfo as metainfo
+import Torrent.iprange as iprange
+import Torrent.completion as completion
+import Torrent.flexget as flexget
+import Log.logqueue as logqueue
+import Log.trace as trace
+import Log.metrics as metrics
 
 # Define some "constants"
 ERROR = -1
 SUCCESS = 0
 
+TRANSMISSION_REBIND_TIMEOUT = 5 # s, for the daemon to listen on a new bind address after a reload
+TRANSMISSION_STOP_TIMEOUT = 30 # s
+TRANSMISSION_RPC_TIMEOUT = 15 # s, for the RPC interface to come up after the daemon started
+COMPLETION_POLL_INTERVAL = 1 # s
+TORRENT_IDLE_FILE = "/dev/shm/torrent_vpn.idle.json" # Active torrents the daemon last reported as idle
+
+CYCLES = metrics.counter("torrent_vpn_cycles_total", "Check cycles by result")
+CYCLE_SECONDS = metrics.histogram("torrent_vpn_cycle_seconds", "Duration of the check cycles")
+LAST_CYCLE = metrics.gauge("torrent_vpn_last_cycle_timestamp_seconds", "Unix time the last check cycle completed")
+VPN_CHECKS = metrics.counter("torrent_vpn_vpn_checks_total", "VPN checks by result")
+VPN_HEALTHY = metrics.gauge("torrent_vpn_vpn_healthy", "1 if the last VPN check found (or brought) the VPN up, 0 otherwise")
+VPN_RESTARTS = metrics.counter("torrent_vpn_vpn_restarts_total", "VPN restarts done by the VPN check")
+VPN_RECOVERY_SECONDS = metrics.histogram("torrent_vpn_vpn_recovery_seconds", "Time from finding the VPN down to a healthy VPN")
+FLEXGET_RUNS = metrics.counter("torrent_vpn_flexget_runs_total", "Flexget runs by method (ipc/exec) and result")
+FLEXGET_TASKS = metrics.counter("torrent_vpn_flexget_task_runs_total", "Flexget task runs by task and result (ok/aborted)")
+FLEXGET_ACCEPTED = metrics.counter("torrent_vpn_flexget_accepted_total", "Entries accepted by Flexget, by task")
+FLEXGET_SECONDS = metrics.histogram("torrent_vpn_flexget_run_seconds", "Duration of the Flexget runs")
+TRANSMISSION_REBINDS = metrics.counter("torrent_vpn_transmission_rebinds_total", "Torrent daemon bind address changes by method (reload/restart) and result")
+TRANSMISSION_REBIND_SECONDS = metrics.histogram("torrent_vpn_transmission_rebind_seconds", "Time the torrent daemon was not listening on the VPN address during a rebind")
+
 currentDate = datetime.datetime.now()
 currentTime = datetime.datetime.now().time()
 
@@ -30,7 +75,17 @@ class GlobalState:
 	basePath = os.curdir
 	pidFile = "/tmp/torrent_vpn.pid"
 	logFile = "/dev/shm/torrent_vpn.log"
+	logFormat = logqueue.FORMAT_TEXT
+	logMaxSize = logqueue.MAX_BYTES
+	logBackups = logqueue.BACKUP_COUNT
+	logSpillDir = ""
+	logSpillCount = logqueue.SPILL_COUNT
+	profileFile = ""
+	profileStatsFile = ""
+	metricsTextFile = ""
+	metricsJsonFile = metrics.JSON_FILE
 	configFile = ""
+	cmdArgs = []
 
 	# Shared config
 	initSystem = ""
@@ -43,6 +98,15 @@ class GlobalState:
 	vpnUser = ""
 	vpnPingOne = False
 	vpnMark = 0
+	vpnProbeTimeout = 3.0
+	vpnPingCount = vpnet.PING_COUNT
+	vpnPingMaxLoss = vpnet.PING_MAX_LOSS
+	vpnPingMaxRtt = vpnet.PING_MAX_RTT
+	vpnExternalIpResolver = dns.OPENDNS_RESOLVER
+	vpnExternalIpCacheTtl = 15
+	externalIpResolver = None
+	vpnFirewall = "iptables"
+	vpnBlocklist = ""
 
 	# Torrent config
 	torrentHomePath = ""
@@ -50,20 +114,39 @@ class GlobalState:
 	torrentActivePath = ""
 	torrentConfigFile = ""
 	torrentDaemonName = ""
+	torrentRpcUsername = None
+	torrentRpcPassword = None
+	torrentIndexFile = "/var/tmp/torrent_vpn.index.json"
+	torrentMinFreeSpace = 1024 * 1024 * 1024 # bytes
+	torrentInventory = None
+	torrentIndex = None
+	torrentRpc = None
+	torrentCompletion = None
+	transmissionDownSince = None # time.monotonic() of a rebind restart, until the daemon runs again
 
 	# Flexget
 	flexgetBin = ""
 	flexgetOverwrite = False
+	flexgetConfigDir = ""
+	flexgetDaemon = False
+	flexgetTimeout = flexget.RUN_TIMEOUT
+	flexgetRunner = None
 
 	# LAN config
 	lanInterface = None
 	lanGw = ""
+	routeTable = None
 
+	# Daemon config
+	daemonMode = False
+	daemonInterval = 60
+	daemonJitter = 10
+
+	# State snapshot (one-shot runs)
+	fastPathRevalidate = snapshot.REVALIDATE
+	stateSnapshot = None
+	cycleIdle = False
 
-# file lists to manipulate later
-added_torrents = []
-pending_torrents = []
-active_torrents = []
 
 def printUsage(appName):
 	"""
@@ -74,8 +157,12 @@ def printUsage(appName):
 	print("  -h | --help                            This help message")
 	print("  -b | --base-path     <base path>       Base path from where all scripts are accessible")
 	print("  -c | --config        <config file>     Path to the configuration file to use for parameters")
+	print("  -d | --daemon                          Run as a long-lived daemon, repeating the checks on the configured schedule")
 	print("  -f | --flexget                         Flexget overwrite - Run Flexget even if the specified interval is not active")
 	print("  -l | --log           <log file>        File to log to (defaults to %s)" % (GlobalState.logFile))
+	print("       --log-format    <text|json>       Log record format (defaults to text; json gives one structured record per line)")
+	print("       --profile       <trace file>      Record the time spent in each phase and subprocess as a Chrome trace-event file")
+	print("       --profile-stats <stats file>      With --profile, also run the checks under cProfile and write the stats here")
 	print("  -t | --test                            Enable test mode (automatically lets certain checks return true")
 	print("  -v | --verbose                         Enable verbose mode")
 	sys.exit()
@@ -87,11 +174,12 @@ def parseCommandLine(argv):
 	No return value, but GlobalState members are set
 	"""
 	try:
-		opts, args = getopt.getopt(argv[1:], "hb:c:fl:tv", ["help","base-path=","config=","flexget","log=","test","verbose"])
+		opts, args = getopt.getopt(argv[1:], "hb:c:dfl:tv", ["help","base-path=","config=","daemon","flexget","log=","log-format=","profile=","profile-stats=","test","verbose"])
 	except getopt.GetoptError as goe:
 		print(goe)
 		printUsage(argv[0])
 
+	GlobalState.cmdArgs = argv[1:]
 	for opt, arg in opts:
 		if opt in ("-h", "--help"):
 			printUsage(argv[0])
@@ -103,6 +191,10 @@ def parseCommandLine(argv):
 			if (GlobalState.verbose):
 				print("Config file to use: %s" % arg)
 			GlobalState.configFile = arg
+		elif opt in ("-d", "--daemon"):
+			if (GlobalState.verbose):
+				print("Daemon mode enabled")
+			GlobalState.daemonMode = True
 		elif opt in ("-f", "--flexget"):
 			if (GlobalState.verbose):
 				print("Flexget overwrite")
@@ -111,6 +203,15 @@ def parseCommandLine(argv):
 			if (GlobalState.verbose):
 				print("Log file to use: %s" % arg)
 			GlobalState.logFile = arg
+		elif opt == "--log-format":
+			if (arg not in (logqueue.FORMAT_TEXT, logqueue.FORMAT_JSON)):
+				print("Error: Unsupported log format %s" % arg)
+				printUsage(argv[0])
+			GlobalState.logFormat = arg
+		elif opt == "--profile":
+			GlobalState.profileFile = arg
+		elif opt == "--profile-stats":
+			GlobalState.profileStatsFile = arg
 		elif opt in ("-t", "--test"):
 			if (GlobalState.verbose):
 				print("Test mode enabled")
@@ -120,44 +221,36 @@ def parseCommandLine(argv):
 				print("verbose mode enabled")
 			GlobalState.verbose = True
 
-def getRouteInfo():
-	"""
-	Get the system route info from the main routing table. Returns a list of routes
-	@return None on error, route list otherwise
-	"""
-	# Build route command
-	cmd = ["route", "-n"]
-	try:
-		output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-		outString = output.decode("utf-8")
-		outList = outString.split("\n")
-		# The first 2 lines is text
-		outList.remove(outList[0])
-		outList.remove(outList[0])
-		return outList
-	except subprocess.CalledProcessError as cpe:
-		outString = cpe.output.decode("utf-8")
-		print("Route error: %d" % cpe.returncode)
-		print("Exception Command output:\n%s" % outString)
-	return None
-
+@trace.traced
 def setLanInfo():
 	"""
-	Find the default route in a list of routes
+	Find the default route in the main routing table
 	Does not return anything, but sets the GlobalState LAN members based on the default route
+	(with multiple default routes, the one with the lowest metric is used)
 	"""
-	# Assume the default route is the one to 0.0.0.0
-	routeList = getRouteInfo()
-	if routeList is not None:
-		for route in routeList:
-			if (len(route) > 0):
-				entry = route.split()
-				if ((len(entry) > 0) and (entry[0] == "0.0.0.0")):
-					GlobalState.lanInterface = interface.Interface(entry[7])
-					GlobalState.lanGw = entry[1]
-					if (GlobalState.verbose):
-						print("\n\n\tLAN IF info: %s" % GlobalState.lanInterface.getNetworkParams())
+	if (GlobalState.routeTable is None):
+		GlobalState.routeTable = routetable.RouteTable(watch = GlobalState.daemonMode, verbose = GlobalState.verbose)
+
+	try:
+		route = GlobalState.routeTable.getDefaultRoute(exclude = (GlobalState.vpnInterface,))
+	except OSError as oe:
+		logging.info("Route error: %s" % (oe))
+		print("Route error: %s" % (oe))
+		return
+
+	if (route is None):
+		logging.info("Route: No default route found")
+		if (GlobalState.verbose):
+			print("No default route found")
+		return
+
+	if ((GlobalState.lanInterface is None) or (GlobalState.lanInterface.getId() != route.iface)):
+		GlobalState.lanInterface = interface.Interface(route.iface)
+	GlobalState.lanGw = route.gateway
+	if (GlobalState.verbose):
+		print("\n\n\tLAN IF info: %s (default route %s)" % (GlobalState.lanInterface.getNetworkParams(), route))
 
+@trace.traced
 def torrentsClearProcessed():
 	"""
 	Clear all torrents marked as 'added'
@@ -165,9 +258,7 @@ def torrentsClearProcessed():
 	 Flexget 'added' directory)
 	At this stage, this function is Transmission specific
 	"""
-	for f in os.listdir(GlobalState.torrentAddedPath):
-		if f.endswith(".added"):
-			added_torrents.append(f)
+	added_torrents = GlobalState.torrentInventory.getAdded()
 
 	if (len(added_torrents) > 0):
 		logging.info("Torrents: Clearing processed torrents")
@@ -176,10 +267,188 @@ def torrentsClearProcessed():
 		for f in added_torrents:
 			full_path = GlobalState.torrentAddedPath+"/"+f
 			print(full_path)
-			os.remove(full_path)
+			try:
+				GlobalState.torrentInventory.removeAdded(f)
+			except FileNotFoundError:
+				logging.info("Torrents: %s already removed" % (full_path))
 	elif (GlobalState.verbose):
 		print("No added torrents to delete")
 
+@trace.traced
+def torrentsRemoveCompleted(transmission):
+	"""
+	Remove the torrents queued by the done-script, with one torrent-remove call
+	per batch (their data is kept). While the daemon is stopped the queued
+	torrents wait for its next start; a batch the running daemon does not take
+	is retried after an increasing delay, up to completion.MAX_ATTEMPTS times.
+	@param transmission Torrent daemon service object
+	"""
+	spool = GlobalState.torrentCompletion
+	# The daemon's completion loop and the check cycle may both get here; a batch
+	# another thread is handling must not be taken (or committed) again
+	if (not spool.lock.acquire(blocking = False)):
+		return
+	try:
+		removeCompletedBatch(spool, transmission)
+	finally:
+		spool.lock.release()
+
+def removeCompletedBatch(spool, transmission):
+	"""
+	Take and remove one batch of queued torrents (with the spool lock held)
+	@param spool Completion spool object
+	@param transmission Torrent daemon service object
+	"""
+	if (not spool.isReady()):
+		return
+	if (transmission.getStatus() == service.STOPPED):
+		if (GlobalState.verbose):
+			print("Completed torrents queued, waiting for the torrent daemon to run")
+		return
+	hashes = spool.take()
+	if (len(hashes) == 0):
+		spool.commit()
+		return
+
+	rpc = getTorrentRpc()
+	try:
+		if (rpc is None):
+			raise transmissionCfg.TransmissionError("no RPC settings")
+		rpc.removeTorrents(hashes)
+	except transmissionCfg.TransmissionError as te:
+		logging.info("Torrents: unable to remove %d completed torrents: %s" % (len(hashes), ''.join(te.args)))
+		if ((not spool.fail()) and GlobalState.verbose):
+			print("Unable to remove completed torrents, retrying later")
+		return
+	spool.commit()
+	logging.info("Torrents: removed %d completed torrents" % (len(hashes)))
+	if (GlobalState.verbose):
+		print("Removed %d completed torrents" % (len(hashes)))
+
+def torrentsDownloadDir():
+	"""
+	Retrieve the directory the torrent daemon allocates new downloads in
+
+	@return Directory path, None if the daemon settings cannot be read
+	"""
+	try:
+		settings = transmissionCfg.loadSettings(GlobalState.torrentConfigFile)
+	except transmissionCfg.TransmissionError as te:
+		logging.info("Transmission: %s" % (''.join(te.args)))
+		return None
+	if (settings.get("incomplete-dir-enabled", False) and settings.get("incomplete-dir")):
+		return settings["incomplete-dir"]
+	return settings.get("download-dir")
+
+@trace.traced
+def torrentsScreen():
+	"""
+	Check the pending (and previously deferred) torrents before they reach the daemon
+	* Duplicates of active torrents (same infohash) are deleted
+	* Torrents larger than the download volume are renamed to .rejected
+	* Torrents that do not fit in the currently free space (less MinFreeSpace)
+	  are renamed to .deferred, and renamed back once they fit
+	"""
+	inv = GlobalState.torrentInventory
+	index = GlobalState.torrentIndex
+	candidates = inv.getPending() + inv.getDeferred()
+	if (len(candidates) == 0):
+		return
+
+	activeMetas = index.update(GlobalState.torrentActivePath, inv.getActive())
+	knownHashes = set(m.infohash for m in activeMetas.values() if m is not None)
+	metas = index.update(GlobalState.torrentAddedPath, candidates)
+
+	free = capacity = None
+	downloadDir = torrentsDownloadDir()
+	if (downloadDir is not None):
+		try:
+			st = os.statvfs(downloadDir)
+			free = st.f_bavail * st.f_frsize - GlobalState.torrentMinFreeSpace
+			capacity = st.f_blocks * st.f_frsize - GlobalState.torrentMinFreeSpace
+		except OSError as oe:
+			logging.info("Torrents: unable to check free space in %s: %s" % (downloadDir, oe))
+
+	reserved = 0
+	for f in candidates:
+		meta = metas.get(f)
+		if (meta is None):
+			continue # Not (yet) parseable, left to the daemon
+		full_path = GlobalState.torrentAddedPath+"/"+f
+		deferred = f.endswith(inventory.SUFFIX_DEFERRED)
+		try:
+			if (meta.infohash in knownHashes):
+				logging.info("Torrents: %s is a duplicate (%s), removing it" % (full_path, meta.infohash))
+				if (GlobalState.verbose):
+					print("Duplicate torrent %s removed" % (full_path))
+				inv.removeAdded(f)
+			elif ((capacity is not None) and (meta.totalSize > capacity)):
+				logging.info("Torrents: %s (%d bytes) can never fit in %s, rejecting it" % (full_path, meta.totalSize, downloadDir))
+				if (GlobalState.verbose):
+					print("Torrent %s too large, rejected" % (full_path))
+				newName = (f[:-len(inventory.SUFFIX_DEFERRED)] if deferred else f) + inventory.SUFFIX_REJECTED
+				inv.renameAdded(f, newName)
+			elif ((free is not None) and (reserved + meta.totalSize > free)):
+				if (not deferred):
+					logging.info("Torrents: not enough space for %s (%d bytes), deferring it" % (full_path, meta.totalSize))
+					if (GlobalState.verbose):
+						print("Not enough space for %s, deferred" % (full_path))
+					inv.renameAdded(f, f + inventory.SUFFIX_DEFERRED)
+					index.rename(os.path.join(GlobalState.torrentAddedPath, f), os.path.join(GlobalState.torrentAddedPath, f + inventory.SUFFIX_DEFERRED))
+			else:
+				reserved += meta.totalSize
+				if (deferred):
+					logging.info("Torrents: %s fits now, releasing it" % (full_path))
+					newName = f[:-len(inventory.SUFFIX_DEFERRED)]
+					inv.renameAdded(f, newName)
+					index.rename(os.path.join(GlobalState.torrentAddedPath, f), os.path.join(GlobalState.torrentAddedPath, newName))
+			knownHashes.add(meta.infohash)
+		except FileNotFoundError:
+			# Consumed by the watch-dir scan in the meantime
+			continue
+	index.save()
+
+@trace.traced
+def torrentsIngest():
+	"""
+	Hand pending torrents directly to the torrent daemon (torrent-add RPC), instead
+	of waiting for its watch-dir scan. Each file is deleted once it was added;
+	files that could not be added are left for the watch-dir.
+	"""
+	pending_torrents = GlobalState.torrentInventory.getPending()
+	if (len(pending_torrents) == 0):
+		return
+
+	rpc = getTorrentRpc()
+	if ((rpc is None) or (not service.waitFor(rpc.isReachable, TRANSMISSION_RPC_TIMEOUT))):
+		logging.info("Transmission: RPC not available, leaving %d torrents to the watch-dir" % (len(pending_torrents)))
+		if (GlobalState.verbose):
+			print("Transmission RPC not available, leaving torrents to the watch-dir")
+		return
+
+	for f in pending_torrents:
+		full_path = GlobalState.torrentAddedPath+"/"+f
+		try:
+			with open(full_path, 'rb') as torrentFile:
+				metainfo = torrentFile.read()
+			torrent = rpc.addTorrent(metainfo)
+		except FileNotFoundError:
+			# Already consumed by the watch-dir scan
+			continue
+		except transmissionCfg.TransmissionError as te:
+			logging.info("Torrents: unable to add %s: %s" % (full_path, ''.join(te.args)))
+			if (GlobalState.verbose):
+				print("Unable to add %s" % (full_path))
+			continue
+		logging.info("Torrents: added %s (%s)" % (full_path, torrent.get("name")))
+		if (GlobalState.verbose):
+			print("Added %s" % (full_path))
+		try:
+			GlobalState.torrentInventory.removeAdded(f)
+		except FileNotFoundError:
+			pass
+
+@trace.traced
 def needFlexget():
 	"""
 	Determine if Flexget should be run based on the time interval
@@ -188,36 +457,234 @@ def needFlexget():
 	if ((GlobalState.testMode) or (GlobalState.flexgetOverwrite)):
 		return True
 
-	if (((currentTime.hour % 2) == 0) and (currentTime.minute < 5)):
+	if (snapshot.flexgetWindow(currentTime.hour, currentTime.minute)):
 		if (GlobalState.verbose):
 			print("Flexget needs to be run")
 		return True
 	return False
 
+def getTorrentRpc():
+	"""
+	Retrieve the (lazily created) Transmission RPC client
+
+	@return RpcClient object, None if the daemon settings cannot be read
+	"""
+	if (GlobalState.torrentRpc is None):
+		try:
+			settings = transmissionCfg.loadSettings(GlobalState.torrentConfigFile)
+		except transmissionCfg.TransmissionError as te:
+			logging.info("Transmission: %s" % (''.join(te.args)))
+			return None
+		GlobalState.torrentRpc = transmissionCfg.RpcClient.fromSettings(settings, GlobalState.torrentRpcPassword,
+																		  GlobalState.torrentRpcUsername, verbose = GlobalState.verbose)
+	return GlobalState.torrentRpc
+
+def torrentsTransferring():
+	"""
+	Ask the torrent daemon whether any of its torrents is still transferring
+
+	@return True if a torrent is active, False if all are paused or finished,
+			None if the daemon could not be queried (eg it is not running)
+	"""
+	rpc = getTorrentRpc()
+	if (rpc is None):
+		return None
+	try:
+		torrents = rpc.getTorrents()
+	except transmissionCfg.TransmissionError as te:
+		logging.info("Transmission: %s" % (''.join(te.args)))
+		return None
+	active = [t for t in torrents if transmissionCfg.isTorrentActive(t)]
+	logging.info("Transmission: %d of %d torrents active" % (len(active), len(torrents)))
+	if (GlobalState.verbose):
+		print("%d of %d torrents active" % (len(active), len(torrents)))
+	return len(active) > 0
+
+def loadIdleTorrents():
+	"""
+	@return List of active torrent files the daemon last reported as idle, None if unknown
+	"""
+	try:
+		with open(TORRENT_IDLE_FILE, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+def saveIdleTorrents(torrentFiles):
+	"""
+	Remember the active torrent files the daemon reported as idle (None to forget)
+	@param torrentFiles List of torrent file names, or None
+	"""
+	try:
+		if (torrentFiles is None):
+			os.unlink(TORRENT_IDLE_FILE)
+		else:
+			with open(TORRENT_IDLE_FILE, 'w') as f:
+				json.dump(sorted(torrentFiles), f)
+	except FileNotFoundError:
+		pass
+	except OSError as oe:
+		logging.info("Torrents: unable to update %s: %s" % (TORRENT_IDLE_FILE, oe))
+
+@trace.traced
 def needTorrentClient():
 	"""
 	Determine if the torrenting client is needed based on new/active torrents
+	Active torrents only count while the daemon reports them as transferring. When
+	the daemon is not running, its last report is reused as long as the set of
+	active torrents did not change.
 	@return True if torrenting client is needed, False otherwise
 	"""
-	for f in os.listdir(GlobalState.torrentAddedPath):
-		if f.endswith(".torrent"):
-			pending_torrents.append(f)
+	pending_torrents = GlobalState.torrentInventory.getPending()
+	active_torrents = GlobalState.torrentInventory.getActive()
+
+	if (len(pending_torrents) > 0):
+		if (GlobalState.verbose):
+			print("Pending torrents present (we need to start torrent client for these)")
+		return True
 
-	for f in os.listdir(GlobalState.torrentActivePath):
-		if f.endswith(".torrent"):
-			active_torrents.append(f)
+	if (len(active_torrents) == 0):
+		if (GlobalState.verbose):
+			print("No pending or active torrents (don't need to start torrent client)")
+		return False
 
-	if ((len(pending_torrents) > 0) or (len(active_torrents) > 0)):
+	transferring = torrentsTransferring()
+	if (transferring is None):
+		if (loadIdleTorrents() == sorted(active_torrents)):
+			if (GlobalState.verbose):
+				print("Active torrents unchanged since the daemon reported them idle (don't need to start torrent client)")
+			return False
 		if (GlobalState.verbose):
-			print("Pending or active torrents present (we need to start torrent client for these)")
+			print("Active torrents present (we need to start torrent client for these)")
 		return True
-	elif (GlobalState.verbose):
-		print("No pending or active torrents (don't need to start torrent client)")
+
+	if (transferring):
+		saveIdleTorrents(None)
+		if (GlobalState.verbose):
+			print("Active torrents transferring (we need the torrent client for these)")
+		return True
+
+	saveIdleTorrents(active_torrents)
+	if (GlobalState.verbose):
+		print("All torrents paused or finished (don't need the torrent client)")
 	return False
 
-def vpnSetRoutesAndRules():
+def vpnDesiredRoutes(vpn):
+	"""
+	Build the routes the VPN routing table should contain
+	@param vpn VPN object (with up to date interface information)
+
+	@return List of netlink.Route objects
+	@throws netlink.NetlinkError if required information is missing
+	"""
+	vpnIp = vpn.getAddr()
+	vpnGw = vpn.getPeer()
+	vpnOne = vpnGw.rsplit('.', 1)[0] + ".1"
+	serverIp = vpn.getServerAddr()
+	lanIf = GlobalState.lanInterface.getId()
+	lanNw = GlobalState.lanInterface.getNetworkParams()
+	if ((serverIp is None) or (lanNw is None)):
+		raise netlink.NetlinkError("VPN server address or LAN network unknown")
+
+	return [netlink.Route("0.0.0.0", 1, vpnGw, GlobalState.vpnInterface),
+			netlink.Route("0.0.0.0", 0, vpnGw, GlobalState.vpnInterface),
+			# Kill switch: when the tunnel goes away, its routes are removed and
+			# marked traffic ends up on the loopback interface
+			netlink.Route("0.0.0.0", 0, "127.0.0.1", "lo", fallback = True),
+			netlink.Route(vpnOne, 32, vpnGw, GlobalState.vpnInterface),
+			netlink.Route(vpnGw, 32, None, GlobalState.vpnInterface, vpnIp, netlink.RT_SCOPE_LINK, netlink.RTPROT_KERNEL),
+			netlink.Route(serverIp, 32, GlobalState.lanGw, lanIf),
+			netlink.Route(str(lanNw.network_address), lanNw.prefixlen, None, lanIf, scope = netlink.RT_SCOPE_LINK)]
+
+def vpnSetRoutes(vpn):
+	"""
+	Program the VPN policy rule and routing table over netlink, changing only what differs
+	@param vpn VPN object
+
+	@return ERROR on failure, SUCCESS otherwise
+	"""
+	vpn.updateInfo()
+	try:
+		table = netlink.getTableId(GlobalState.vpnRoutingTable)
+		desired = vpnDesiredRoutes(vpn)
+		sock = netlink.RouteSocket(GlobalState.verbose)
+		try:
+			sock.ensureRule(netlink.Rule(int(str(GlobalState.vpnMark), 0), table))
+			sock.syncRoutes(table, desired)
+		finally:
+			sock.close()
+		return SUCCESS
+	except (netlink.NetlinkError, KeyError) as ne:
+		msg = ''.join(ne.args)
+		logging.info("Netlink: Error setting VPN routes and rules: %s" % (msg))
+		if (GlobalState.verbose):
+			print("Netlink: Error setting VPN routes and rules: %s" % (msg))
+	return ERROR
+
+def vpnSetFirewall():
+	"""
+	Load the nftables firewall ruleset (only if it changed)
+
+	@return ERROR on failure, SUCCESS otherwise
+	"""
+	fw = firewall.NftFirewall(verbose = GlobalState.verbose)
+	try:
+		ruleset = fw.render(GlobalState.lanInterface.getId(),
+							[GlobalState.lanInterface.getNetworkParams()],
+							GlobalState.vpnInterface,
+							GlobalState.vpnUser,
+							GlobalState.vpnMark)
+		fw.apply(ruleset)
+		return SUCCESS
+	except firewall.FirewallError as fe:
+		msg = ''.join(fe.args)
+		logging.info("Firewall: Error: %s" % (msg))
+		if (GlobalState.verbose):
+			print("Firewall: Error: %s" % (msg))
+	return ERROR
+
+@trace.traced
+def vpnSetBlocklist():
+	"""
+	Load the (merged) blocklist into the nftables blocklist set, if one is configured
+	The list is only parsed when it changed, and only the changed ranges are applied,
+	unless the table had to be set up again.
+
+	@return ERROR on failure, SUCCESS otherwise
 	"""
-	Set the VPN routes, rules and iptables entries based on configured parameters
+	if (not GlobalState.vpnBlocklist):
+		return SUCCESS
+	bl = firewall.NftBlocklist(verbose = GlobalState.verbose)
+	try:
+		# New rules mean a new (or recreated) table: its set is reloaded completely
+		reload = bl.setRules(GlobalState.vpnInterface, GlobalState.vpnMark)
+		if ((not reload) and bl.isCurrent(GlobalState.vpnBlocklist)):
+			return SUCCESS
+		ranges = iprange.RangeSet.fromFiles([GlobalState.vpnBlocklist])
+		bl.sync(ranges, force = reload)
+		bl.markCurrent(GlobalState.vpnBlocklist)
+		return SUCCESS
+	except firewall.FirewallError as fe:
+		msg = ''.join(fe.args)
+		logging.info("Firewall: Blocklist error: %s" % (msg))
+		if (GlobalState.verbose):
+			print("Firewall: Blocklist error: %s" % (msg))
+		bl.reset()
+	except OSError as oe:
+		logging.info("Firewall: Unable to read blocklist %s: %s" % (GlobalState.vpnBlocklist, oe))
+		if (GlobalState.verbose):
+			print("Firewall: Unable to read blocklist %s: %s" % (GlobalState.vpnBlocklist, oe))
+	return ERROR
+
+@trace.traced
+def vpnSetRoutesAndRules(vpn):
+	"""
+	Set the VPN routes, rules and firewall entries based on configured parameters
+	Routes and rules are set over netlink; if that fails the script sets them instead.
+	The firewall is set by the script (iptables) or loaded as an nftables ruleset.
+	@param vpn VPN object
+
+	@return ERROR on failure, SUCCESS otherwise
 	"""
 	cmd = [GlobalState.basePath + "/Network/vpn_route.sh",
 			"-s", GlobalState.initSystem,
@@ -230,6 +697,16 @@ def vpnSetRoutesAndRules():
 			"-t", GlobalState.vpnRoutingTable,
 			"-u", GlobalState.vpnUser]
 
+	routesSet = (vpnSetRoutes(vpn) == SUCCESS)
+	if (GlobalState.vpnFirewall == "nftables"):
+		if (vpnSetFirewall() == ERROR):
+			return ERROR
+		if (routesSet):
+			return SUCCESS
+		cmd.append("--routes-only")
+	elif (routesSet):
+		cmd.append("--firewall-only")
+
 	if (GlobalState.verbose):
 		print("Command to execute: %s" % cmd)
 
@@ -249,6 +726,41 @@ def vpnSetRoutesAndRules():
 			print("Exception Command output:\n%s" % outString)
 	return ERROR
 
+def getExternalIpResolver():
+	"""
+	Retrieve the resolver used for the external IP check, creating it on first use
+	Queries are sent from a socket marked with the VPN mark, so they are routed
+	like the VPN user's traffic. The tries share the probe deadline with some
+	margin left, so a retry can still answer before the probe is cancelled.
+
+	@return dns.DnsResolver object
+	"""
+	if (GlobalState.externalIpResolver is None):
+		retries = 1
+		GlobalState.externalIpResolver = dns.DnsResolver(GlobalState.vpnExternalIpResolver,
+														 timeout = GlobalState.vpnProbeTimeout / (retries + 2),
+														 retries = retries,
+														 mark = int(str(GlobalState.vpnMark), 0),
+														 cacheTtl = GlobalState.vpnExternalIpCacheTtl,
+														 verbose = GlobalState.verbose)
+	return GlobalState.externalIpResolver
+
+def externalIpIsVpn(extIp):
+	"""
+	Compare the apparent external IP with the ISP provided IP
+	@param extIp The apparent external IP
+
+	@return SUCCESS if the first octets differ (thus traffic leaves via the VPN), ERROR otherwise
+	"""
+	extFirst = extIp.split('.')[0]
+	if (extFirst != GlobalState.ispIpFirstOctet):
+		logging.info("External IP: First octets are different, assuming VPN link up (external: %s; ISP %s)" % (extFirst, GlobalState.ispIpFirstOctet))
+		if (GlobalState.verbose):
+			print("External IP: First octets are different, assuming VPN link up (external: %s; ISP %s)" % (extFirst, GlobalState.ispIpFirstOctet))
+		return SUCCESS
+	return ERROR
+
+@trace.traced
 def vpnCheckExternalIp():
 	"""
 	Attempt to determine what the Transmission user context think is the internet
@@ -260,40 +772,89 @@ def vpnCheckExternalIp():
 	if (GlobalState.verbose):
 		print("VPN: Testing apparent external IP")
 
-	digCmd = "dig +short myip.opendns.com @resolver1.opendns.com"
-
-	cmd = ["su", "-l", GlobalState.vpnUser, "-s", "/bin/bash", "-c", digCmd]
-	if (GlobalState.verbose):
-		print("dig: command to execute")
-		print(cmd)
 	try:
-		logging.info("dig: running...")
-		output = subprocess.check_output(cmd)
-		outString = output.decode("utf-8").strip('\n')
-		logging.info("dig: completed (%s)" % (outString))
+		addrs = getExternalIpResolver().queryA(dns.OPENDNS_MYIP)
+		logging.info("External IP: %s" % (addrs[0]))
 		if (GlobalState.verbose):
-			print(outString)
-
-		digFirst = outString.split('.')[0]
-		if (digFirst != GlobalState.ispIpFirstOctet):
-			logging.info("dig: First octets are different, assuming VPN link up (dig: %s; ISP %s)" % (digFirst, GlobalState.ispIpFirstOctet))
-			if (GlobalState.verbose):
-				print("dig: First octets are different, assuming VPN link up (dig: %s; ISP %s)" % (digFirst, GlobalState.ispIpFirstOctet))
-			return SUCCESS
-
-	except subprocess.CalledProcessError as cpe:
-		outString = cpe.output.decode("utf-8")
-		logging.info("dig: Error %d" % cpe.returncode)
-		logging.info("dig: Exception Command output:\n%s" % outString)
+			print("External IP: %s" % (addrs[0]))
+		return externalIpIsVpn(addrs[0])
+	except dns.DnsError as de:
+		msg = ''.join(de.args)
+		logging.info("External IP: Error: %s" % (msg))
 		if (GlobalState.verbose):
-			print("dig: Error %d" % cpe.returncode)
-			print("dig: Exception Command output:\n%s" % outString)
+			print("External IP: Error: %s" % (msg))
 
 	return ERROR
 
+def vpnProbeDecide(results):
+	"""
+	Decide on the VPN health from the probe results collected so far
+	The VPN is up if the service is running and either the peer answers pings or
+	the external IP is not the ISP IP. It is down as soon as the service is
+	known to be stopped, or once both connectivity probes failed.
+	@param results Dictionary of probe name -> probe result
+
+	@return vpnet.UP, vpnet.DOWN, or None if more results are needed
+	"""
+	srv = results.get("service")
+	if ((srv is not None) and (srv != probe.PASS)):
+		return vpnet.DOWN
+
+	connected = ((results.get("ping") == probe.PASS) or (results.get("extip") == probe.PASS))
+	if (connected and (srv == probe.PASS)):
+		return vpnet.UP
+
+	failed = [k for k in ("ping", "extip") if ((k in results) and (results[k] != probe.PASS))]
+	if (len(failed) == 2):
+		return vpnet.DOWN
+	return None
+
+@trace.traced
+def vpnProbe(vpn):
+	"""
+	Determine if the VPN is up and functional, running the service status, ping and
+	external IP checks concurrently (each limited to GlobalState.vpnProbeTimeout)
+	@param vpn VPN object to probe
+
+	@return vpnet.UP if the VPN is active and functional, vpnet.DOWN otherwise
+	"""
+	# The interface check is an in-process lookup, do it first
+	if (vpn.vpnIf.getStatus() != interface.UP):
+		logging.info("VPN: Interface is not available")
+		return vpnet.DOWN
+
+	vpn.updateInfo()
+	if (vpn.getPingCmd() is None):
+		return vpnet.DOWN
+
+	timeout = GlobalState.vpnProbeTimeout
+	if (vpn.service.hasNativeStatus()):
+		srvProbe = probe.CallableProbe("service",
+									   lambda: probe.PASS if (vpn.service.getStatus(0) == service.RUNNING) else probe.FAIL,
+									   timeout)
+	else:
+		srvProbe = probe.CommandProbe("service", vpn.service.getCmd("status"), timeout,
+									  lambda rc, out: probe.PASS if ((rc == 0) and (vpn.service.parseStatus(out) == service.RUNNING)) else probe.FAIL)
+	probes = [srvProbe,
+			  probe.CallableProbe("ping",
+								  lambda: probe.PASS if (vpn.pingPeer(GlobalState.vpnPingCount, GlobalState.vpnPingMaxLoss, GlobalState.vpnPingMaxRtt) == vpnet.UP) else probe.FAIL,
+								  timeout)]
+	if (GlobalState.ispIpFirstOctet != "0"):
+		probes.append(probe.CallableProbe("extip",
+										  lambda: probe.PASS if (vpnCheckExternalIp() == SUCCESS) else probe.FAIL,
+										  timeout))
+
+	verdict, results = probe.runProbes(probes, vpnProbeDecide)
+	if (GlobalState.verbose):
+		print("VPN probe results: %s" % (dict((k, probe.RESULT_NAMES.get(v, v)) for k, v in results.items())))
+	if (verdict == vpnet.UP):
+		return vpnet.UP
+	return vpnet.DOWN
+
+@trace.traced
 def vpnCheck(vpn, maxAttempts = 1):
 	"""
-	Check the VPN state and attempt to start it if necessary
+	Check the VPN state and attempt to (re)start it if necessary
 	@param vpn VPN object to check & start
 	@param maxAttempts The maximum number of attempts to start the VPN before giving up (defaults to 1)
 
@@ -301,74 +862,72 @@ def vpnCheck(vpn, maxAttempts = 1):
 	"""
 	retVal = ERROR
 
-	for attempt in range(0, maxAttempts):
-		try:
-			vpnStatus = vpn.getStatus()
-		except vpnet.VPNError as ve:
-			msg = ''.join(ve.args)
-			logging.info("Exception occured while checking VPN status: %s" % (msg))
-			if (GlobalState.verbose):
-				print("Exception occured while checking VPN status: %s" % (msg))
-			return ERROR
-
-		if (vpnStatus != vpnet.UP):
-			logging.info("VPN not up, attempting to start [%d/%d]" % (attempt, maxAttempts))
-			if (GlobalState.verbose):
-				print("VPN is down, starting it...")
+	try:
+		vpnStatus = vpnProbe(vpn)
+	except vpnet.VPNError as ve:
+		msg = ''.join(ve.args)
+		logging.info("Exception occured while checking VPN status: %s" % (msg))
+		if (GlobalState.verbose):
+			print("Exception occured while checking VPN status: %s" % (msg))
+		VPN_CHECKS.inc(result = "error")
+		VPN_HEALTHY.set(0)
+		return ERROR
 
-			if (GlobalState.initSystem == "openRC"):
-				vpnStatus = vpn.start()
-			else:
-				vpnStatus = vpn.start(5,5) # systemd might not be ready immediately
+	downSince = None if (vpnStatus == vpnet.UP) else time.monotonic()
 
-			if (vpnStatus != vpnet.UP):
-				logging.info("VPN: failed to start on attempt %d of %d, aborting" % (attempt, maxAttempts))
-				if (GlobalState.verbose):
-					print("VPN failed to start on attempt %d of %d, aborting" % (attempt, maxAttempts))
-				retVal = ERROR
-				break
-
-			# Set routes and rules
-			retVal = vpnSetRoutesAndRules()
-			if (retVal == ERROR):
-				logging.info("VPN: failed to set rules and route on attempt %d of %d, aborting" % (attempt, maxAttempts))
-				if (GlobalState.verbose):
-					print("VPN failed to set rules and route on attempt %d of %d, aborting" % (attempt, maxAttempts))
-				break
+	for attempt in range(0, maxAttempts):
+		if (vpnStatus == vpnet.UP):
+			# Reaching this point means the VPN is up and connected
+			retVal = SUCCESS
+			break
 
-		# Here the VPN service should be up with the tunnel interface configured
+		logging.info("VPN not up or not functional, attempting to (re)start [%d/%d]" % (attempt, maxAttempts))
 		if (GlobalState.verbose):
-			print("VPN appears up, getting info and pinging peer")
-		vpn.updateInfo()
-		vpnStatus = vpn.pingPeer()
+			print("VPN is down or not functional, (re)starting it...")
+		VPN_RESTARTS.inc()
+		with trace.span("vpn.stop"):
+			vpn.stop() # Make sure a half-working VPN is stopped before restarting it
+		if (GlobalState.externalIpResolver is not None):
+			GlobalState.externalIpResolver.clearCache()
+
+		# Returns as soon as the tunnel has an address; the arguments only bound the wait
+		with trace.span("vpn.start", attempt = attempt):
+			vpnStatus = vpn.start(5,5)
 
 		if (vpnStatus != vpnet.UP):
-			logging.info("VPN: Failed to ping peer, attempting to determine external IP")
+			logging.info("VPN: failed to start on attempt %d of %d, aborting" % (attempt, maxAttempts))
 			if (GlobalState.verbose):
-				print("VPN: Failed to ping peer, attempting to determine external IP")
-				
-			if (GlobalState.ispIpFirstOctet != "0"):
-				logging.info("VPN: Attempting to determine external IP")
-				if (GlobalState.verbose):
-					print("VPN: Attempting to determine external IP")
-				retVal = vpnCheckExternalIp()
-			else:
-				retVal = ERROR
+				print("VPN failed to start on attempt %d of %d, aborting" % (attempt, maxAttempts))
+			retVal = ERROR
+			break
+
+		# Set routes and rules
+		retVal = vpnSetRoutesAndRules(vpn)
+		if (retVal == ERROR):
+			logging.info("VPN: failed to set rules and route on attempt %d of %d, aborting" % (attempt, maxAttempts))
+			if (GlobalState.verbose):
+				print("VPN failed to set rules and route on attempt %d of %d, aborting" % (attempt, maxAttempts))
+			break
 
-			if (retVal == ERROR):
-				logging.info("VPN: External IP check failed or disabled")
-				if (GlobalState.verbose):
-					print("VPN: External IP check failed or disabled")
-				vpn.stop() # Restart VPN to get a better connection
-				continue
+		# Here the VPN service should be up with the tunnel interface configured
+		if (GlobalState.verbose):
+			print("VPN appears up, probing connectivity")
+		vpnStatus = vpnProbe(vpn)
+		retVal = SUCCESS if (vpnStatus == vpnet.UP) else ERROR
+		if (retVal == ERROR):
+			logging.info("VPN: Connectivity probes failed on attempt %d of %d" % (attempt, maxAttempts))
 
-		# Reaching this point means the VPN is up and connected
+	if (retVal == SUCCESS):
 		logging.info("VPN: Active and functional")
-		retVal = SUCCESS
-		break
-
-	if (retVal == ERROR):
+		if (downSince is not None):
+			VPN_RECOVERY_SECONDS.observe(time.monotonic() - downSince)
+	else:
 		vpn.stop()
+	if (downSince is None):
+		VPN_CHECKS.inc(result = "up")
+	else:
+		VPN_CHECKS.inc(result = "recovered" if (retVal == SUCCESS) else "error")
+	VPN_HEALTHY.set(1 if (retVal == SUCCESS) else 0)
 	return retVal
 
 def configParseShared(sharedConfig):
@@ -430,6 +989,33 @@ def configParseVpn(vpnConfig):
 	else:
 		GlobalState.vpnPingOne = False
 
+	if 'Firewall' in vpnConfig:
+		if (vpnConfig['Firewall'] not in ("iptables", "nftables")):
+			print("Error: VPN Firewall must be either iptables or nftables")
+			sys.exit(1)
+		GlobalState.vpnFirewall = vpnConfig['Firewall']
+
+	if 'Blocklist' in vpnConfig:
+		GlobalState.vpnBlocklist = vpnConfig['Blocklist']
+
+	if 'ExternalIpResolver' in vpnConfig:
+		GlobalState.vpnExternalIpResolver = vpnConfig['ExternalIpResolver']
+
+	try:
+		if 'ProbeTimeout' in vpnConfig:
+			GlobalState.vpnProbeTimeout = float(vpnConfig['ProbeTimeout'])
+		if 'PingCount' in vpnConfig:
+			GlobalState.vpnPingCount = int(vpnConfig['PingCount'])
+		if 'PingMaxLoss' in vpnConfig:
+			GlobalState.vpnPingMaxLoss = int(vpnConfig['PingMaxLoss']) / 100.0
+		if 'PingMaxRtt' in vpnConfig:
+			GlobalState.vpnPingMaxRtt = int(vpnConfig['PingMaxRtt'])
+		if 'ExternalIpCacheTtl' in vpnConfig:
+			GlobalState.vpnExternalIpCacheTtl = int(vpnConfig['ExternalIpCacheTtl'])
+	except ValueError:
+		print("Error: VPN ProbeTimeout, PingCount, PingMaxLoss, PingMaxRtt and ExternalIpCacheTtl must be numeric")
+		sys.exit(1)
+
 def configParseTorrents(torrentConfig):
 	"""
 	Parse Torrent configuration
@@ -467,6 +1053,18 @@ def configParseTorrents(torrentConfig):
 		print("Error: Provided config does not specify the daemon name")
 		sys.exit(1)
 
+	# Only needed if the RPC interface requires authentication (settings.json
+	# only holds a hash of the password)
+	if 'RpcUsername' in torrentConfig:
+		GlobalState.torrentRpcUsername = torrentConfig['RpcUsername']
+	if 'RpcPassword' in torrentConfig:
+		GlobalState.torrentRpcPassword = torrentConfig['RpcPassword']
+
+	if 'IndexFile' in torrentConfig:
+		GlobalState.torrentIndexFile = torrentConfig['IndexFile']
+	if 'MinFreeSpace' in torrentConfig:
+		GlobalState.torrentMinFreeSpace = int(torrentConfig['MinFreeSpace']) * 1024 * 1024
+
 def configParseFlexget(flexgetConfig):
 	"""
 	Parse Flexget configuration
@@ -480,6 +1078,91 @@ def configParseFlexget(flexgetConfig):
 		print("Error: Provided config does not specify the Flexget binary location")
 		sys.exit(1)
 
+	if 'ConfigDir' in flexgetConfig:
+		GlobalState.flexgetConfigDir = flexgetConfig['ConfigDir']
+	else:
+		GlobalState.flexgetConfigDir = os.path.join(GlobalState.torrentHomePath, ".flexget")
+	try:
+		if 'Daemon' in flexgetConfig:
+			GlobalState.flexgetDaemon = flexgetConfig.getboolean('Daemon')
+		if 'Timeout' in flexgetConfig:
+			GlobalState.flexgetTimeout = int(flexgetConfig['Timeout'])
+	except ValueError:
+		print("Error: Flexget Daemon must be yes or no and Timeout a whole number of seconds")
+		sys.exit(1)
+	if (GlobalState.flexgetTimeout <= 0):
+		print("Error: Flexget Timeout must be positive")
+		sys.exit(1)
+
+def configParseDaemon(daemonConfig):
+	"""
+	Parse daemon configuration (optional section)
+	@param daemonConfig Daemon configuration dictionary as extracted from the supplied configuration file
+
+	Nothing is returned, but GlobalState members are set
+	"""
+	try:
+		if 'Interval' in daemonConfig:
+			GlobalState.daemonInterval = int(daemonConfig['Interval'])
+		if 'Jitter' in daemonConfig:
+			GlobalState.daemonJitter = int(daemonConfig['Jitter'])
+	except ValueError:
+		print("Error: Daemon Interval and Jitter must be specified in whole seconds")
+		sys.exit(1)
+
+	if ((GlobalState.daemonInterval <= 0) or (GlobalState.daemonJitter < 0)):
+		print("Error: Daemon Interval must be positive and Jitter may not be negative")
+		sys.exit(1)
+
+def configParseLogging(loggingConfig):
+	"""
+	Parse logging configuration (optional section)
+	@param loggingConfig Logging configuration dictionary as extracted from the supplied configuration file
+
+	Nothing is returned, but GlobalState members are set
+	"""
+	try:
+		if 'MaxSize' in loggingConfig:
+			GlobalState.logMaxSize = int(loggingConfig['MaxSize']) * 1024
+		if 'Backups' in loggingConfig:
+			GlobalState.logBackups = int(loggingConfig['Backups'])
+		if 'SpillCount' in loggingConfig:
+			GlobalState.logSpillCount = int(loggingConfig['SpillCount'])
+	except ValueError:
+		print("Error: Logging MaxSize, Backups and SpillCount must be whole numbers")
+		sys.exit(1)
+	if 'SpillDir' in loggingConfig:
+		GlobalState.logSpillDir = loggingConfig['SpillDir']
+
+def configParseMetrics(metricsConfig):
+	"""
+	Parse metrics configuration (optional section)
+	@param metricsConfig Metrics configuration dictionary as extracted from the supplied configuration file
+
+	Nothing is returned, but GlobalState members are set
+	"""
+	if 'TextFile' in metricsConfig:
+		GlobalState.metricsTextFile = metricsConfig['TextFile']
+		if (GlobalState.metricsTextFile and (not GlobalState.metricsTextFile.endswith(".prom"))):
+			print("Error: Metrics TextFile must end in .prom to be picked up by the textfile collector")
+			sys.exit(1)
+	if 'JsonFile' in metricsConfig:
+		GlobalState.metricsJsonFile = metricsConfig['JsonFile']
+
+def configParseFastPath(fastPathConfig):
+	"""
+	Parse idle fast path configuration (optional section)
+	@param fastPathConfig Fast path configuration dictionary as extracted from the supplied configuration file
+
+	Nothing is returned, but GlobalState members are set
+	"""
+	try:
+		if 'Revalidate' in fastPathConfig:
+			GlobalState.fastPathRevalidate = int(fastPathConfig['Revalidate'])
+	except ValueError:
+		print("Error: FastPath Revalidate must be a whole number")
+		sys.exit(1)
+
 def getConfig(configFile):
 	"""
 	Parse the configuration file
@@ -512,47 +1195,70 @@ def getConfig(configFile):
 		configParseVpn(config['VPN'])
 		configParseTorrents(config['Torrents'])
 		configParseFlexget(config['Flexget'])
+		if 'Daemon' in config.sections():
+			configParseDaemon(config['Daemon'])
+		if 'Logging' in config.sections():
+			configParseLogging(config['Logging'])
+		if 'Metrics' in config.sections():
+			configParseMetrics(config['Metrics'])
+		if 'FastPath' in config.sections():
+			configParseFastPath(config['FastPath'])
 
 	except configparser.ParsingError:
 		print("Error parsing config file %s" % configFile)
 		sys.exit(1)
 
+@trace.traced
 def flexgetRun():
 	"""
 	Run the Flexget application to find and download new torrent files
+	With [Flexget] Daemon enabled the execution is handed to the Flexget daemon,
+	otherwise (or if the daemon cannot be used) Flexget is started directly.
 
 	@return ERROR on failure, SUCCESS otherwise
 	"""
-	if (GlobalState.testMode):
-		flexgetCmd = "%s --test execute" % GlobalState.flexgetBin
-	else:
-		flexgetCmd = "%s --cron execute" % GlobalState.flexgetBin
-
-	cmd = ["su", "-l", GlobalState.vpnUser, "-s", "/bin/bash", "-c", flexgetCmd]
-	#cmd = ["ls", "-lah", GlobalState.flexgetBin]
-	if (GlobalState.verbose):
-		print("Flexget: command to execute")
-		print(cmd)
-	try:
-		logging.info("Flexget: running...")
-		output = subprocess.check_output(cmd)
-		outString = output.decode("utf-8")
-		logging.info("Flexget: completed")
+	logging.info("Flexget: running...")
+	startTime = time.monotonic()
+	run = GlobalState.flexgetRunner.run(GlobalState.testMode)
+	FLEXGET_SECONDS.observe(time.monotonic() - startTime)
+	FLEXGET_RUNS.inc(method = run.method, result = run.result)
+
+	for task in sorted(run.tasks):
+		counts = run.tasks[task]
+		FLEXGET_TASKS.inc(task = task, result = "aborted" if (counts["aborted"]) else "ok")
+		FLEXGET_ACCEPTED.inc(counts["accepted"], task = task)
+		logging.info("Flexget: task %s: %d accepted, %d rejected, %d undecided, %d failed%s" %
+					 (task, counts["accepted"], counts["rejected"], counts["undecided"], counts["failed"],
+					  " (aborted)" if (counts["aborted"]) else ""))
+
+	if (run.result == flexget.RESULT_SUCCESS):
+		logging.info("Flexget: completed (%s)" % (run.method))
 		if (GlobalState.verbose):
-			print(outString)
+			print(run.output)
 		return SUCCESS
-	except subprocess.CalledProcessError as cpe:
-		outString = cpe.output.decode("utf-8")
-		logging.info("Flexget: Error %d" % cpe.returncode)
-		logging.info("Flexget: Exception Command output:\n%s" % outString)
-		if (GlobalState.verbose):
-			print("Flexget error: %d" % cpe.returncode)
-			print("Exception Command output:\n%s" % outString)
+
+	if (run.result == flexget.RESULT_TIMEOUT):
+		logging.info("Flexget: no result after %d s (%s)" % (GlobalState.flexgetTimeout, run.method))
+	elif (run.returnCode is not None):
+		logging.info("Flexget: Error %d" % run.returnCode)
+	else:
+		logging.info("Flexget: Error (%s)" % (run.method))
+	logging.info("Flexget: output:\n%s" % run.output)
+	if (run.log):
+		logging.info("Flexget: log:\n%s" % run.log)
+	if (GlobalState.verbose):
+		print("Flexget error: %s" % (run.result))
+		print("Output:\n%s" % run.output)
 	return ERROR
 
+@trace.traced
 def transmissionUpdateBindIp(transmissionService, configFile, vpnIp):
 	"""
 	Update the Transmission IPv4 bind address (if necessary)
+	A running daemon is asked to reread its settings (SIGHUP via the service
+	reload action), which keeps its peer connections; it is only stopped (to be
+	started again by the caller) if it does not pick up the new address.
+	@param transmissionService Torrent daemon service object
 	@param configFile Transmission configuration file
 	@param vpnIp The current VPN IP
 
@@ -562,167 +1268,440 @@ def transmissionUpdateBindIp(transmissionService, configFile, vpnIp):
 	if (GlobalState.verbose):
 		print("VPN IP: %s" % vpnIp)
 	try:
-		with open(configFile, 'r') as config:
-			data = config.readlines()
-	except FileNotFoundError as fnfe:
-		logging("Transmission: File %s not found" % configFile)
+		settings = transmissionCfg.loadSettings(configFile)
+	except transmissionCfg.TransmissionError as te:
+		msg = ''.join(te.args)
+		logging.info("Transmission: %s" % (msg))
 		if (GlobalState.verbose):
-			print("File %s not found" % configFile)
+			print(msg)
 		return ERROR
 
-	idx = 0
-	while idx < len(data):
-		line = data[idx]
+	bindIp = settings.get(transmissionCfg.KEY_BIND_IPV4)
+	logging.info("Transmission: Bind IPv4: %s" % bindIp)
+	if (GlobalState.verbose):
+		print("Bind IPv4: %s" % bindIp)
+	if (bindIp == vpnIp):
+		logging.info("Transmission: No Transmission IPv4 bind address update required")
+		if (GlobalState.verbose):
+			print("No Transmission IPv4 bind address update required")
+		return SUCCESS
 
-		if "bind-address-ipv4" in line:
-			#tmp = line.split()
-			bindIp = line.split()[1].strip('",')
-			logging.info("Transmission: Bind IPv4: %s" % bindIp)
-			if (GlobalState.verbose):
-				print("Bind IPv4: %s" % bindIp)
-			if (bindIp == vpnIp):
-				logging.info("Transmission: No Transmission IPv4 bind address update required")
-				if (GlobalState.verbose):
-					print("No Transmission IPv4 bind address update required")
-				return SUCCESS
-			else:
-				logging.info("Transmission: Current and stored IPs do not match, update required")
-				if (GlobalState.verbose):
-					print("Current and stored IPs do not match, update required")
-				# Stop the transmission service
-				while (transmissionService.getStatus() == service.RUNNING):
-					transmissionService.stop()
-					# Give the service time to stop
-					time.sleep(1)
+	logging.info("Transmission: Current and stored IPs do not match, update required")
+	if (GlobalState.verbose):
+		print("Current and stored IPs do not match, update required")
+	settings[transmissionCfg.KEY_BIND_IPV4] = vpnIp
+	try:
+		transmissionCfg.saveSettings(configFile, settings)
+	except transmissionCfg.TransmissionError as te:
+		msg = ''.join(te.args)
+		logging.info("Transmission: %s" % (msg))
+		if (GlobalState.verbose):
+			print(msg)
+		return ERROR
+	logging.info("Transmission: IPv4 bind address update")
 
-				# Update the configured IPv4 bind address
-				data[idx] = "    \"bind-address-ipv4\": \""+ vpnIp +"\",\n"
+	if (transmissionService.getStatus(0) != service.RUNNING):
+		# Picked up on the next start
+		return SUCCESS
 
-		else:
-			newLine = line
-		idx += 1
+	startTime = time.monotonic()
+	if (transmissionService.reload() and
+		service.waitFor(lambda: transmissionCfg.isPeerPortBound(settings, vpnIp), TRANSMISSION_REBIND_TIMEOUT)):
+		TRANSMISSION_REBINDS.inc(method = "reload", result = "success")
+		TRANSMISSION_REBIND_SECONDS.observe(time.monotonic() - startTime, method = "reload")
+		logging.info("Transmission: Rebound to %s without restart" % (vpnIp))
+		if (GlobalState.verbose):
+			print("Transmission rebound to %s without restart" % (vpnIp))
+		return SUCCESS
+	TRANSMISSION_REBINDS.inc(method = "reload", result = "error")
 
-	# Wrtie back the data to the file
-	with open(configFile, 'w') as config:
-		config.writelines(data)
+	logging.info("Transmission: Daemon did not rebind to %s, restarting it" % (vpnIp))
+	if (GlobalState.verbose):
+		print("Transmission did not rebind, restarting it")
+	# Downtime runs until the caller has started the daemon again
+	GlobalState.transmissionDownSince = startTime
+	transmissionService.stop()
+	if (not service.waitFor(lambda: transmissionService.getStatus(0) == service.STOPPED, TRANSMISSION_STOP_TIMEOUT)):
+		logging.info("Transmission: Daemon did not stop")
+		TRANSMISSION_REBINDS.inc(method = "restart", result = "error")
+		GlobalState.transmissionDownSince = None
+		return ERROR
 
-	logging.info("Transmission: IPv4 bind address update")
+	# The daemon saves its settings on exit; make sure the new address survived
+	try:
+		if (transmissionCfg.loadSettings(configFile).get(transmissionCfg.KEY_BIND_IPV4) != vpnIp):
+			transmissionCfg.saveSettings(configFile, settings)
+	except transmissionCfg.TransmissionError as te:
+		logging.info("Transmission: %s" % (''.join(te.args)))
+		return ERROR
 	return SUCCESS
 
-######################################################################################
-def main():
-	parseCommandLine(sys.argv)
-	getConfig(GlobalState.configFile)
+def createObjects():
+	"""
+	Create the VPN and torrent daemon service objects from the configuration
 
-	# Start log
-	logging.basicConfig(filename = GlobalState.logFile, level = logging.INFO)
+	@return Tuple of (vpn, transmission) objects
+	@throws VPNError or ServiceError if the objects could not be created
+	"""
+	try:
+		vpn = vpnet.VPN(GlobalState.vpnProvider, GlobalState.vpnInterface, GlobalState.initSystem, GlobalState.vpnPingOne, GlobalState.verbose)
+		transmission = service.Service(GlobalState.torrentDaemonName, GlobalState.initSystem, GlobalState.verbose)
+	except vpnet.VPNError as ve:
+		msg = ''.join(ve.args)
+		logging.info("VPN exception occured: %s" % (msg))
+		if (GlobalState.verbose):
+			print("VPN exception occured: %s" % (msg))
+		raise
+	except service.ServiceError as se:
+		msg = ''.join(se.args)
+		logging.info("Service exception occured: %s" % (msg))
+		if (GlobalState.verbose):
+			print("Service exception occured: %s" % (msg))
+		raise
+	return vpn, transmission
 
-	pid = str(os.getpid())
+@trace.traced
+def runCycle(vpn, transmission):
+	"""
+	Run a single pass of all the checks
+	@param vpn VPN object to check & start
+	@param transmission Torrent daemon service object
+
+	@return ERROR on failure, SUCCESS otherwise
+	"""
+	global currentDate, currentTime
+	currentDate = datetime.datetime.now()
+	currentTime = currentDate.time()
 
 	curDate = "%04d-%02d-%02d" % (currentDate.year, currentDate.month, currentDate.day)
 	curTime = "%02d:%02d" % (currentTime.hour, currentTime.minute)
 
-	# Test if another instance is already running
-	if (os.path.isfile(GlobalState.pidFile)):
-		logging.info("\t\t-- Process already running, aborting --")
-		if (GlobalState.verbose):
-			print("\t\t-- [%s %s] Process already running, aborting --" % (curDate, curTime))
-		sys.exit()
+	logging.info("========================================================================")
+	logging.info("%s - %s" % (curDate, curTime))
 
-	open(GlobalState.pidFile, 'w').write(pid)
+	if (GlobalState.verbose):
+		print("The current date is %s" % (curDate))
+		print("The current time is %s" % (curTime))
 
-	try:
-		logging.info("========================================================================")
-		logging.info("%s - %s" % (curDate, curTime))
+	setLanInfo()
+	torrentsRemoveCompleted(transmission)
+	torrentsScreen()
+
+	currentTorrents = False
+	GlobalState.cycleIdle = False
 
+	vpnNeeded = (needFlexget() or needTorrentClient())
+	if (vpnNeeded):
+		logging.info("VPN: connection is needed")
 		if (GlobalState.verbose):
-			print("The current date is %s" % (curDate))
-			print("The current time is %s" % (curTime))
+			print("VPN connection is needed")
 
-		setLanInfo()
+		r = vpnCheck(vpn, 2)
+		if (r == SUCCESS):
+			if (GlobalState.verbose):
+				print("VPN is good to go")
+			# Not fatal: the daemon's own blocklists still apply
+			vpnSetBlocklist()
+		else:
+			if (GlobalState.verbose):
+				print("VPN error, aborting")
+			return ERROR
 
-		currentTorrents = False
+	# Here the VPN can be concidered up and functional
+	if (needFlexget()):
+		logging.info("Flexget needs to be run")
+		flexgetRun()
 
-		try:
-			vpn = vpnet.VPN(GlobalState.vpnProvider, GlobalState.vpnInterface, GlobalState.initSystem, GlobalState.vpnPingOne, GlobalState.verbose)
-			transmission = service.Service(GlobalState.torrentDaemonName, GlobalState.initSystem, GlobalState.verbose)
-		except vpnet.VPNError as ve:
-			msg = ''.join(ve.args)
-			logging.info("VPN exception occured: %s" % (msg))
+	if (needTorrentClient()):
+		logging.info("Torrent client needed")
+		currentTorrents = True
+		if (transmissionUpdateBindIp(transmission, GlobalState.torrentConfigFile, vpn.getAddr()) == SUCCESS):
 			if (GlobalState.verbose):
-				print("VPN exception occured: %s" % (msg))
-			#sys.exit(1)
-			raise
-		except service.ServiceError as se:
-			msg = ''.join(se.args)
-			logging.info("Service exception occured: %s" % (msg))
+				print("Transmission bind IP is OK")
+		else:
+			logging.info("Transmission: Error with bind IP, aborting")
 			if (GlobalState.verbose):
-				print("Service exception occured: %s" % (msg))
-			#sys.exit(1)
-			raise
+				print("Error with Transmission bind IP, aborting")
+			return ERROR
 
-		if (needFlexget() or needTorrentClient()):
-			logging.info("VPN: connection is needed")
+		if (transmission.getStatus() == service.STOPPED):
+			logging.info("Transmission: Starting Transmission service")
 			if (GlobalState.verbose):
-				print("VPN connection is needed")
+				print("Starting Transmission service")
+			with trace.span("transmission.start"):
+				status = transmission.start()
+			if (GlobalState.transmissionDownSince is not None):
+				# Restarted after a failed rebind
+				TRANSMISSION_REBINDS.inc(method = "restart", result = "success" if (status == service.RUNNING) else "error")
+				if (status == service.RUNNING):
+					TRANSMISSION_REBIND_SECONDS.observe(time.monotonic() - GlobalState.transmissionDownSince, method = "restart")
+				GlobalState.transmissionDownSince = None
+			# If Transmission service fails to start, there is probably nothing we can do at this point
+			# So don't test for it, just fall through and catch any error output in the log
+
+		torrentsIngest()
+
+	if (not currentTorrents):
+		logging.info("Transmission: No active torrents")
+		if (GlobalState.verbose):
+			print("No current torrents\nStop the torrent daemon and VPN")
+		if (transmission.getStatus() == service.RUNNING):
+			logging.info("Stop the torrent daemon")
+			with trace.span("transmission.stop"):
+				transmission.stop()
+		if (vpn.getStatus() == vpnet.UP):
+			logging.info("Stop the VPN")
+			with trace.span("vpn.stop"):
+				vpn.stop()
 
-			r = vpnCheck(vpn, 2)
-			if (r == SUCCESS):
-				if (GlobalState.verbose):
-					print("VPN is good to go")
-			else:
-				if (GlobalState.verbose):
-					print("VPN error, aborting")
-				#sys.exit(1);
-				raise
-
-		# Here the VPN can be concidered up and functional
-		if (needFlexget()):
-			logging.info("Flexget needs to be run")
-			flexgetRun()
-
-		if (needTorrentClient()):
-			logging.info("Torrent client needed")
-			currentTorrents = True
-			if (transmissionUpdateBindIp(transmission, GlobalState.torrentConfigFile, vpn.getAddr()) == SUCCESS):
-				if (GlobalState.verbose):
-					print("Transmission bind IP is OK")
-			else:
-				logging.info("Transmission: Error with bind IP, aborting")
-				if (GlobalState.verbose):
-					print("Error with Transmission bind IP, aborting")
-				#sys.exit(1)
-				raise
+	# Clear any already added torrents
+	torrentsClearProcessed()
+	GlobalState.cycleIdle = not vpnNeeded
+	logging.info("")
+	return SUCCESS
 
-			if (transmission.getStatus() == service.STOPPED):
-				logging.info("Transmission: Starting Transmission service")
-				if (GlobalState.verbose):
-					print("Starting Transmission service")
-				transmission.start()
-				# If Transmission service fails to start, there is probably nothing we can do at this point
-				# So don't test for it, just fall through and catch any error output in the log
+def stateSnapshotStart():
+	"""
+	Start the state snapshot of a one-shot run: the watched files and directories
+	are recorded before the checks, so that anything changing during the cycle
+	makes the next run do the full checks
+	"""
+	snap = snapshot.StateSnapshot(GlobalState.cmdArgs, GlobalState.fastPathRevalidate)
+	for path in (GlobalState.configFile, GlobalState.torrentConfigFile, GlobalState.torrentAddedPath,
+				 GlobalState.torrentActivePath, TORRENT_IDLE_FILE):
+		snap.watch(path)
+	GlobalState.stateSnapshot = snap
 
-		if (not currentTorrents):
-			logging.info("Transmission: No active torrents")
-			if (GlobalState.verbose):
-				print("No current torrents\nStop the torrent daemon and VPN")
-			if (transmission.getStatus() == service.RUNNING):
-				logging.info("Stop the torrent daemon")
-				transmission.stop()
-			if (vpn.getStatus() == vpnet.UP):
-				logging.info("Stop the VPN")
-				vpn.stop()
+def stateSnapshotSave(vpn, transmission, success):
+	"""
+	Complete and write the state snapshot of a one-shot run
+	It only allows the next run to take the idle fast path if the cycle was idle
+	and the VPN, its tunnel interface and the torrent daemon are confirmed stopped
+	(by a stat call each)
+	@param vpn VPN object
+	@param transmission Torrent daemon service object
+	@param success True if the cycle completed
+	"""
+	snap = GlobalState.stateSnapshot
+	GlobalState.stateSnapshot = None
+	if ((snap is None) or (GlobalState.fastPathRevalidate <= 0) or GlobalState.profileFile):
+		snapshot.discard()
+		return
+
+	idle = success and GlobalState.cycleIdle
+	for srv in (vpn.service, transmission):
+		marker = srv.getStatusMarker()
+		running = None if (marker is None) else os.path.lexists(marker)
+		snap.services[srv.name] = {"running": running, "marker": marker}
+		if (running is not False):
+			idle = False # Running, or no way to tell without the init system
+	absent = [os.path.join(snapshot.SYS_NET_DIR, GlobalState.vpnInterface)] + [e["marker"] for e in snap.services.values() if e["marker"]]
+	for path in absent:
+		if (os.path.lexists(path)):
+			idle = False
+		snap.requireAbsent(path)
+	# Torrents queued for removal wait for the daemon's next start (it is stopped
+	# when idle), so they do not end the idle state; a change to the queue does
+	for path in (GlobalState.torrentCompletion.spoolFile, GlobalState.torrentCompletion.workFile):
+		if (os.path.lexists(path)):
+			snap.watch(path)
+		else:
+			snap.requireAbsent(path)
 
-		# Clear any already added torrents
-		torrentsClearProcessed()
-		logging.info("")
+	if (vpn.ifParams):
+		snap.vpnAddr = vpn.getAddr()
+	else:
+		previous = snapshot.StateSnapshot.load()
+		snap.vpnAddr = previous.vpnAddr if (previous is not None) else None
+	try:
+		snap.bindIp = transmissionCfg.loadSettings(GlobalState.torrentConfigFile).get(transmissionCfg.KEY_BIND_IPV4)
+	except transmissionCfg.TransmissionError:
+		pass
 
+	snap.idle = idle
+	try:
+		snap.save()
+		logging.info("State: snapshot saved (%s)" % ("idle" if idle else "not idle"))
+	except OSError as oe:
+		logging.info("State: unable to write %s: %s" % (snapshot.STATE_FILE, oe))
+		snapshot.discard()
+
+def runCycleSafe(vpn, transmission):
+	"""
+	Run a single pass of all the checks, logging (instead of propagating) any exception
+	so that a single bad cycle does not take down the daemon, followed by a
+	summary record (result and duration) of the cycle
+	@param vpn VPN object to check & start
+	@param transmission Torrent daemon service object
+
+	@return ERROR on failure, SUCCESS otherwise
+	"""
+	cycle = logqueue.startCycle()
+	startTime = time.monotonic()
+	result = ERROR
+	if (not GlobalState.daemonMode):
+		stateSnapshotStart()
+	try:
+		result = trace.profileCall(runCycle, vpn, transmission)
 	except Exception as theException:
-		msg = ''.join(se.args)
-		print("Exception occured: %s" % (msg))
+		logging.exception("Exception occured during cycle: %s" % (theException))
+		print("Exception occured: %s" % (theException))
+	if (not GlobalState.daemonMode):
+		stateSnapshotSave(vpn, transmission, result == SUCCESS)
+	durationMs = (time.monotonic() - startTime) * 1000
+	CYCLES.inc(result = "success" if (result == SUCCESS) else "error")
+	CYCLE_SECONDS.observe(durationMs / 1000)
+	LAST_CYCLE.set(round(time.time()))
+	metrics.REGISTRY.export(GlobalState.metricsTextFile, GlobalState.metricsJsonFile)
+	logging.info("Cycle %d: %s in %.0f ms" % (cycle, "success" if (result == SUCCESS) else "error", durationMs),
+				 extra = {"event": "cycle", "result": "success" if (result == SUCCESS) else "error", "durationMs": round(durationMs, 1)})
+	return result
+
+def daemonNextDelay():
+	"""
+	Determine the delay until the next cycle, applying random jitter so that the
+	checks do not line up with other periodic jobs on the system
+
+	@return Delay in seconds
+	"""
+	jitter = random.uniform(-GlobalState.daemonJitter, GlobalState.daemonJitter)
+	return max(1.0, GlobalState.daemonInterval + jitter)
+
+async def daemonLoop(vpn, transmission, stopEvent, wakeEvent):
+	"""
+	Repeat the checks until asked to stop
+	The (blocking) cycle runs in an executor thread, so that signals are still
+	handled by the event loop while a cycle is in progress. A cycle that is in
+	progress when a stop is requested is allowed to complete.
+	@param vpn VPN object to check & start
+	@param transmission Torrent daemon service object
+	@param stopEvent asyncio.Event that is set when the daemon should shut down
+	@param wakeEvent asyncio.Event that is set to start the next cycle immediately
+	"""
+	loop = asyncio.get_event_loop()
+	while (not stopEvent.is_set()):
+		wakeEvent.clear()
+		await loop.run_in_executor(None, runCycleSafe, vpn, transmission)
+
+		delay = daemonNextDelay()
+		if (GlobalState.verbose):
+			print("Daemon: next cycle in %.1f s" % (delay))
+		stopWait = asyncio.ensure_future(stopEvent.wait())
+		wakeWait = asyncio.ensure_future(wakeEvent.wait())
+		done, pending = await asyncio.wait([stopWait, wakeWait], timeout = delay, return_when = asyncio.FIRST_COMPLETED)
+		for fut in pending:
+			fut.cancel()
+
+async def completionLoop(transmission, stopEvent):
+	"""
+	Remove completed torrents shortly after the done-script queued them,
+	instead of waiting for the next cycle
+	@param transmission Torrent daemon service object
+	@param stopEvent asyncio.Event that is set when the daemon should shut down
+	"""
+	loop = asyncio.get_event_loop()
+	while (not stopEvent.is_set()):
+		if (GlobalState.torrentCompletion.isReady()):
+			await loop.run_in_executor(None, torrentsRemoveCompleted, transmission)
+		try:
+			await asyncio.wait_for(stopEvent.wait(), timeout = COMPLETION_POLL_INTERVAL)
+		except asyncio.TimeoutError:
+			pass
+
+def runDaemon(vpn, transmission):
+	"""
+	Run the checks on a schedule until SIGTERM/SIGINT is received
+	@param vpn VPN object to check & start
+	@param transmission Torrent daemon service object
+	"""
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	stopEvent = asyncio.Event()
+
+	def requestStop(signame):
+		logging.info("Daemon: %s received, shutting down" % (signame))
+		if (GlobalState.verbose):
+			print("Daemon: %s received, shutting down" % (signame))
+		stopEvent.set()
+
+	for sig in (signal.SIGTERM, signal.SIGINT):
+		loop.add_signal_handler(sig, requestStop, sig.name)
+
+	# Start a cycle as soon as a new torrent file lands in the watch directory
+	wakeEvent = asyncio.Event()
+
+	def inventoryChanged():
+		if (GlobalState.torrentInventory.processEvents()):
+			logging.info("Daemon: new torrent detected, starting cycle")
+			wakeEvent.set()
+
+	inventoryFd = GlobalState.torrentInventory.fileno()
+	if (inventoryFd is not None):
+		loop.add_reader(inventoryFd, inventoryChanged)
+
+	logging.info("Daemon: started (interval %d s, jitter %d s)" % (GlobalState.daemonInterval, GlobalState.daemonJitter))
+	try:
+		loop.run_until_complete(asyncio.gather(daemonLoop(vpn, transmission, stopEvent, wakeEvent), completionLoop(transmission, stopEvent)))
+	finally:
+		if (inventoryFd is not None):
+			loop.remove_reader(inventoryFd)
+		loop.close()
+	logging.info("Daemon: stopped")
+
+######################################################################################
+def main():
+	parseCommandLine(sys.argv)
+	getConfig(GlobalState.configFile)
+
+	# Start log (written by a background thread; console output goes through it as well)
+	logqueue.setup(GlobalState.logFile, GlobalState.logFormat, GlobalState.logMaxSize, GlobalState.logBackups,
+				   GlobalState.logSpillDir, GlobalState.logSpillCount)
+
+	pid = str(os.getpid())
+
+	# Test if another instance is already running
+	if (os.path.isfile(GlobalState.pidFile)):
+		logging.info("\t\t-- Process already running, aborting --")
+		if (GlobalState.verbose):
+			print("\t\t-- [%s] Process already running, aborting --" % (datetime.datetime.now().strftime("%Y-%m-%d %H:%M")))
+		sys.exit()
+
+	open(GlobalState.pidFile, 'w').write(pid)
+
+	if (GlobalState.profileFile):
+		trace.start(GlobalState.profileFile, GlobalState.profileStatsFile or None)
+
+	# Carry the counters over from the previous run
+	if (GlobalState.metricsJsonFile):
+		metrics.REGISTRY.load(GlobalState.metricsJsonFile)
+
+	try:
+		vpn, transmission = createObjects()
+		GlobalState.torrentInventory = inventory.TorrentInventory(GlobalState.torrentAddedPath, GlobalState.torrentActivePath,
+																  GlobalState.daemonMode, GlobalState.verbose)
+		GlobalState.torrentIndex = metainfo.TorrentIndex(GlobalState.torrentIndexFile, GlobalState.verbose)
+		GlobalState.torrentCompletion = completion.CompletionSpool(verbose = GlobalState.verbose)
+		GlobalState.flexgetRunner = flexget.Flexget(GlobalState.flexgetBin, GlobalState.vpnUser, GlobalState.flexgetConfigDir,
+													GlobalState.flexgetDaemon, GlobalState.flexgetTimeout, GlobalState.verbose)
+
+		if (GlobalState.daemonMode):
+			runDaemon(vpn, transmission)
+		else:
+			runCycleSafe(vpn, transmission)
+
+	except Exception as theException:
+		print("Exception occured: %s" % (theException))
 
 	finally:
+		if (GlobalState.torrentInventory is not None):
+			GlobalState.torrentInventory.close()
+		if (GlobalState.torrentRpc is not None):
+			GlobalState.torrentRpc.close()
 		os.unlink(GlobalState.pidFile)
+		if (GlobalState.profileFile):
+			# Measured after the checks (in a separate interpreter), so it does not skew them
+			trace.measureImports(os.path.dirname(os.path.abspath(__file__)))
+			trace.stop()
 
 if __name__ == '__main__':
 	main()
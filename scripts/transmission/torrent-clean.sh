@@ -1,4 +1,11 @@
 #!/bin/bash
+# Transmission done-script: queue the finished torrent for removal. The
+# orchestrator (torrent_vpn.py) removes the queued torrents in batches, with a
+# single RPC call per batch (see Torrent/completion.py). If the queue cannot
+# be written the torrent is removed directly
+SPOOL="/dev/shm/torrent_vpn.completed"
 PORT="9091"
 
-transmission-remote $PORT  --torrent $TR_TORRENT_ID --remove
+if ! echo "$TR_TORRENT_HASH" >> "$SPOOL" 2>/dev/null; then
+	transmission-remote $PORT --torrent "$TR_TORRENT_HASH" --remove
+fi